@@ -0,0 +1,14 @@
+"""
+Benchmarks. Run them from the repository root, e.g.
+
+    python -m bench.indexes
+"""
+
+
+def percentile(timings, p):
+    """
+    Returns the p-th percentile (0 to 1) of timings, which must be sorted.
+    """
+    if not timings:
+        return 0.0
+    return timings[min(int(len(timings) * p), len(timings) - 1)]
@@ -0,0 +1,127 @@
+"""
+Runs concurrent readers and writers against a SQLite database, once with
+SQLite's defaults and once with the settings from config.py, and reports
+throughput, latency and how many operations failed with "database is
+locked".
+
+    python -m bench.concurrency [--readers 8] [--writers 4] [--seconds 10]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+import config
+
+config.SQLALCHEMY_DATABASE_URI = 'sqlite://'
+
+from bench import percentile
+from gtb.database import configure_engine
+
+
+SCHEMA = ('CREATE TABLE files (id INTEGER PRIMARY KEY, organization_id '
+          'INTEGER, file_name VARCHAR(256), upload_date FLOAT)')
+INDEX = ('CREATE INDEX ix_files_org_date ON files '
+         '(organization_id, upload_date)')
+READ = ('SELECT id, file_name FROM files WHERE organization_id = ? '
+        'ORDER BY upload_date DESC LIMIT 5')
+WRITE = ('INSERT INTO files (organization_id, file_name, upload_date) '
+         'VALUES (?, ?, ?)')
+
+
+def make_engine(path, settings):
+    """
+    Returns an engine configured the way the app configures its own.
+    """
+    engine = create_engine('sqlite:///' + path)
+    configure_engine(engine, settings)
+    return engine
+
+
+def worker(engine, sql, deadline, stats, lock, write):
+    """
+    Runs sql in its own transaction until deadline, recording latencies and
+    lock failures in stats.
+    """
+    timings, failures = [], 0
+    n = 0
+    while time.time() < deadline:
+        n += 1
+        params = (n % 10, 'notes_%d.pdf' % n, time.time()) if write \
+                 else (n % 10,)
+        began = time.time()
+        try:
+            conn = engine.connect()
+            try:
+                if write:
+                    trans = conn.begin()
+                    conn.execute(sql, params)
+                    trans.commit()
+                else:
+                    conn.execute(sql, params).fetchall()
+            finally:
+                conn.close()
+        except OperationalError:
+            failures += 1
+            continue
+        timings.append((time.time() - began) * 1000)
+    with lock:
+        stats['timings'].extend(timings)
+        stats['failures'] += failures
+
+
+def run(name, settings, args):
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    engine = make_engine(path, settings)
+    conn = engine.connect()
+    conn.execute(SCHEMA)
+    conn.execute(INDEX)
+    conn.close()
+
+    reads = {'timings': [], 'failures': 0}
+    writes = {'timings': [], 'failures': 0}
+    lock = threading.Lock()
+    deadline = time.time() + args.seconds
+    threads = [threading.Thread(target=worker,
+                                args=(engine, READ, deadline, reads, lock,
+                                      False))
+               for _ in range(args.readers)]
+    threads += [threading.Thread(target=worker,
+                                 args=(engine, WRITE, deadline, writes, lock,
+                                       True))
+                for _ in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print name
+    for kind, stats in (('reads', reads), ('writes', writes)):
+        timings = sorted(stats['timings'])
+        print ('    {0}: {1:.0f}/s, p50 {2:.2f} ms, p95 {3:.2f} ms, '
+               '{4} locked').format(kind, len(timings) / args.seconds,
+                                    percentile(timings, 0.5),
+                                    percentile(timings, 0.95),
+                                    stats['failures'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args(argv)
+
+    run('defaults', {}, args)
+    run('tuned', {'SQLITE_JOURNAL_MODE': config.SQLITE_JOURNAL_MODE,
+                  'SQLITE_SYNCHRONOUS': config.SQLITE_SYNCHRONOUS,
+                  'SQLITE_BUSY_TIMEOUT': config.SQLITE_BUSY_TIMEOUT}, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
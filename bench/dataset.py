@@ -0,0 +1,239 @@
+"""
+Generates a synthetic dataset for the route benchmarks: organizations,
+users, memberships, term folders, files with their blobs and search terms,
+conversations and messages, and the organization stats counted from them.
+Rows go straight into the database with executemany, so even the large
+profile builds in a minute or two.
+
+    python -m bench.dataset [--profile small|large] [--seed 0] DIR
+
+Writes DIR/bench.db and DIR/uploads/. The app has to be configured to use
+them before this module is imported, as bench.routes does with
+configure().
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import config
+
+
+PROFILES = {
+    'small': dict(organizations=50, users=500, files=5000, messages=5000),
+    'large': dict(organizations=2000, users=20000, files=200000,
+                  messages=200000),
+}
+
+# Distinct file contents; files share them like re-uploaded slide decks do.
+BLOBS = 200
+BLOB_SIZE = 64 * 1024
+
+CATEGORIES = ['CS', 'MATH', 'PHYS', 'CHEM', 'ECON']
+YEARS = [2012, 2013]
+MEMBERSHIPS_PER_USER = 3
+PASSWORD = 'bench'
+
+
+def configure(directory):
+    """
+    Points the app config at a dataset directory. Has to run before gtb is
+    imported.
+    """
+    config.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory,
+                                                                 'bench.db')
+    config.UPLOAD_FOLDER = os.path.join(directory, 'uploads/')
+    config.UPLOAD_STAGING_FOLDER = os.path.join(directory, 'uploads',
+                                                '.staging/')
+    config.STORAGE_BACKEND = 'local'
+    config.CSRF_ENABLED = False
+
+
+def exists(directory):
+    return os.path.exists(os.path.join(directory, 'bench.db'))
+
+
+class Row(object):
+    """
+    Just the attributes search.file_terms reads, without a session.
+    """
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def store_blobs(rng):
+    """
+    Puts BLOBS random files in storage. Returns [(digest, size)].
+    """
+    from gtb.blobs import hash_file
+    from gtb.layout import blob_key
+    from gtb.storage import storage
+
+    blobs = []
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        for _ in range(BLOBS):
+            with open(path, 'wb') as dst:
+                dst.write(('%0*x' % (BLOB_SIZE * 2,
+                                     rng.getrandbits(BLOB_SIZE * 8)))
+                          .decode('hex'))
+            digest, size = hash_file(path)
+            storage.put(blob_key(digest), path)
+            blobs.append((digest, size))
+    finally:
+        os.remove(path)
+    return blobs
+
+
+def populate(profile, seed=0):
+    """
+    Fills the configured database, which must be empty, with a dataset of
+    the given profile.
+    """
+    from gtb import db
+    from gtb.constants import TERMS
+    from gtb.passwords import hash_password
+    from gtb.search import file_terms
+    from gtb.stats import reconcile_stats
+
+    sizes = PROFILES[profile]
+    rng = random.Random(seed)
+    start = datetime(2012, 1, 1)
+    db.create_all()
+    conn = db.engine.raw_connection()
+    cursor = conn.cursor()
+
+    cursor.executemany('INSERT INTO categories (tag) VALUES (?)',
+                       [(tag,) for tag in CATEGORIES])
+
+    users = sizes['users']
+    password = hash_password(PASSWORD)
+    cursor.executemany('INSERT INTO users (id, username, name, password, '
+                       'admin) VALUES (?, ?, ?, ?, 0)',
+                       [(i, 'user%d' % i, 'User %d' % i, password)
+                        for i in range(1, users + 1)])
+
+    orgs = sizes['organizations']
+    org_names = dict((i, 'Org %d' % i) for i in range(1, orgs + 1))
+    admins = dict((i, rng.randint(1, users)) for i in range(1, orgs + 1))
+    cursor.executemany('INSERT INTO organizations (id, name, admin_id) '
+                       'VALUES (?, ?, ?)',
+                       [(i, org_names[i], admins[i])
+                        for i in range(1, orgs + 1)])
+
+    members = dict((org, set([admin])) for org, admin in admins.items())
+    rows = [(org, admin, 1, 100) for org, admin in admins.items()]
+    for user in range(1, users + 1):
+        for org in rng.sample(range(1, orgs + 1),
+                              min(MEMBERSHIPS_PER_USER, orgs)):
+            if user in members[org]:
+                continue
+            accepted = rng.random() < 0.9
+            if accepted:
+                members[org].add(user)
+            rows.append((org, user, accepted, 1))
+    cursor.executemany('INSERT INTO organization_members (organization_id, '
+                       'user_id, accepted, rank) VALUES (?, ?, ?, ?)', rows)
+
+    folders = []
+    rows = []
+    for org in range(1, orgs + 1):
+        rows.append((len(rows) + 1, org, 1, None, None))
+        for year in YEARS:
+            for term in TERMS:
+                rows.append((len(rows) + 1, org, 0, term, year))
+                folders.append(Row(id=rows[-1][0], organization_id=org,
+                                   term=term, year=year,
+                                   name='{0} {1}'.format(term, year),
+                                   file_count=0, last_upload=start))
+    cursor.executemany('INSERT INTO folders (id, organization_id, top, term, '
+                       'year, file_count) VALUES (?, ?, ?, ?, ?, 0)', rows)
+
+    authors = dict((org, sorted(users)) for org, users in members.items())
+    blobs = store_blobs(rng)
+    refcounts = dict((digest, 0) for digest, _ in blobs)
+    files, terms = [], []
+    for i in range(1, sizes['files'] + 1):
+        folder = rng.choice(folders)
+        org = folder.organization_id
+        digest = rng.choice(blobs)[0]
+        refcounts[digest] += 1
+        f = Row(id=i, file_name='notes_%d.pdf' % i,
+                author_id=rng.choice(authors[org]),
+                organization=Row(name=org_names[org]), folder=folder,
+                course_tag=rng.choice(CATEGORIES),
+                course_id=rng.randint(100, 120),
+                upload_date=start + timedelta(
+                                minutes=rng.randint(0, 1000000)))
+        f.course_folder = '{0} {1}'.format(f.course_tag, f.course_id)
+        folder.file_count += 1
+        folder.last_upload = max(folder.last_upload, f.upload_date)
+        files.append((i, f.file_name, f.author_id, org, folder.id,
+                      f.course_tag, f.course_id, f.upload_date,
+                      f.upload_date, digest))
+        terms.extend((term, i, org, weight)
+                     for term, weight in file_terms(f).items())
+        if len(files) == 10000:
+            insert_files(cursor, files, terms)
+            files, terms = [], []
+    insert_files(cursor, files, terms)
+
+    cursor.executemany('INSERT INTO blobs (id, size, refcount, created_at) '
+                       'VALUES (?, ?, ?, ?)',
+                       [(digest, size, refcounts[digest], start)
+                        for digest, size in blobs])
+    cursor.executemany('UPDATE folders SET file_count = ?, last_upload = ? '
+                       'WHERE id = ?',
+                       [(folder.file_count, folder.last_upload, folder.id)
+                        for folder in folders])
+
+    conversations = users
+    cursor.executemany('INSERT INTO conversations (id, sender_id, '
+                       'receiver_id, subject) VALUES (?, ?, ?, ?)',
+                       [(i, rng.randint(1, users), rng.randint(1, users),
+                         'Notes for week %d' % (i % 15))
+                        for i in range(1, conversations + 1)])
+    cursor.executemany('INSERT INTO messages (conversation_id, sender_id, '
+                       'content, sent_at, read) VALUES (?, ?, ?, ?, ?)',
+                       [(rng.randint(1, conversations), rng.randint(1, users),
+                         'Message %d' % i, start + timedelta(minutes=i),
+                         rng.random() < 0.8)
+                        for i in range(sizes['messages'])])
+
+    conn.commit()
+    cursor.execute('ANALYZE')
+    conn.close()
+    reconcile_stats()
+
+
+def insert_files(cursor, files, terms):
+    cursor.executemany('INSERT INTO files (id, file_name, author_id, '
+                       'organization_id, folder_id, course_tag, course_id, '
+                       'class_date, upload_date, blob_id, status) '
+                       "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'ready')",
+                       files)
+    cursor.executemany('INSERT INTO search_terms (term, file_id, '
+                       'organization_id, weight) VALUES (?, ?, ?, ?)', terms)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory')
+    parser.add_argument('--profile', choices=sorted(PROFILES),
+                        default='small')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if exists(args.directory):
+        parser.error('{0} already holds a dataset.'.format(args.directory))
+    if not os.path.isdir(args.directory):
+        os.makedirs(args.directory)
+    configure(args.directory)
+    populate(args.profile, args.seed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+"""
+Shows the query plan and latency of the hot lookup queries with and
+without the indexes declared in gtb/models.py.
+
+    python -m bench.indexes [--files 100000] [--repeat 50]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import config
+
+_db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+config.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + _db_path
+
+from gtb import db
+from gtb.constants import TERMS
+
+
+QUERIES = [
+    ('memberships',
+     'SELECT organization_id, accepted FROM organization_members '
+     'WHERE user_id = :user_id'),
+    ('org members',
+     'SELECT * FROM organization_members '
+     'WHERE organization_id = :org_id AND accepted = 1'),
+    ('recent files',
+     'SELECT * FROM files WHERE organization_id = :org_id '
+     'ORDER BY upload_date DESC LIMIT 5'),
+    ('course files',
+     'SELECT * FROM files WHERE organization_id = :org_id '
+     "AND course_tag = 'CS' AND course_id = :course_id "
+     'ORDER BY upload_date DESC'),
+    ('folder courses',
+     'SELECT course_tag, course_id, count(*) FROM files '
+     'WHERE folder_id = :folder_id GROUP BY course_tag, course_id'),
+    ('folder lookup',
+     'SELECT * FROM folders WHERE organization_id = :org_id '
+     "AND term = 'Fall' AND year = 2013"),
+    ('conversation pair',
+     'SELECT * FROM conversations WHERE '
+     '(sender_id = :user_id AND receiver_id = :other_id) OR '
+     '(sender_id = :other_id AND receiver_id = :user_id)'),
+    ('inbox',
+     'SELECT * FROM conversations '
+     'WHERE sender_id = :user_id OR receiver_id = :user_id'),
+    ('message page',
+     'SELECT * FROM messages WHERE conversation_id = :conversation_id '
+     'ORDER BY id DESC LIMIT 50'),
+    ('search',
+     'SELECT file_id, sum(weight) AS score FROM search_terms '
+     "WHERE term IN ('cs', 'cs101') AND organization_id IN (:org_id) "
+     'GROUP BY file_id ORDER BY score DESC LIMIT 26'),
+]
+
+
+def populate(conn, files, seed=0):
+    """
+    Fills the schema with a synthetic dataset scaled by the number of files.
+    """
+    rng = random.Random(seed)
+    orgs = max(files // 500, 1)
+    users = max(files // 50, 2)
+    start = datetime(2010, 1, 1)
+
+    conn.executemany('INSERT INTO users (id, username, name) VALUES (?, ?, ?)',
+                     [(i, 'user%d' % i, 'User %d' % i)
+                      for i in range(1, users + 1)])
+    conn.executemany('INSERT INTO organizations (id, name, admin_id) '
+                     'VALUES (?, ?, ?)',
+                     [(i, 'Org %d' % i, rng.randint(1, users))
+                      for i in range(1, orgs + 1)])
+    conn.executemany('INSERT INTO organization_members '
+                     '(organization_id, user_id, accepted, rank) '
+                     'VALUES (?, ?, ?, 1)',
+                     [(rng.randint(1, orgs), u, rng.random() < 0.9)
+                      for u in range(1, users + 1) for _ in range(5)])
+
+    folders = []
+    for org in range(1, orgs + 1):
+        for year in (2012, 2013):
+            for term in TERMS:
+                folders.append((len(folders) + 1, org, term, year))
+    conn.executemany('INSERT INTO folders (id, organization_id, top, term, '
+                     'year) VALUES (?, ?, 0, ?, ?)', folders)
+
+    rows, terms = [], []
+    for i in range(1, files + 1):
+        folder = rng.choice(folders)
+        course = rng.randint(100, 140)
+        rows.append((i, 'notes_%d.pdf' % i, rng.randint(1, users), folder[1],
+                     folder[0], 'CS', course,
+                     start + timedelta(minutes=rng.randint(0, 2000000))))
+        for term in ('cs', str(course), 'cs%d' % course, 'notes', str(i)):
+            terms.append((term, i, folder[1], 1))
+    conn.executemany('INSERT INTO files (id, file_name, author_id, '
+                     'organization_id, folder_id, course_tag, course_id, '
+                     'upload_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.executemany('INSERT INTO search_terms (term, file_id, '
+                     'organization_id, weight) VALUES (?, ?, ?, ?)', terms)
+
+    conversations = users * 2
+    conn.executemany('INSERT INTO conversations (id, sender_id, receiver_id, '
+                     'subject) VALUES (?, ?, ?, ?)',
+                     [(i, rng.randint(1, users), rng.randint(1, users), 'hi')
+                      for i in range(1, conversations + 1)])
+    conn.executemany('INSERT INTO messages (conversation_id, sender_id, '
+                     'content, sent_at, read) VALUES (?, ?, ?, ?, 0)',
+                     [(rng.randint(1, conversations), rng.randint(1, users),
+                       'message', start + timedelta(minutes=i))
+                      for i in range(files // 2)])
+
+    return dict(user_id=rng.randint(1, users), other_id=rng.randint(1, users),
+                org_id=rng.randint(1, orgs), course_id=120,
+                folder_id=rng.randint(1, len(folders)),
+                conversation_id=rng.randint(1, conversations))
+
+
+def measure(conn, sql, params, repeat):
+    """
+    Returns (query plan, median latency in ms).
+    """
+    plan = '; '.join(row[-1] for row in
+                     conn.execute('EXPLAIN QUERY PLAN ' + sql, params))
+    timings = []
+    for _ in range(repeat):
+        began = time.time()
+        conn.execute(sql, params).fetchall()
+        timings.append((time.time() - began) * 1000)
+    timings.sort()
+    return plan, timings[len(timings) // 2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    engine = db.engine
+    db.metadata.create_all(engine)
+    indexes = [index for table in db.metadata.sorted_tables
+               for index in table.indexes]
+    for index in indexes:
+        index.drop(engine)
+
+    conn = sqlite3.connect(_db_path)
+    params = populate(conn, args.files)
+    conn.commit()
+    conn.execute('ANALYZE')
+
+    before = [measure(conn, sql, params, args.repeat)
+              for _, sql in QUERIES]
+
+    conn.close()
+    for index in indexes:
+        index.create(engine)
+    conn = sqlite3.connect(_db_path)
+    conn.execute('ANALYZE')
+
+    after = [measure(conn, sql, params, args.repeat)
+             for _, sql in QUERIES]
+
+    for (name, _), (plan_a, ms_a), (plan_b, ms_b) in zip(QUERIES, before,
+                                                            after):
+        print '{0}: {1:.3f} ms -> {2:.3f} ms'.format(name, ms_a, ms_b)
+        print '    before: {0}'.format(plan_a)
+        print '    after:  {0}'.format(plan_b)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
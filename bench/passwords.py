@@ -0,0 +1,131 @@
+"""
+Measures what password hashing costs: first hashes per second on one core
+for a range of PBKDF2 iterations, then a burst of logins through /login
+from concurrent clients with the configured hashing pool.
+
+    python -m bench.passwords [--iterations 1000,10000,20000,50000]
+                              [--workers 2] [--threads 16] [--seconds 10]
+
+Logins per second per core is the burst's throughput over the cores the
+hashing workers can use. Logins turned away because hashing was backed up are
+counted as busy, not as errors.
+"""
+import argparse
+import multiprocessing
+import sys
+import tempfile
+import threading
+import time
+
+import config
+
+from bench import dataset, percentile
+
+
+USERS = 100
+
+
+def hash_rate(algorithm, iterations, seconds):
+    """
+    Returns how many hashes one core makes per second.
+    """
+    from gtb.passwords import make_hash
+
+    count = 0
+    began = time.time()
+    while time.time() - began < seconds:
+        make_hash('correct horse', algorithm, iterations, 16)
+        count += 1
+    return count / (time.time() - began)
+
+
+def login_burst(app, threads, seconds):
+    """
+    Logs users in from concurrent clients for a while. Returns the sorted
+    latencies of successful logins and the counts of each outcome.
+    """
+    timings, counts = [], {'ok': 0, 'busy': 0, 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def worker(n):
+        mine = []
+        outcomes = {'ok': 0, 'busy': 0, 'errors': 0}
+        i = n
+        while time.time() < deadline:
+            i += threads
+            client = app.test_client()
+            began = time.time()
+            response = client.post('/login', data=dict(
+                                username='user%d' % (i % USERS + 1),
+                                password=dataset.PASSWORD))
+            elapsed = (time.time() - began) * 1000
+            if response.status_code == 302:
+                outcomes['ok'] += 1
+                mine.append(elapsed)
+            elif response.status_code == 503:
+                outcomes['busy'] += 1
+            else:
+                outcomes['errors'] += 1
+        with lock:
+            timings.extend(mine)
+            for outcome, count in outcomes.items():
+                counts[outcome] += count
+
+    workers = [threading.Thread(target=worker, args=(n,))
+               for n in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return sorted(timings), counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', default='1000,10000,20000,50000',
+                        help='comma separated iterations to time hashing at')
+    parser.add_argument('--algorithm', default=config.PASSWORD_HASH_ALGORITHM)
+    parser.add_argument('--workers', type=int,
+                        default=config.PASSWORD_HASH_WORKERS)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    dataset.configure(directory)
+    config.PASSWORD_HASH_WORKERS = args.workers
+    config.INSTRUMENT_ENABLED = False
+    config.JOB_WORKERS_IN_PROCESS = False
+
+    from gtb import app, db
+    from gtb.models import User
+    from gtb.passwords import start_pool
+
+    for iterations in map(int, args.iterations.split(',')):
+        rate = hash_rate(args.algorithm, iterations, min(args.seconds, 3))
+        print 'pbkdf2:{0}:{1:<7} {2:8.1f} hashes/s per core  {3:7.2f} ms'\
+              .format(args.algorithm, iterations, rate, 1000 / rate)
+
+    start_pool()
+    db.create_all()
+    for i in range(1, USERS + 1):
+        db.session.add(User('user%d' % i, 'User %d' % i, dataset.PASSWORD))
+    db.session.commit()
+    db.session.remove()
+
+    timings, counts = login_burst(app, args.threads, args.seconds)
+    per_second = counts['ok'] / args.seconds
+    cores = min(max(args.workers, 1), multiprocessing.cpu_count())
+    print ('logins: {0:.1f}/s, {1:.1f}/s per core  p50 {2:.2f} ms  '
+           'p95 {3:.2f} ms  p99 {4:.2f} ms  {5} busy  {6} errors '
+           '({7} workers, {8} threads)').format(
+                per_second, per_second / cores,
+                percentile(timings, 0.5), percentile(timings, 0.95),
+                percentile(timings, 0.99), counts['busy'], counts['errors'],
+                args.workers, args.threads)
+    return 1 if counts['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
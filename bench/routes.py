@@ -0,0 +1,351 @@
+"""
+Drives the main routes with the test client against a synthetic dataset
+(see bench.dataset): first each route on its own, then a mix of all of
+them from concurrent clients. Reports latency percentiles, throughput and
+queries per request, and compares them with the baselines stored in
+bench/baselines.json.
+
+    python -m bench.routes [--profile small|large] [--data DIR]
+                           [--requests 200] [--threads 8] [--seconds 10]
+                           [--tolerance 0.5] [--save-baseline]
+
+Exits with 1 when a route returned errors (going over a view's query
+budget is one), ran more queries in a request than any did in its
+baseline, or got slower than its baseline by more than the tolerance.
+Latency baselines only hold on the machine that saved them; query counts
+hold everywhere. --data keeps the dataset between runs, since building
+the large one takes a while.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import config
+
+from bench import dataset, percentile
+
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'baselines.json')
+
+ROUTES = ['display_org', 'search', 'inbox', 'conversation', 'get_folder',
+          'display_files', 'upload_file', 'download']
+
+# How often each route comes up in the concurrent mix.
+MIX = {'display_org': 3, 'search': 3, 'inbox': 2, 'conversation': 2,
+       'get_folder': 2, 'display_files': 3, 'upload_file': 1, 'download': 3}
+
+SEARCHES = ['cs', 'cs101', 'math110', 'notes', 'fall2013', 'spring 2012',
+            'org 1', 'phys']
+
+
+class Subjects(object):
+    """
+    Ids to build requests from, loaded from the dataset.
+    """
+    def __init__(self, conn):
+        def rows(sql):
+            return conn.execute(sql).fetchall()
+
+        self.members = {}
+        for user_id, org_id in rows('SELECT user_id, organization_id FROM '
+                                    'organization_members WHERE accepted = 1 '
+                                    'ORDER BY id'):
+            self.members.setdefault(org_id, []).append(user_id)
+        self.memberships = [(user_id, org_id) for org_id, users
+                            in sorted(self.members.items())
+                            for user_id in users]
+        self.folders = rows('SELECT id, organization_id FROM folders '
+                            'WHERE top = 0 AND file_count > 0 ORDER BY id')
+        self.courses = rows('SELECT DISTINCT f.organization_id, d.term, '
+                            'd.year, f.course_tag, f.course_id FROM files f '
+                            'JOIN folders d ON d.id = f.folder_id '
+                            'ORDER BY 1, 2, 3, 4, 5')
+        self.conversations = rows('SELECT sender_id, receiver_id '
+                                  'FROM conversations ORDER BY id')
+        self.files = [row[0] for row in rows('SELECT id FROM files '
+                                             'ORDER BY id')]
+
+
+"""
+Requests, as (user id, method, url, form data)
+"""
+
+
+def display_org(rng, s):
+    user_id, org_id = rng.choice(s.memberships)
+    return user_id, 'GET', '/organization/%d/display' % org_id, None
+
+
+def search(rng, s):
+    user_id, _ = rng.choice(s.memberships)
+    return (user_id, 'GET',
+            '/search?search=' + rng.choice(SEARCHES).replace(' ', '+'), None)
+
+
+def inbox(rng, s):
+    user_id = rng.choice(s.conversations)[rng.randint(0, 1)]
+    return user_id, 'GET', '/inbox', None
+
+
+def conversation(rng, s):
+    sender_id, receiver_id = rng.choice(s.conversations)
+    return (sender_id, 'GET',
+            '/%d/%d/conversation' % (sender_id, receiver_id), None)
+
+
+def get_folder(rng, s):
+    folder_id, org_id = rng.choice(s.folders)
+    return (rng.choice(s.members[org_id]), 'GET',
+            '/organization/%d/folder/%d' % (org_id, folder_id), None)
+
+
+def display_files(rng, s):
+    org_id, term, year, tag, course_id = rng.choice(s.courses)
+    return (rng.choice(s.members[org_id]), 'GET',
+            '/organization/%d/term/%s %d/folder/%s %d' % (
+                org_id, term, year, tag, course_id), None)
+
+
+def upload_file(rng, s):
+    user_id, org_id = rng.choice(s.memberships)
+    data = 'bench upload %d\n' % rng.getrandbits(64) + 'x' * 20000
+    return user_id, 'POST', '/organization/%d/upload' % org_id, dict(
+                course_tag=rng.choice(dataset.CATEGORIES),
+                course_id=str(rng.randint(100, 120)),
+                term='Fall', year=str(rng.choice(dataset.YEARS)),
+                date='01/02/2013', file=(io.BytesIO(data), 'upload.txt'))
+
+
+def download(rng, s):
+    return None, 'GET', '/uploads/%d' % rng.choice(s.files), None
+
+
+FACTORIES = dict((f.__name__, f) for f in (display_org, search, inbox,
+                                          conversation, get_folder,
+                                          display_files, upload_file,
+                                          download))
+
+
+class Client(object):
+    """
+    A test client that logs in as whoever the next request is for.
+    """
+    def __init__(self, app):
+        self.client = app.test_client()
+        self.user_id = None
+
+    def request(self, user_id, method, url, data):
+        if user_id != self.user_id:
+            with self.client.session_transaction() as session:
+                session.clear()
+                if user_id is not None:
+                    session['user_id'] = unicode(user_id)
+                    session['_fresh'] = True
+            self.user_id = user_id
+        began = time.time()
+        response = self.client.open(url, method=method, data=data)
+        elapsed = (time.time() - began) * 1000
+        return response.status_code, elapsed
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {'p50_ms': round(percentile(timings, 0.5), 2),
+            'p95_ms': round(percentile(timings, 0.95), 2),
+            'p99_ms': round(percentile(timings, 0.99), 2)}
+
+
+def is_error(status):
+    return status >= 400
+
+
+def run_route(app, metrics, subjects, name, requests, warmup, seed):
+    """
+    Sends requests to one route from one client. Returns its results.
+    """
+    rng = random.Random(seed)
+    client = Client(app)
+    factory = FACTORIES[name]
+    for _ in range(warmup):
+        client.request(*factory(rng, subjects))
+
+    metrics.reset()
+    timings, errors = [], 0
+    began = time.time()
+    for _ in range(requests):
+        status, elapsed = client.request(*factory(rng, subjects))
+        errors += is_error(status)
+        timings.append(elapsed)
+    seconds = time.time() - began
+
+    queries = metrics.endpoints[name].queries
+    result = summarize(timings)
+    result.update(throughput=round(requests / seconds, 1), errors=errors,
+                  queries=round(float(queries.total) / queries.count, 2),
+                  max_queries=queries.max)
+    return result
+
+
+def run_mix(app, subjects, threads, seconds, seed):
+    """
+    Sends the MIX of routes from concurrent clients for a while. Returns
+    the overall results.
+    """
+    weighted = [name for name in ROUTES for _ in range(MIX[name])]
+    timings, counts = [], {'requests': 0, 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def worker(n):
+        rng = random.Random(seed + n)
+        client = Client(app)
+        mine, errors = [], 0
+        while time.time() < deadline:
+            name = rng.choice(weighted)
+            status, elapsed = client.request(*FACTORIES[name](rng, subjects))
+            errors += is_error(status)
+            mine.append(elapsed)
+        with lock:
+            timings.extend(mine)
+            counts['requests'] += len(mine)
+            counts['errors'] += errors
+
+    workers = [threading.Thread(target=worker, args=(n,))
+               for n in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    result = summarize(timings)
+    result.update(throughput=round(counts['requests'] / seconds, 1),
+                  errors=counts['errors'])
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a line for each result that drifted past its baseline.
+    """
+    drift = []
+    for name, result in sorted(results['routes'].items()):
+        if result['errors']:
+            drift.append('{0}: {1} errors'.format(name, result['errors']))
+        base = baseline.get('routes', {}).get(name)
+        if not base:
+            continue
+        # The mean depends on how many requests found the caches warm, so
+        # a shorter run would drift; the most any request ran doesn't.
+        if result['max_queries'] > base['max_queries']:
+            drift.append('{0}: up to {1} queries per request, baseline '
+                         '{2}'.format(name, result['max_queries'],
+                                      base['max_queries']))
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            drift.append('{0}: p95 {1} ms, baseline {2} ms'.format(
+                            name, result['p95_ms'], base['p95_ms']))
+
+    mix, base = results['mix'], baseline.get('mix')
+    if mix['errors']:
+        drift.append('mix: {0} errors'.format(mix['errors']))
+    if base and mix['throughput'] < base['throughput'] * (1 - tolerance):
+        drift.append('mix: {0} requests/s, baseline {1}'.format(
+                        mix['throughput'], base['throughput']))
+    return drift
+
+
+def load_baselines():
+    if not os.path.exists(BASELINES):
+        return {}
+    with open(BASELINES) as f:
+        return json.load(f)
+
+
+def save_baseline(profile, results):
+    baselines = load_baselines()
+    baselines[profile] = results
+    with open(BASELINES, 'w') as f:
+        json.dump(baselines, f, indent=4, sort_keys=True,
+                  separators=(',', ': '))
+        f.write('\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', choices=sorted(dataset.PROFILES),
+                        default='small')
+    parser.add_argument('--data', help='dataset directory to build or reuse')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--tolerance', type=float, default=0.5)
+    parser.add_argument('--render-cache', action='store_true',
+                        help='serve pages from the render cache')
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args(argv)
+
+    directory = args.data or tempfile.mkdtemp()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    dataset.configure(directory)
+    # Measure the work behind each page, not the page cache.
+    if not args.render_cache:
+        config.RENDER_CACHE_BACKEND = None
+    config.INSTRUMENT_ENABLED = True
+    config.QUERY_BUDGET_STRICT = True
+    config.JOB_WORKERS_IN_PROCESS = False
+
+    from gtb import app, db
+    from gtb.instrument import metrics
+
+    if not dataset.exists(directory):
+        began = time.time()
+        dataset.populate(args.profile, args.seed)
+        print 'built {0} dataset in {1:.0f} s'.format(args.profile,
+                                                       time.time() - began)
+
+    conn = db.engine.connect()
+    subjects = Subjects(conn)
+    conn.close()
+
+    results = {'routes': {}}
+    for n, name in enumerate(ROUTES):
+        result = run_route(app, metrics, subjects, name, args.requests,
+                           args.warmup, args.seed + n)
+        results['routes'][name] = result
+        print ('{0:>14}: p50 {p50_ms:7.2f} ms  p95 {p95_ms:7.2f} ms  '
+               'p99 {p99_ms:7.2f} ms  {throughput:7.1f}/s  '
+               '{queries:5.1f} queries (max {max_queries})  '
+               '{errors} errors').format(name, **result)
+
+    mix = results['mix'] = run_mix(app, subjects, args.threads, args.seconds,
+                                   args.seed)
+    print ('{0:>14}: p50 {p50_ms:7.2f} ms  p95 {p95_ms:7.2f} ms  '
+           'p99 {p99_ms:7.2f} ms  {throughput:7.1f}/s  {errors} errors'
+           ' ({1} threads)').format('mix', args.threads, **mix)
+
+    if args.save_baseline:
+        save_baseline(args.profile, results)
+        print 'saved {0} baseline'.format(args.profile)
+        return 0
+
+    baseline = load_baselines().get(args.profile)
+    if not baseline:
+        print 'no {0} baseline to compare with'.format(args.profile)
+        return 0
+    drift = compare(results, baseline, args.tolerance)
+    for line in drift:
+        print 'DRIFT ' + line
+    return 1 if drift else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
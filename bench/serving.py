@@ -0,0 +1,254 @@
+"""
+Load tests the development server (run.py) against the production one
+(serve.py) over real HTTP. Each server is started on a synthetic dataset
+(see bench.dataset), then concurrent clients log in and request a mix of
+organization pages, searches and downloads for a while. Meanwhile a few
+slow clients post forms at SLOW_RATE, like uploads over a slow link.
+Reports throughput, latency percentiles and errors for the fast clients.
+
+    python -m bench.serving [--profile small|large] [--data DIR]
+                            [--clients 16] [--slow-clients 2]
+                            [--seconds 20] [--workers 4] [--threads 4]
+"""
+import argparse
+import cookielib
+import httplib
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+
+import config
+
+from bench import dataset, percentile
+
+
+SERVERS = ['dev', 'gunicorn']
+
+# How often each kind of request comes up.
+MIX = {'display_org': 3, 'search': 2, 'download': 5}
+
+SEARCHES = ['cs', 'notes', 'math110', 'fall2013', 'org 1']
+
+# Slow clients send a 64 KiB form 1 KiB at a time, about 20 KiB/s.
+SLOW_BODY = 64 * 1024
+SLOW_CHUNK = 1024
+SLOW_DELAY = 0.05
+
+
+def serve(kind, directory, port, workers, threads):
+    """
+    Runs one of the servers on a dataset until it is stopped.
+    """
+    dataset.configure(directory)
+    config.JOB_WORKERS_IN_PROCESS = False
+    if kind == 'dev':
+        # What run.py does, without debugging.
+        from gtb import app
+        app.run('127.0.0.1', port, False)
+    else:
+        import serve
+        serve.main(['-b', '127.0.0.1:{0}'.format(port), '-w', str(workers),
+                    '-t', str(threads), '--preload'])
+
+
+def start(kind, args, port):
+    """
+    Starts a server in a subprocess and waits until it accepts connections.
+    """
+    server = subprocess.Popen([sys.executable, '-m', 'bench.serving',
+                               '--serve', kind, '--data', args.data,
+                               '--port', str(port),
+                               '--workers', str(args.workers),
+                               '--threads', str(args.threads)],
+                              stdout=open(os.devnull, 'w'),
+                              stderr=subprocess.STDOUT)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return server
+        except socket.error:
+            if server.poll() is not None:
+                break
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError('{0} server did not start'.format(kind))
+
+
+def stop(server):
+    server.terminate()
+    server.wait()
+
+
+def subjects(directory):
+    """
+    Returns [(user id, organization id)] for accepted memberships, and
+    the file ids.
+    """
+    conn = sqlite3.connect(os.path.join(directory, 'bench.db'))
+    try:
+        rows = conn.execute('SELECT user_id, organization_id FROM '
+                            'organization_members WHERE accepted = 1 '
+                            'ORDER BY id').fetchall()
+        files = [row[0] for row in
+                 conn.execute('SELECT id FROM files ORDER BY id')]
+    finally:
+        conn.close()
+    return rows, files
+
+
+def slow_post(port):
+    """
+    Posts a large login form slowly. The server is busy reading it the
+    whole time, as it would be with a big upload.
+    """
+    body = urllib.urlencode({'username': 'nobody', 'password': 'nothing',
+                             'padding': 'x' * SLOW_BODY})
+    conn = httplib.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        conn.putrequest('POST', '/login')
+        conn.putheader('Content-Type', 'application/x-www-form-urlencoded')
+        conn.putheader('Content-Length', str(len(body)))
+        conn.endheaders()
+        for i in range(0, len(body), SLOW_CHUNK):
+            conn.send(body[i:i + SLOW_CHUNK])
+            time.sleep(SLOW_DELAY)
+        conn.getresponse().read()
+    except (httplib.HTTPException, socket.error):
+        pass
+    finally:
+        conn.close()
+
+
+def load(port, memberships, files, clients, slow_clients, seconds, seed):
+    """
+    Sends the MIX from concurrent logged in clients for a while, with
+    slow_clients posting slowly alongside. Returns the results.
+    """
+    base = 'http://127.0.0.1:{0}'.format(port)
+    weighted = [name for name in sorted(MIX) for _ in range(MIX[name])]
+    timings, counts = [], {'requests': 0, 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def slow_worker():
+        while time.time() < deadline:
+            slow_post(port)
+
+    def fetch(opener, url, data=None):
+        began = time.time()
+        try:
+            response = opener.open(base + url, data, 60)
+            response.read()
+            ok = response.getcode() < 400
+        except (urllib2.URLError, socket.error):
+            ok = False
+        return ok, (time.time() - began) * 1000
+
+    def worker(n):
+        rng = random.Random(seed + n)
+        user_id, org_id = rng.choice(memberships)
+        opener = urllib2.build_opener(
+                        urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
+        ok, _ = fetch(opener, '/login', urllib.urlencode(dict(
+                        username='user%d' % user_id,
+                        password=dataset.PASSWORD)))
+        mine, errors = [], 0 if ok else 1
+        while time.time() < deadline:
+            name = rng.choice(weighted)
+            if name == 'display_org':
+                url = '/organization/%d/display' % org_id
+            elif name == 'search':
+                url = '/search?' + urllib.urlencode(
+                                        {'search': rng.choice(SEARCHES)})
+            else:
+                url = '/uploads/%d' % rng.choice(files)
+            ok, elapsed = fetch(opener, url)
+            errors += not ok
+            mine.append(elapsed)
+        with lock:
+            timings.extend(mine)
+            counts['requests'] += len(mine)
+            counts['errors'] += errors
+
+    threads = [threading.Thread(target=worker, args=(n,))
+               for n in range(clients)]
+    threads += [threading.Thread(target=slow_worker)
+                for _ in range(slow_clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    timings.sort()
+    return {'throughput': round(counts['requests'] / seconds, 1),
+            'p50_ms': round(percentile(timings, 0.5), 2),
+            'p95_ms': round(percentile(timings, 0.95), 2),
+            'p99_ms': round(percentile(timings, 0.99), 2),
+            'errors': counts['errors']}
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', choices=sorted(dataset.PROFILES),
+                        default='small')
+    parser.add_argument('--data', help='dataset directory to build or reuse')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--slow-clients', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--workers', type=int, default=config.SERVE_WORKERS)
+    parser.add_argument('--threads', type=int, default=config.SERVE_THREADS)
+    parser.add_argument('--serve', choices=SERVERS, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        return serve(args.serve, args.data, args.port, args.workers,
+                     args.threads)
+
+    args.data = args.data or tempfile.mkdtemp()
+    if not dataset.exists(args.data):
+        if not os.path.isdir(args.data):
+            os.makedirs(args.data)
+        dataset.configure(args.data)
+        began = time.time()
+        dataset.populate(args.profile, args.seed)
+        print 'built {0} dataset in {1:.0f} s'.format(args.profile,
+                                                       time.time() - began)
+    memberships, files = subjects(args.data)
+
+    failed = False
+    for kind in SERVERS:
+        port = free_port()
+        server = start(kind, args, port)
+        try:
+            result = load(port, memberships, files, args.clients,
+                          args.slow_clients, args.seconds, args.seed)
+        finally:
+            stop(server)
+        failed = failed or result['errors']
+        print ('{0:>9}: {throughput:7.1f}/s  p50 {p50_ms:8.2f} ms  '
+               'p95 {p95_ms:8.2f} ms  p99 {p99_ms:8.2f} ms  {errors} errors'
+               ).format(kind, **result)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""
+Uploads the same set of files one request at a time and then as a single
+bulk upload of a zip archive, and reports the throughput of each.
+
+    python -m bench.uploads [--files 200] [--size 20000]
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+import config
+
+_dir = tempfile.mkdtemp()
+config.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(_dir, 'bench.db')
+config.UPLOAD_FOLDER = os.path.join(_dir, 'uploads/')
+config.UPLOAD_STAGING_FOLDER = os.path.join(_dir, 'uploads', '.staging/')
+config.CSRF_ENABLED = False
+
+from gtb import app, db
+from gtb.models import Category
+
+
+def make_files(count, size, salt):
+    """
+    Returns count distinct (name, bytes) pairs of about size bytes.
+    """
+    return [('notes_%d.txt' % i,
+             '%s %d\n' % (salt, i) + 'x' * size)
+            for i in range(count)]
+
+
+def timed(f):
+    began = time.time()
+    f()
+    return time.time() - began
+
+
+def upload_singly(client, files, year):
+    for name, data in files:
+        response = client.post('/organization/1/upload', data=dict(
+                        course_tag='CS', course_id='101', term='Fall',
+                        year=str(year), date='01/02/2013',
+                        file=(io.BytesIO(data), name)))
+        assert response.status_code == 302, response.status_code
+
+
+def upload_bulk(client, files, year):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as z:
+        for name, data in files:
+            z.writestr('CS_101/' + name, data)
+    archive.seek(0)
+    response = client.post('/organization/1/upload/bulk', data=dict(
+                    term='Fall', year=str(year), date='01/02/2013',
+                    files=[(archive, 'notes.zip')]))
+    assert response.status_code == 201, response.data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--size', type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    app.config['CSRF_ENABLED'] = False
+    db.create_all()
+    db.session.add(Category('CS'))
+    db.session.commit()
+
+    client = app.test_client()
+    client.post('/register', data=dict(name='bench', username='bench',
+                                       password='bench',
+                                       confirm_pass='bench'))
+    client.post('/create/organization', data=dict(name='Bench'))
+
+    # Each run gets its own bytes so neither is helped by deduplication.
+    single = timed(lambda: upload_singly(
+                        client, make_files(args.files, args.size, 'a'), 2012))
+    bulk = timed(lambda: upload_bulk(
+                        client, make_files(args.files, args.size, 'b'), 2013))
+
+    for name, seconds in (('one by one', single), ('bulk', bulk)):
+        print '{0}: {1:.2f} s, {2:.0f} files/s'.format(name, seconds,
+                                                       args.files / seconds)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+from uploads import UploadError
+
+import posixpath
+import tarfile
+import zipfile
+
+
+"""
+Unpacks the zip and tar archives given to a bulk upload. Members are read
+straight out of the archive as they are stored, without extracting the
+archive to disk first.
+"""
+
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2')
+
+
+def is_archive(file_name):
+    return file_name.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def is_hidden(path):
+    """
+    Returns if path is in a hidden or metadata folder, like the __MACOSX
+    folder zips made on a Mac carry.
+    """
+    return any(part.startswith(('.', '__MACOSX'))
+               for part in path.split('/') if part)
+
+
+def decode_name(name):
+    if isinstance(name, str):
+        return name.decode('utf-8', 'replace')
+    return name
+
+
+def zip_members(stream):
+    try:
+        archive = zipfile.ZipFile(stream)
+        infos = archive.infolist()
+    except zipfile.BadZipfile:
+        raise UploadError("Not a valid zip archive.")
+    for info in infos:
+        if not info.filename.endswith('/'):
+            yield (decode_name(info.filename), info.file_size,
+                   lambda info=info: archive.open(info))
+
+
+def tar_members(stream):
+    # 'r|*' reads the archive front to back as a stream, compressed or not.
+    # A member has to be opened before moving on to the next.
+    try:
+        archive = tarfile.open(fileobj=stream, mode='r|*')
+        for member in archive:
+            if member.isfile():
+                yield (decode_name(member.name), member.size,
+                       lambda member=member: archive.extractfile(member))
+    except tarfile.TarError:
+        raise UploadError("Not a valid tar archive.")
+
+
+def expand_uploads(files):
+    """
+    Yields (path, size, open) for each uploaded file, and for each file
+    inside an uploaded archive, skipping hidden files. size is the size an
+    archive member claims to have, or None, and open returns a stream of
+    the file. Nothing is read from a member until it is opened.
+    """
+    for f in files:
+        if not f.filename:
+            continue
+        if not is_archive(f.filename):
+            yield f.filename, None, lambda f=f: f.stream
+            continue
+
+        if f.filename.lower().endswith('.zip'):
+            members = zip_members(f.stream)
+        else:
+            members = tar_members(f.stream)
+        for path, size, open_member in members:
+            path = posixpath.normpath(path.replace('\\', '/')).lstrip('/')
+            if not is_hidden(path):
+                yield path, size, open_member
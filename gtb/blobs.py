@@ -0,0 +1,207 @@
+from gtb import db
+from models import Blob, File, OrganizationStats
+from storage import BLOCK_SIZE, storage
+
+import hashlib
+import os
+
+
+"""
+Content-addressed storage for uploaded bytes. Blobs are named by the SHA-256
+of their contents and reference counted by the File rows pointing at them,
+so the same slide deck uploaded to five terms is stored once. The bytes
+themselves go to the configured storage backend.
+"""
+
+
+def copy_hashed(src, dst, limit=None):
+    """
+    Copies src to dst in blocks, hashing along the way. With limit, stops
+    once more than limit bytes are copied, so a caller can tell src was too
+    big without reading the rest of it.
+    Returns (hex digest, number of bytes copied).
+    """
+    sha = hashlib.sha256()
+    size = 0
+    while limit is None or size <= limit:
+        block = src.read(BLOCK_SIZE if limit is None
+                         else min(BLOCK_SIZE, limit + 1 - size))
+        if not block:
+            break
+        sha.update(block)
+        dst.write(block)
+        size += len(block)
+    return sha.hexdigest(), size
+
+
+def hash_file(path):
+    """
+    Returns (hex digest, size) for a file on disk.
+    """
+    with open(path, 'rb') as src:
+        return hash_stream(src)
+
+
+def hash_stream(src):
+    """
+    Returns (hex digest, size) for everything read from src.
+    """
+    sha = hashlib.sha256()
+    size = 0
+    while True:
+        block = src.read(BLOCK_SIZE)
+        if not block:
+            break
+        sha.update(block)
+        size += len(block)
+    return sha.hexdigest(), size
+
+
+def find_blob(digest, organization_id):
+    """
+    Returns the blob with the given digest if a file in the organization
+    already uses it. Limiting this to one organization keeps a client from
+    getting at another organization's file just by knowing its hash.
+    """
+    return Blob.query.join(
+                        File, File.blob_id == Blob.id
+                    ).filter(
+                        Blob.id == digest
+                    ).filter(
+                        File.organization_id == organization_id
+                    ).first()
+
+
+def store_blobs(staged, stored):
+    """
+    Adds a reference to the blob for each staged (path, digest, size),
+    putting the bytes in storage if they haven't been seen before and
+    looking up the known digests in one query. Returns the blobs in the
+    same order. Each key put in storage is appended to stored as soon as
+    it is, so a caller can delete them if the transaction fails. The staged
+    files are left for the caller to remove.
+    """
+    counts = {}
+    for _, digest, _ in staged:
+        counts[digest] = counts.get(digest, 0) + 1
+
+    blobs = {}
+    digests = list(counts)
+    for i in range(0, len(digests), 500):
+        for blob in Blob.query.filter(Blob.id.in_(digests[i:i + 500])):
+            blob.refcount = Blob.refcount + counts[blob.id]
+            blobs[blob.id] = blob
+
+    new = []
+    for path, digest, size in staged:
+        if digest in blobs:
+            continue
+        blob = Blob(digest, size, refcount=counts[digest])
+        db.session.add(blob)
+        blobs[digest] = blob
+        new.append((path, blob))
+
+    # Insert the rows before storing their bytes. discard_stored checks for
+    # the rows under a lock, so it can't delete bytes a blob about to be
+    # committed is relying on.
+    db.session.flush()
+    for path, blob in new:
+        storage.put(blob.key, path)
+        stored.append(blob.key)
+
+    return [blobs[digest] for _, digest, _ in staged]
+
+
+def discard_stored(keys):
+    """
+    Deletes what a failed transaction put in storage, after it has been
+    rolled back. A key is kept if a blob row for it exists. The rows are
+    locked while checking, so a transaction inserting the same blob either
+    commits first and the bytes are kept, or inserts after they are deleted
+    and stores them again itself.
+    """
+    digests = dict((key.rsplit('/', 1)[-1], key) for key in keys)
+    ordered = sorted(digests)
+    try:
+        for i in range(0, len(ordered), 500):
+            batch = ordered[i:i + 500]
+            # An UPDATE locks the rows, or where they would go, until the
+            # transaction ends.
+            Blob.query.filter(
+                            Blob.id.in_(batch)
+                        ).update({'refcount': Blob.refcount + 0},
+                                 synchronize_session=False)
+            kept = set(digest for digest, in
+                       db.session.query(Blob.id).filter(Blob.id.in_(batch)))
+            for digest in batch:
+                if digest not in kept:
+                    storage.delete(digests[digest])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def reference_blob(blob):
+    """
+    Adds a reference to a blob that is already stored.
+    """
+    blob.refcount = Blob.refcount + 1
+    return blob
+
+
+def adopt_legacy_files(batch_size=100, dry_run=False):
+    """
+    Moves files uploaded before the blob store out of the old per-course
+    folders on local disk and into blobs in storage, a batch per
+    transaction. Returns (adopted, missing) where missing counts files
+    that aren't on disk.
+    """
+    adopted = missing = 0
+    last_id = 0
+    while True:
+        files = File.query.filter(
+                            File.blob_id == None
+                        ).filter(
+                            File.id > last_id
+                        ).order_by(
+                            File.id
+                        ).limit(batch_size).all()
+        if not files:
+            break
+        last_id = files[-1].id
+
+        staged = []
+        for f in files:
+            path = f.full_path + f.file_name
+            if not os.path.exists(path):
+                missing += 1
+                continue
+            digest, size = hash_file(path)
+            staged.append((f, path, digest, size))
+        if dry_run:
+            adopted += len(staged)
+            continue
+
+        stored = []
+        try:
+            blobs = store_blobs([s[1:] for s in staged], stored)
+            sizes = {}
+            for (f, _, _, size), blob in zip(staged, blobs):
+                f.blob_id = blob.id
+                sizes[f.organization_id] = \
+                    sizes.get(f.organization_id, 0) + size
+            # Files without a blob had no known size until now.
+            for organization_id, size in sizes.items():
+                OrganizationStats.add(organization_id, bytes_stored=size)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            discard_stored(stored)
+            raise
+
+        for _, path, _, _ in staged:
+            if os.path.exists(path):
+                os.remove(path)
+        adopted += len(staged)
+    return adopted, missing
@@ -0,0 +1,48 @@
+from collections import OrderedDict
+from threading import Lock
+
+import time
+
+
+class TTLCache(object):
+    """
+    A thread-safe, process-local dict whose entries expire after ttl
+    seconds. When max_size is set the least recently used entries are
+    dropped first.
+    """
+    def __init__(self, ttl, max_size=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            del self._data[key]
+            if expires < time.time():
+                return default
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + (ttl or self.ttl), value)
+            if self.max_size is not None:
+                while len(self._data) > self.max_size:
+                    self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
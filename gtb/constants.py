@@ -1,2 +1,6 @@
 TERMS = ['Fall', 'Winter', 'Spring', 'Summer']
+# The order terms come in within a year.
+TERM_ORDER = ['Winter', 'Spring', 'Summer', 'Fall']
 CURRENT_YEAR = 2014
+FILE_STATES = ['processing', 'ready', 'failed']
+JOB_STATES = ['queued', 'running', 'failed']
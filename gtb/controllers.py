@@ -1,9 +1,11 @@
 from flask import (Blueprint, request, render_template, flash, g, jsonify,
-                    redirect, send_from_directory, send_file, session, url_for)
+                    redirect, send_from_directory, send_file, session, url_for,
+                    abort)
 from flask.ext.login import (login_user, logout_user, current_user,
                                 login_required)
 from flask.ext.wtf import Form
 from sqlalchemy import desc, and_
+from sqlalchemy.orm import joinedload
 from werkzeug.utils import secure_filename
 from wtforms.ext.sqlalchemy.orm import model_form
 
@@ -12,10 +14,25 @@ from gtb import db, app, login_manager
 from forms import (Register, LoginForm, ConversationForm, CreateOrg,
                     InviteToOrg, FileForm)
 from models import (User, Message, Conversation, Organization,
-                    OrganizationMember, File, Folder)
+                    OrganizationMember, OrganizationStats, File, Folder,
+                    UploadSession)
+from archives import expand_uploads
+from blobs import find_blob
+from downloads import send_stored_file, send_zip
+from instrument import metrics, query_budget
+from pages import cached_page, render_cache
+from passwords import PasswordsBusy
+from queries import (LOAD_PROFILES, archive_files, conversation_messages,
+                    course_files, course_folders, find_conversation,
+                    inbox_conversations, mark_read, organization_members,
+                    recent_files, term_folders)
+from search import search_files
+from uploads import (UploadError, bulk_upload, commit_file, discard_session,
+                    finalize_session, link_file, receive_file, write_chunk)
 from util import (is_current_user, require_org_member, require_admin,
-                    allowed_file, get_tags, get_user, get_year_range,
-                    member_of)
+                    allowed_file, get_organization_ids, get_tags, get_user,
+                    get_year_range, member_of, page_number, parse_course,
+                    parse_date)
 
 import datetime
 from functools import wraps
@@ -32,7 +49,29 @@ def before_request():
     g.user = current_user
     if g.user is None:
         g.user = User("", "Guest", "")
-    g.login_form = LoginForm()
+
+
+@app.context_processor
+def inject_login_form():
+    """
+    Gives templates login_form(), which builds the navbar's LoginForm the
+    first time a page asks for it. Most pages are for logged in users and
+    JSON responses have no template, so neither pays for a form.
+    """
+    def login_form():
+        if getattr(g, 'login_form', None) is None:
+            g.login_form = LoginForm()
+        return g.login_form
+    return dict(login_form=login_form)
+
+
+@app.errorhandler(PasswordsBusy)
+def passwords_busy(e):
+    """
+    Turns logins and registrations away while password hashing is backed up.
+    """
+    return no_perms("Too many people are logging in right now, please try "
+                    "again in a moment."), 503
 
 
 """
@@ -84,6 +123,7 @@ def add_member(org_id):
                                             rank=form.rank.data,
                                             accepted=False)
             db.session.add(org_member)
+            OrganizationStats.add(org_id, pending_invites=1)
             db.session.commit()
 
             msg = form.username.data + " invited to the organization!"
@@ -92,36 +132,29 @@ def add_member(org_id):
 
 
 #TODO: Make sure the first message is sent with the listing title
-#TODO: Implement read and unread messages.
-#TODO: Clean up this method, it is messy as shit.
 #TODO: Rework the url to be less redundant, and more proper.
 @app.route("/<sender_id>/<receiver_id>/conversation", methods=['GET', 'POST'])
+@query_budget(9)
 @login_required
 def conversation(sender_id, receiver_id):
     """
-    Show a conversation between two users.
+    Show a conversation between two users, newest messages last. Older
+    messages are paged in with ?before=<message id>.
     """
     form = ConversationForm()
-    sender = User.query.filter_by(id=sender_id).first()
-    receiver = User.query.filter_by(id=receiver_id).first()
+    sender = User.query.get(sender_id)
+    receiver = User.query.get(receiver_id)
 
     if not sender or not receiver:
         return no_perms("One of the users provided does not exist!")
+    if g.user.id not in (sender.id, receiver.id):
+        abort(404)
+
+    conv = find_conversation(sender.id, receiver.id)
 
     if sender.id != g.user.id:
         receiver = sender
 
-    conv = Conversation.query.filter_by(
-                    sender_id=sender_id
-                ).filter_by(
-                    receiver_id=receiver_id
-                ).first() or \
-           Conversation.query.filter_by(
-                    sender_id=receiver_id
-                ).filter_by(
-                    receiver_id=sender_id
-                ).first()
-
     if request.method == "POST":
         if not conv:
             if form.content.data and form.subject.data:
@@ -129,30 +162,29 @@ def conversation(sender_id, receiver_id):
                                     receiver_id=receiver_id,
                                     subject=form.subject.data)
                 db.session.add(conv)
-                db.session.commit()
-
-                msg = Message(conversation_id=conv.id,
-                              sender=g.user.id,
-                              content=form.content.data)
-                db.session.add(msg)
-                db.session.commit()
+                db.session.flush()
             else:
                 return no_perms("You didn't input a subject or message!")
-
-        elif form.content.data:
-            msg = Message(conversation_id=conv.id,
-                          sender=g.user.id,
-                          content=form.content.data)
-            db.session.add(msg)
-            db.session.commit()
-        else:
+        elif not form.content.data:
             return no_perms("You didn't input a message!")
+
+        msg = Message(conversation_id=conv.id,
+                      sender=g.user.id,
+                      content=form.content.data)
+        db.session.add(msg)
+
+    messages, has_older = [], False
     if conv:
-        for msg in conv.messages:
-            msg.sent_at = msg.sent_at.strftime("%b %d, %Y")
-        conv.messages = Message.query.filter_by(conversation_id=conv.id).all()
+        # Committing expires everything loaded, so load the messages after.
+        # This also commits a message just sent.
+        mark_read(conv.id, g.user.id)
+        db.session.commit()
+        messages, has_older = conversation_messages(conv.id,
+                                before=request.args.get('before', type=int),
+                                limit=app.config['CONVERSATION_PAGE_SIZE'])
 
     return render_template("conversation.html", form=form, conversation=conv,
+                            messages=messages, has_older=has_older,
                             receiver=receiver)
 
 
@@ -178,6 +210,7 @@ def create_org():
                                         accepted=True,
                                         rank=100)
         db.session.add(org_member)
+        db.session.add(OrganizationStats(new_org.id, member_count=1))
         db.session.commit()
         msg = "Organization created successfully!"
         # Should redirect to add members page, but that's not created yet :(
@@ -188,88 +221,158 @@ def create_org():
 
 # Make sure a user has permissions to view the org
 @app.route("/organization/<int:org_id>/display")
+@query_budget(6)
 @require_org_member
+@cached_page('org:{org_id}')
 def display_org(org_id):
     """
-    Display home page for an organization.
+    Display home page for an organization. Members are paged with ?page=.
     """
     # for now lets just display members and files.
-    organization = Organization.query.filter_by(id=org_id).first()
-    members = OrganizationMember.query.filter_by(
-                                        organization_id=org_id,
-                                        accepted=True
-                                    ).all()
-    files = File.query.filter_by(
-                            organization_id=org_id
-                        ).order_by(
-                            File.upload_date.desc()
-                ).all()
-    num_files = 5 if len(files) > 5 else len(files)
-
-    # Grab 5 most recent files
-    recent_files = files[:num_files]
-
-    # Get all folders
-    folders = Folder.query.filter_by(
-                            organization_id=org_id,
-                            top=False
-                        ).all()
-    print folders
+    organization = Organization.query.options(
+                                        joinedload('stats')
+                                    ).get(org_id)
+    page = page_number()
+    members, has_next = organization_members(org_id, page=page,
+                                per_page=app.config['MEMBERS_PER_PAGE'])
 
     return render_template("display_org.html", organization=organization,
-                            members=members, recent_files=recent_files,
-                            folders=folders)
+                            members=members, page=page, has_next=has_next,
+                            stats=organization.stats,
+                            recent_files=recent_files(org_id),
+                            folders=term_folders(org_id))
 
 
 @app.route('/organization/<int:organization_id>' +
             '/term/<path:term>/folder/<path:folder>')
+@query_budget(2)
+@cached_page('org:{organization_id}')
 def display_files(organization_id, term="", folder=""):
     """
-    Returns all files for a given folder.
+    Returns the files for a course folder (e.g. "CS 101") in a term
+    (e.g. "Fall 2013"). Takes ?sort=recent|name|class_date and ?page=.
     """
-    print folder
-    course_tag = folder.split(" ")[0]
-    course_id = folder.split(" ")[1]
-
-    files = File.query.filter_by(
-                        organization_id=organization_id,
-                        course_tag=course_tag,
-                        course_id=course_id
-                    ).order_by(
-                            File.upload_date.desc()
-                    ).all()
+    term_name, year, course_tag, course_id = parse_course(term, folder)
 
-    files = filter(lambda x: x.folder.name == term, files)
+    sort = request.args.get('sort', 'recent')
+    page = page_number()
+    files, has_next = course_files(organization_id, term_name, year,
+                                   course_tag, course_id, sort=sort,
+                                   page=page,
+                                   per_page=app.config['FILES_PER_PAGE'])
 
-    return render_template("files.html", folder=folder,
-                            files=files, organization_id=organization_id)
+    return render_template("files.html", folder=folder, term=term,
+                            files=files, organization_id=organization_id,
+                            sort=sort, page=page, has_next=has_next)
 
 
 @app.route('/uploads/<int:file_id>', methods=['GET', 'POST'])
+@query_budget(2)
 def download(file_id):
     """
-    Sends an uploaded file from the 'uploads' directory.
+    Sends an uploaded file, honoring conditional and range requests.
     """
-    f = File.query.filter_by(id=file_id).first()
-    return send_from_directory(f.full_path, f.file_name, as_attachment=True)
+    f = File.query.options(*LOAD_PROFILES['download']).get_or_404(file_id)
+    return send_stored_file(f)
+
+
+@app.route('/organization/<int:org_id>/folder/<int:folder_id>/download')
+@login_required
+@require_org_member
+def download_folder(org_id, folder_id):
+    """
+    Sends every file in a term folder as one zip, a folder per course.
+    """
+    folder = Folder.query.filter_by(
+                            id=folder_id,
+                            organization_id=org_id
+                        ).first_or_404()
+    return send_zip(archive_files(folder.id),
+                    secure_filename(folder.name) + '.zip')
+
+
+@app.route('/organization/<int:org_id>/download' +
+            '/term/<path:term>/folder/<path:folder>')
+@login_required
+@require_org_member
+def download_course(org_id, term, folder):
+    """
+    Sends the files for a course folder (e.g. "CS 101") in a term
+    (e.g. "Fall 2013") as one zip.
+    """
+    term_name, year, course_tag, course_id = parse_course(term, folder)
+
+    term_folder = Folder.query.filter_by(
+                            organization_id=org_id,
+                            term=term_name,
+                            year=year
+                        ).first_or_404()
+    return send_zip(archive_files(term_folder.id, course_tag, course_id),
+                    secure_filename(term + ' ' + folder) + '.zip',
+                    course_folders=False)
+
+
+@app.route('/uploads/<int:file_id>/status')
+@login_required
+def file_status(file_id):
+    """
+    Returns how far a file's post-upload jobs have got.
+    """
+    f = File.query.get_or_404(file_id)
+    if not member_of(f.organization_id):
+        abort(404)
+    return jsonify({'file_id': f.id,
+                    'status': f.status,
+                    'jobs': [{'kind': job.kind,
+                              'state': job.state,
+                              'attempts': job.attempts}
+                             for job in f.jobs]})
 
 
 @app.route('/organization/<int:organization_id>/folder/<int:folder_id>')
+@query_budget(4)
+@cached_page('org:{organization_id}')
 def get_folder(organization_id, folder_id):
     """
-    Displays a folder and it's contents.
+    Displays a folder and it's contents. Takes ?sort=name|files|recent
+    and ?page=.
     """
-    organization = Organization.query.filter_by(id=organization_id).first()
-    folder = Folder.query.filter_by(id=folder_id).first()
-    course_folders_dup = [file.course_folder for file in folder.files]
-    print course_folders_dup
-    # remove duplicates with set, then convert back to list.
-    course_folders_uniq = list(set(course_folders_dup))
+    organization = Organization.query.get_or_404(organization_id)
+    folder = Folder.query.filter_by(
+                            id=folder_id,
+                            organization_id=organization_id
+                        ).first_or_404()
+
+    sort = request.args.get('sort', 'name')
+    page = page_number()
+    folders, has_next = course_folders(folder.id, sort=sort, page=page,
+                            per_page=app.config['COURSE_FOLDERS_PER_PAGE'])
 
-    print course_folders_uniq
     return render_template('folder.html', folder=folder,
-                            course_folders=course_folders_uniq,
-                            organization=organization)
+                            course_folders=folders,
+                            organization=organization,
+                            sort=sort, page=page, has_next=has_next)
+
+
+@app.route("/admin/cache")
+@login_required
+@require_admin
+def cache_stats():
+    """
+    Shows how well the render cache is doing in this process.
+    """
+    return jsonify(render_cache.stats())
+
+
+@app.route("/admin/metrics")
+@login_required
+@require_admin
+def request_metrics():
+    """
+    Shows request latency, query counts and repeated statements per
+    endpoint in this process.
+    """
+    return jsonify(metrics.stats())
 
 
 @app.route("/")
@@ -287,8 +390,6 @@ def handle_invites():
     Show the organizations you have pending invites for.
     """
     if request.method == "POST":
-        print "wtf"
-        print "hi"
         org_id = request.form.get('accept') or request.form.get('deny')
         if not org_id:
             return no_perms("That invite doesn't exist!")
@@ -309,36 +410,20 @@ def handle_invites():
     return render_template("my_invites.html", orgs=orgs)
 
 
-#TODO: Sort most recent conversations to first
-#TODO: Add in unread messages
 @app.route("/inbox", methods=['GET'])
+@query_budget(3)
 @login_required
 def inbox():
     """
     Shows an inbox of messages for the currently logged in user.
     """
-    unsorted_conversations = Conversation.query.filter_by(
-                                            sender_id=g.user.id
-                                        ).all() + \
-                                Conversation.query.filter_by(
-                                            receiver_id=g.user.id
-                                        ).all()
-
-    if unsorted_conversations:
-        conversations = []
-        for conv in unsorted_conversations:
-            if conv.receiver_id == g.user.id:
-                conv.otherperson = User.query.filter_by(
-                                            id=conv.sender_id
-                                        ).first()
-            else:
-                conv.otherperson = User.query.filter_by(
-                                            id=conv.receiver_id
-                                        ).first()
-            conversations.append(conv)
+    page = page_number()
+    conversations, has_next = inbox_conversations(g.user.id, page=page,
+                                    per_page=app.config['INBOX_PER_PAGE'])
 
-        conversations.sort(key=lambda r: r.messages[len(r.messages)-1].sent_at)
-        return render_template('inbox.html', conversations=conversations)
+    if conversations or page > 1:
+        return render_template('inbox.html', conversations=conversations,
+                                page=page, has_next=has_next)
 
     return no_perms("You do not have any conversations!")
 
@@ -349,7 +434,12 @@ def my_orgs():
     """
     Show the organizations you are a part of, and an administrator for.
     """
-    orgs = current_user.organizations()
+    org_ids = get_organization_ids(current_user.id)
+    orgs = org_ids and Organization.query.options(
+                                        joinedload('stats')
+                                    ).filter(
+                                        Organization.id.in_(org_ids)
+                                    ).all()
     admin_orgs = filter(lambda org: org.admin_id == current_user.id, orgs)
     member_orgs = filter(lambda org: org.admin_id != current_user.id, orgs)
 
@@ -377,6 +467,8 @@ def login():
 
             user = User.query.filter_by(username=form.username.data).first()
             if user and user.check_password(form.password.data):
+                # Keeps the new hash if the password was rehashed.
+                db.session.commit()
                 login_user(user)
                 flash("Logged in successfully.")
                 return redirect("/")
@@ -401,8 +493,6 @@ def remove_user(organization_id):
     Removes a user from an organization
     """
     user_id = int(request.form.get('user_id'))
-    print user_id
-    print request.form
     om = OrganizationMember.query.filter_by(
                                     organization_id=organization_id,
                                     user_id=user_id
@@ -414,6 +504,10 @@ def remove_user(organization_id):
                                         user_id=user_id
                                     ).first()
         db.session.delete(user)
+        if user.accepted:
+            OrganizationStats.add(organization_id, member_count=-1)
+        else:
+            OrganizationStats.add(organization_id, pending_invites=-1)
         db.session.commit()
 
     return jsonify({'message': 'Success!'})
@@ -451,125 +545,215 @@ def register():
 
 
 @app.route("/search", methods=['GET', 'POST'])
+@query_budget(3)
+@login_required
 def search():
     """
-    Search the db for files.
-    * Should be search for files from orgs we are a part of? Idk.
-    Will search:
-        - Organization (All files for organization)
-        - Term
-        - Class
+    Search the files of the organizations we are a member of.
+    Matches on:
+        - Organization name
+        - Term (e.g. "Fall 2013")
+        - Class (e.g. "CS 101")
         - File name
     """
-
-    if not request.method == "POST" or not request.form.get('search'):
+    term = request.values.get('search')
+    if not term:
         return no_perms("You need to provide a term to search for!")
 
-    my_orgs = OrganizationMember.query.filter_by(
-                                        user_id=current_user.id,
-                                        accepted=True
-                                    ).all()
-    my_org_ids = [org.organization_id for org in my_orgs]
-
-    term = request.form.get('search')
-    results = []
-
-    # Check organizations
-    organizations = Organization.query.filter(
-                            Organization.name.like("%" + term + "%")
-                        ).all()
-
-    if organizations:
-        org_ids = [org.id for org in organizations]
-        for org_id in org_ids:
-            if org_id in my_org_ids:
-                files = File.query.filter_by(organization_id=org_id).all()
-                results += files
-
-    temp_term = term.replace(" ", "").lower()
-
-    # Check terms
-    folders = Folder.query.filter(Folder.organization_id.in_(my_org_ids)).all()
-    for folder in folders:
-        if folder.name.replace(" ", "").lower() == temp_term:
-            results += folder.files
-
-    # Check files classes matches
-    all_files =  File.query.filter_by(organization_id=2).all()
-    relevant_files = File.query.filter(File.organization_id.in_(my_org_ids)).all()
-    for file in relevant_files:
-        if file.course_folder.replace(" ", "").lower() == temp_term:
-            results += [file]
-
-    # Check file names similar
-    temp_term = term.split(' ') or term
-    for t in temp_term:
-        relevant_files = File.query.filter(
-                                    and_(File.organization_id.in_(my_org_ids),
-                                         File.file_name.like("%" + t + "%"))
-                                ).all()
-        results += relevant_files if relevant_files else []
-
-    results = list(set(results))
-
-    if results:
-        return render_template('search.html', results=results, term=term)
+    page = page_number(request.values)
+
+    my_org_ids = get_organization_ids(current_user.id)
+
+    results, has_next = search_files(term, my_org_ids, page=page,
+                        per_page=app.config['SEARCH_RESULTS_PER_PAGE'])
+
+    if results or page > 1:
+        return render_template('search.html', results=results, term=term,
+                                page=page, has_next=has_next)
     else:
         return no_perms("No results found...")
 
 
-@login_required
 @app.route('/organization/<int:org_id>/upload', methods=['GET', 'POST'])
+@login_required
+@require_org_member
 def upload_file(org_id):
     """
     Allows an organization member to upload a file for an organization.
     """
     form = FileForm()
+    message = ""
 
     organization = Organization.query.filter_by(id=org_id).first()
 
     if request.method == "POST":
-        file = request.files['file']
+        file = request.files.get('file')
+        date = parse_date(request.form.get('date'))
 
         if (file and allowed_file(file.filename) and form.course_id.data and
-            request.form.get('date')):
+            date):
+            staging_path, digest, size = receive_file(file.stream)
+            commit_file(staging_path, digest, size,
+                        organization_id=org_id,
+                        author_id=g.user.id,
+                        file_name=secure_filename(file.filename),
+                        term=form.term.data,
+                        year=form.year.data,
+                        course_tag=form.course_tag.data,
+                        course_id=form.course_id.data,
+                        class_date=date)
+            return redirect(url_for('display_org', org_id=org_id))
+        message = "You need to provide a file, course number and date!"
 
-            exists = Folder.query.filter_by(
-                                    organization_id=org_id,
-                                    term=form.term.data,
-                                    year=form.year.data
-                                ).first()
-            folder_id = 0
-            if exists:
-                folder_id = exists.id
-            else:
-                folder = Folder(organization_id=organization.id,
-                                top=False,
-                                term=form.term.data,
-                                year=form.year.data)
-                db.session.add(folder)
-                db.session.commit()
-                folder_id = folder.id
-
-            # Parse date and create a datetime object
-            date_inp = map(int, request.form['date'].split('/'))
-            month = date_inp[0]
-            day = date_inp[1]
-            year = date_inp[2]
-            date = datetime.datetime(year, month, day, 0, 0, 0)
-
-            filename = secure_filename(file.filename)
-            f = File(file_name=filename, author_id=g.user.id,
-                     organization_id=org_id, folder_id=folder_id,
-                     course_tag=form.course_tag.data,
-                     course_id=form.course_id.data,
-                     class_date=date)
-
-            db.session.add(f)
-            db.session.commit()
+    return render_template('upload.html', form=form,
+                            organization=organization, message=message)
 
-            file.save(f.full_path + f.file_name)
-            return redirect(url_for('display_org', org_id=org_id))
-    else:
-        return render_template('upload.html', form=form,
-                                organization=organization)
+
+@app.route('/organization/<int:org_id>/upload/bulk', methods=['POST'])
+@login_required
+@require_org_member
+def upload_files(org_id):
+    """
+    Uploads any number of 'files' at once into one term folder, unpacking
+    zip and tar archives among them. Files in a course folder of an archive
+    ("CS_101/notes.pdf") go to that course, the rest to the form's course.
+    Every file is added in one transaction; returns the outcome of each.
+    """
+    term = request.form.get('term')
+    year = request.form.get('year', type=int)
+    date = parse_date(request.form.get('date'))
+    if term not in TERMS or not year or not date:
+        return jsonify({'message': 'A term, year and date are required!'}), 400
+
+    try:
+        results = bulk_upload(expand_uploads(request.files.getlist('files')),
+                              organization_id=org_id,
+                              author_id=g.user.id,
+                              term=term,
+                              year=year,
+                              course_tag=request.form.get('course_tag'),
+                              course_id=request.form.get('course_id'),
+                              class_date=date)
+    except UploadError as e:
+        return jsonify({'message': e.message}), e.status
+
+    created = len([r for r in results if r['status'] == 'created'])
+    return jsonify({'message': 'Success!' if created else 'Nothing uploaded!',
+                    'created': created,
+                    'skipped': len(results) - created,
+                    'files': results}), 201 if created else 400
+
+
+def upload_session_json(upload):
+    """
+    Returns what a client needs to know to resume an upload session.
+    """
+    return jsonify({'id': upload.id,
+                    'offset': upload.offset,
+                    'size': upload.size,
+                    'chunk_size': app.config['UPLOAD_CHUNK_SIZE']})
+
+
+@app.route('/organization/<int:org_id>/upload/sessions', methods=['POST'])
+@login_required
+@require_org_member
+def create_upload_session(org_id):
+    """
+    Starts a chunked upload. Takes the same fields as the upload form, plus
+    the file's name and total size in bytes. If the client sends the file's
+    sha256 and the organization already has those bytes, the File is
+    created right away and no chunks need to be sent.
+    """
+    file_name = secure_filename(request.form.get('file_name', ''))
+    date = parse_date(request.form.get('date'))
+    term = request.form.get('term')
+    try:
+        size = int(request.form.get('size'))
+        year = int(request.form.get('year'))
+    except (TypeError, ValueError):
+        size = year = None
+
+    if (not allowed_file(file_name) or size is None or size < 0 or
+        term not in TERMS or not request.form.get('course_id') or not date):
+        return jsonify({'message': 'Invalid upload parameters!'}), 400
+
+    sha256 = request.form.get('sha256', '').lower() or None
+    blob = sha256 and find_blob(sha256, org_id)
+    if blob and blob.size == size:
+        f = link_file(blob,
+                      organization_id=org_id,
+                      author_id=g.user.id,
+                      file_name=file_name,
+                      term=term,
+                      year=year,
+                      course_tag=request.form.get('course_tag'),
+                      course_id=request.form.get('course_id'),
+                      class_date=date)
+        return jsonify({'message': 'Success!', 'file_id': f.id,
+                        'status': f.status}), 201
+
+    upload = UploadSession(author_id=g.user.id,
+                           organization_id=org_id,
+                           file_name=file_name,
+                           size=size,
+                           term=term,
+                           year=year,
+                           course_tag=request.form.get('course_tag'),
+                           course_id=request.form.get('course_id'),
+                           class_date=date,
+                           sha256=sha256)
+    db.session.add(upload)
+    db.session.commit()
+
+    return upload_session_json(upload), 201
+
+
+@app.route('/upload/sessions/<session_id>', methods=['GET', 'PUT', 'DELETE'])
+@login_required
+def upload_session(session_id):
+    """
+    GET reports how many bytes have been received, so a client can resume.
+    PUT writes the request body as the chunk starting at ?offset=.
+    DELETE abandons the upload.
+    """
+    upload = UploadSession.query.filter_by(id=session_id,
+                                           author_id=g.user.id).first()
+    if not upload:
+        return jsonify({'message': 'Upload session not found!'}), 404
+
+    if request.method == "PUT":
+        offset = request.args.get('offset', type=int)
+        if offset is None or offset < 0:
+            return jsonify({'message': 'A chunk needs an offset!'}), 400
+        try:
+            write_chunk(upload, offset, request.stream,
+                        request.content_length)
+        except UploadError as e:
+            response = upload_session_json(upload)
+            response.status_code = e.status
+            return response
+    elif request.method == "DELETE":
+        discard_session(upload)
+        return jsonify({'message': 'Success!'})
+
+    return upload_session_json(upload)
+
+
+@app.route('/upload/sessions/<session_id>/finalize', methods=['POST'])
+@login_required
+def finalize_upload_session(session_id):
+    """
+    Turns a fully received upload session into a File.
+    """
+    upload = UploadSession.query.filter_by(id=session_id,
+                                           author_id=g.user.id).first()
+    if not upload:
+        return jsonify({'message': 'Upload session not found!'}), 404
+
+    try:
+        f = finalize_session(upload)
+    except UploadError as e:
+        return jsonify({'message': e.message}), e.status
+
+    return jsonify({'message': 'Success!', 'file_id': f.id,
+                    'status': f.status})
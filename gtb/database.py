@@ -0,0 +1,101 @@
+from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.exc import DisconnectionError
+
+import threading
+
+
+"""
+Engine setup. SQLite gets WAL journaling, a busy timeout and a relaxed
+synchronous mode on every new connection, so readers no longer wait on a
+writer and writers queue up instead of failing with "database is locked".
+Server databases get a sized connection pool that pings connections as
+they are checked out.
+"""
+
+
+POOL_OPTIONS = ('pool_size', 'pool_timeout', 'pool_recycle', 'max_overflow')
+
+
+class Database(SQLAlchemy):
+    """
+    SQLAlchemy that configures each engine it creates from the app config.
+    """
+    def __init__(self, app=None, **kwargs):
+        self._configured = set()
+        self._configured_lock = threading.Lock()
+        SQLAlchemy.__init__(self, app, **kwargs)
+
+    def apply_driver_hacks(self, app, info, options):
+        # A file database is opened per checkout (NullPool); pool sizes only
+        # make sense for server databases.
+        if info.drivername == 'sqlite':
+            for option in POOL_OPTIONS:
+                options.pop(option, None)
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+
+    def get_engine(self, app, bind=None):
+        engine = SQLAlchemy.get_engine(self, app, bind)
+        if engine not in self._configured:
+            with self._configured_lock:
+                if engine not in self._configured:
+                    configure_engine(engine, app.config)
+                    self._configured.add(engine)
+        return engine
+
+
+def configure_engine(engine, config):
+    """
+    Adds the connection listeners for an engine, and the query counting
+    ones when INSTRUMENT_ENABLED. Every engine gets them, including those
+    made again when SQLALCHEMY_DATABASE_URI changes.
+    """
+    if engine.dialect.name == 'sqlite':
+        pragmas = sqlite_pragmas(config)
+        if pragmas:
+            event.listen(engine, 'connect', set_pragmas(pragmas))
+    elif config.get('SQLALCHEMY_POOL_PRE_PING'):
+        event.listen(engine, 'checkout', ping_connection)
+    if config.get('INSTRUMENT_ENABLED'):
+        # instrument imports the app, which imports this module.
+        from instrument import watch_engine
+        watch_engine(engine)
+
+
+def sqlite_pragmas(config):
+    """
+    Returns the PRAGMA statements to run on each new SQLite connection.
+    Settings left as None keep SQLite's default.
+    """
+    pragmas = []
+    if config.get('SQLITE_JOURNAL_MODE'):
+        pragmas.append('PRAGMA journal_mode=' + config['SQLITE_JOURNAL_MODE'])
+    if config.get('SQLITE_BUSY_TIMEOUT') is not None:
+        pragmas.append('PRAGMA busy_timeout={0:d}'.format(
+                                            config['SQLITE_BUSY_TIMEOUT']))
+    if config.get('SQLITE_SYNCHRONOUS'):
+        pragmas.append('PRAGMA synchronous=' + config['SQLITE_SYNCHRONOUS'])
+    return pragmas
+
+
+def set_pragmas(pragmas):
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+    return connect
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """
+    Checks a pooled connection is still alive before handing it out. A
+    DisconnectionError makes the pool throw it away and connect again.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        raise DisconnectionError()
+    finally:
+        cursor.close()
@@ -0,0 +1,163 @@
+from flask import Response, abort, request
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
+
+from datetime import datetime
+from gtb import app
+from storage import BLOCK_SIZE, storage
+from zipstream import ZipStream
+
+import calendar
+import mimetypes
+import os
+import posixpath
+
+
+"""
+Serves stored files with strong ETags, conditional GET and single byte
+ranges, and whole folders as zip archives streamed as they are written.
+When DOWNLOAD_SENDFILE_HEADER is set and storage is on local disk the body
+is left to the front end server (X-Sendfile for Apache/lighttpd,
+X-Accel-Redirect for nginx), so workers only ever send headers.
+"""
+
+
+def file_etag(f, stat):
+    """
+    Returns a strong ETag for a File. Blobs are named by their content hash,
+    older files fall back to their size and modification time.
+    """
+    if f.blob_id:
+        return f.blob_id
+    return '{0:x}-{1:x}'.format(int(stat.mtime), stat.size)
+
+
+def requested_range(etag, last_modified, size):
+    """
+    Returns the (start, stop) the client asked for, None for the whole
+    file, or False if the range can't be satisfied.
+    """
+    rng = request.range
+    if rng is None or len(rng.ranges) != 1:
+        return None
+
+    # A stale If-Range means the client's partial copy is outdated.
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if (if_range.date is not None and
+        last_modified.replace(microsecond=0) > if_range.date):
+        return None
+
+    return rng.range_for_length(size) or False
+
+
+def sendfile_location(path):
+    """
+    Returns the value for the configured sendfile header. nginx wants an
+    internal URI, the others want the path on disk.
+    """
+    if app.config['DOWNLOAD_SENDFILE_HEADER'] == 'X-Accel-Redirect':
+        relative = os.path.relpath(path, app.config['UPLOAD_FOLDER'])
+        return app.config['DOWNLOAD_ACCEL_PREFIX'] + relative
+    return path
+
+
+def send_stored_file(f):
+    """
+    Returns a response for downloading File f.
+    """
+    key = f.storage_key
+    stat = storage.stat(key)
+    if stat is None:
+        abort(404)
+    etag = file_etag(f, stat)
+    last_modified = datetime.utcfromtimestamp(stat.mtime)
+
+    response = Response(mimetype=mimetypes.guess_type(f.file_name)[0] or
+                                 'application/octet-stream',
+                        direct_passthrough=True)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.max_age = app.config['DOWNLOAD_CACHE_MAX_AGE']
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers.add('Content-Disposition', 'attachment',
+                         filename=f.file_name.encode('utf-8'))
+
+    if not is_resource_modified(request.environ, etag=etag,
+                                last_modified=last_modified):
+        response.status_code = 304
+        return response
+
+    path = storage.local_path(key)
+    if path and app.config['DOWNLOAD_SENDFILE_HEADER']:
+        response.headers[app.config['DOWNLOAD_SENDFILE_HEADER']] = \
+            sendfile_location(path)
+        return response
+
+    rng = requested_range(etag, last_modified, stat.size)
+    if rng is False:
+        response.status_code = 416
+        response.headers['Content-Range'] = 'bytes */{0}'.format(stat.size)
+        return response
+
+    if rng:
+        start, stop = rng
+        response.status_code = 206
+        response.headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+                                                start, stop - 1, stat.size)
+        response.content_length = stop - start
+        response.response = storage.stream(key, start, stop)
+    elif path:
+        response.content_length = stat.size
+        response.response = wrap_file(request.environ, open(path, 'rb'),
+                                      BLOCK_SIZE)
+    else:
+        response.content_length = stat.size
+        response.response = storage.stream(key)
+    return response
+
+
+def send_zip(files, archive_name, course_folders=True):
+    """
+    Returns a response streaming files as a zip archive. With
+    course_folders each file goes in a folder for its course ("CS_101/").
+    Files from before the blob store that are missing are left out.
+    """
+    archive = ZipStream()
+    names = set()
+    for f in files:
+        key = f.storage_key
+        if f.blob_id:
+            size = f.blob.size
+        else:
+            stat = storage.stat(key)
+            if stat is None:
+                continue
+            size = stat.size
+
+        name = f.file_name
+        if course_folders and f.course_tag and f.course_id:
+            name = posixpath.join(u'{0}_{1}'.format(f.course_tag,
+                                                    f.course_id), name)
+        # Keep files with the same name from overwriting each other.
+        base, ext = posixpath.splitext(name)
+        n = 1
+        while name in names:
+            n += 1
+            name = u'{0} ({1}){2}'.format(base, n, ext)
+        names.add(name)
+
+        archive.add(lambda key=key: storage.open(key), name, size,
+                    calendar.timegm((f.upload_date or datetime.utcnow())
+                                    .utctimetuple()))
+
+    response = Response(archive, mimetype='application/zip',
+                        direct_passthrough=True)
+    response.content_length = archive.content_length()
+    response.cache_control.private = True
+    response.cache_control.no_store = True
+    response.headers.add('Content-Disposition', 'attachment',
+                         filename=archive_name.encode('utf-8'))
+    return response
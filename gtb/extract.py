@@ -0,0 +1,93 @@
+import re
+import subprocess
+import threading
+import zipfile
+
+
+"""
+Pulls the plain text out of uploaded documents so their contents can be
+searched. Each extractor returns unicode text, or None when the format
+isn't supported here.
+"""
+
+
+class ExtractTimeout(Exception):
+    """
+    Raised when an external extractor ran past its deadline and was killed.
+    """
+    pass
+
+
+XML_DOCUMENTS = {
+    'docx': 'word/document.xml',
+    'odt': 'content.xml',
+}
+
+
+def extension(file_name):
+    return file_name.rsplit('.', 1)[-1].lower() if '.' in file_name else ''
+
+
+def extract_plain(path, max_bytes):
+    with open(path, 'rb') as src:
+        return src.read(max_bytes).decode('utf-8', 'ignore')
+
+
+def extract_xml(path, member, max_bytes):
+    """
+    Returns the text of an XML part of a zipped document (docx, odt), with
+    the markup dropped.
+    """
+    with zipfile.ZipFile(path) as archive:
+        xml = archive.open(member).read(max_bytes)
+    return re.sub(r'<[^>]+>', ' ', xml.decode('utf-8', 'ignore'))
+
+
+def extract_pdf(path, max_bytes, timeout):
+    """
+    Uses poppler's pdftotext when it is installed. It is killed if it runs
+    longer than timeout seconds, so a pathological PDF can't hold a worker.
+    """
+    try:
+        process = subprocess.Popen(['pdftotext', '-q', '-enc', 'UTF-8',
+                                    path, '-'], stdout=subprocess.PIPE)
+    except OSError:
+        return None
+
+    killed = []
+
+    def kill():
+        killed.append(True)
+        try:
+            process.kill()
+        except OSError:
+            # It exited on its own in the meantime.
+            pass
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        text = process.stdout.read(max_bytes)
+        process.stdout.close()
+        process.wait()
+    finally:
+        timer.cancel()
+    if killed:
+        raise ExtractTimeout("pdftotext ran longer than {0} seconds.".format(
+                                timeout))
+    return text.decode('utf-8', 'ignore')
+
+
+def extract_text(path, file_name, max_bytes, timeout):
+    """
+    Returns at most max_bytes worth of text from the file at path, going by
+    the extension of file_name. External extractors get timeout seconds.
+    """
+    ext = extension(file_name)
+    if ext == 'txt':
+        return extract_plain(path, max_bytes)
+    elif ext in XML_DOCUMENTS:
+        return extract_xml(path, XML_DOCUMENTS[ext], max_bytes)
+    elif ext == 'pdf':
+        return extract_pdf(path, max_bytes, timeout)
+    return None
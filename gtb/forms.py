@@ -2,7 +2,7 @@ from flask.ext.wtf import (Form, SelectField, TextField, TextAreaField,
                             PasswordField, BooleanField, Required)
 from constants import TERMS
 from models import User
-from util import get_tags, get_year_range
+from util import get_tag_choices, get_year_choices
 
 
 class Register(Form):
@@ -28,15 +28,17 @@ class InviteToOrg(Form):
     rank = TextField('rank', [Required()])
 
 class FileForm(Form):
-    all_tags = get_tags()
-    tags = zip(all_tags, all_tags)
-
-    course_tag = SelectField('course_tag', choices=tags)
+    course_tag = SelectField('course_tag')
     course_id = TextField('course_id')
 
     terms = zip(TERMS, TERMS)
     term = SelectField('term', choices=terms)
 
-    all_years = map(str, get_year_range()[::-1])
-    years = zip(all_years, all_years)
-    year = SelectField('year', choices=years)
+    year = SelectField('year')
+
+    def __init__(self, *args, **kwargs):
+        Form.__init__(self, *args, **kwargs)
+        # Set per instance so importing the form doesn't hit the database
+        # and new categories show up without a restart.
+        self.course_tag.choices = get_tag_choices()
+        self.year.choices = get_year_choices()
@@ -0,0 +1,302 @@
+from flask import request
+from sqlalchemy import event
+
+from gtb import app
+
+import bisect
+import cProfile
+import os
+import threading
+import time
+
+
+"""
+Records where request time goes, per endpoint: latency, how many queries
+each request ran and how long they took, and statements a single request
+ran over and over (an N+1 pattern, usually a lazy load in a loop). Counts
+are kept per process and shown at /admin/metrics.
+
+With INSTRUMENT_PROFILE on, adding ?_profile=1 to a URL also runs that
+request under cProfile and writes the stats to INSTRUMENT_PROFILE_DIR,
+for reading with pstats or snakeviz.
+
+Views can declare the most queries a request may run with @query_budget.
+Going over is logged, or with QUERY_BUDGET_STRICT on (as in tests and the
+benchmarks) raises QueryBudgetExceeded, so a page that starts loading a
+relationship per row fails instead of slowly getting slower.
+"""
+
+
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+# Statements longer than this are cut short in the repeated statements list.
+STATEMENT_LENGTH = 300
+
+
+class Histogram(object):
+    """
+    Counts observations into buckets by upper bound, plus one bucket for
+    everything over the last bound.
+    """
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """
+        Returns the upper bound of the bucket the p-th percentile falls in,
+        or the largest value seen for the last bucket.
+        """
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def stats(self):
+        labels = ['<={0}'.format(b) for b in self.bounds] + \
+                 ['>{0}'.format(self.bounds[-1])]
+        return {'count': self.count,
+                'mean': float(self.total) / self.count if self.count else 0.0,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'buckets': dict((label, count) for label, count
+                                in zip(labels, self.counts) if count)}
+
+
+class EndpointMetrics(object):
+    """
+    Latency, query and status counts for one endpoint.
+    """
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.query_ms = 0.0
+        self.statuses = {}
+        # statement -> [requests that repeated it, most repeats in one]
+        self.repeated = {}
+
+    def stats(self):
+        return {'latency_ms': self.latency.stats(),
+                'queries': self.queries.stats(),
+                'query_ms': round(self.query_ms, 1),
+                'statuses': self.statuses,
+                'repeated_statements': [
+                    {'statement': statement, 'requests': requests,
+                     'max_repeats': repeats}
+                    for statement, (requests, repeats)
+                    in sorted(self.repeated.items(),
+                              key=lambda item: -item[1][0])]}
+
+
+class Metrics(object):
+    """
+    Per endpoint metrics for this process.
+    """
+    def __init__(self, repeat_threshold, max_statements):
+        self.repeat_threshold = repeat_threshold
+        self.max_statements = max_statements
+        self.endpoints = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, status, elapsed_ms, trace):
+        """
+        Adds a finished request. Returns the statements it repeated at
+        least repeat_threshold times, with their counts.
+        """
+        repeated = [(statement, count) for statement, count
+                    in trace.statements.items()
+                    if count >= self.repeat_threshold]
+        with self._lock:
+            metrics = self.endpoints.get(endpoint)
+            if metrics is None:
+                metrics = self.endpoints[endpoint] = EndpointMetrics()
+            metrics.latency.observe(elapsed_ms)
+            metrics.queries.observe(trace.queries)
+            metrics.query_ms += trace.query_ms
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            for statement, count in repeated:
+                seen = metrics.repeated.get(statement)
+                if seen is not None:
+                    seen[0] += 1
+                    seen[1] = max(seen[1], count)
+                elif len(metrics.repeated) < self.max_statements:
+                    metrics.repeated[statement] = [1, count]
+        return repeated
+
+    def stats(self):
+        with self._lock:
+            return {'since': self.started,
+                    'endpoints': dict((endpoint, m.stats()) for endpoint, m
+                                      in self.endpoints.items())}
+
+    def reset(self):
+        with self._lock:
+            self.endpoints = {}
+            self.started = time.time()
+
+
+class QueryBudgetExceeded(AssertionError):
+    """
+    A request ran more queries than its view's budget.
+    """
+    pass
+
+
+class Trace(object):
+    """
+    What one request has done so far.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.queries = 0
+        self.query_ms = 0.0
+        self.statements = {}
+        self.query_started = []
+        self.profile = None
+
+
+metrics = Metrics(app.config['INSTRUMENT_REPEAT_THRESHOLD'],
+                  app.config['INSTRUMENT_MAX_STATEMENTS'])
+
+_current = threading.local()
+
+# endpoint -> the most queries one request to it may run
+budgets = {}
+
+
+def current_trace():
+    """
+    Returns the Trace of the request this thread is handling, or None.
+    """
+    return getattr(_current, 'trace', None)
+
+
+def query_budget(queries):
+    """
+    Decorator to set the most queries a request to a view may run, loading
+    the user included. Goes under @app.route, e.g. @query_budget(6).
+    """
+    def decorator(f):
+        budgets[f.__name__] = queries
+        return f
+    return decorator
+
+
+"""
+Query events
+"""
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    trace = current_trace()
+    if trace is not None:
+        trace.query_started.append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    trace = current_trace()
+    if trace is None or not trace.query_started:
+        return
+    trace.query_ms += (time.time() - trace.query_started.pop()) * 1000
+    trace.queries += 1
+    statement = statement[:STATEMENT_LENGTH]
+    trace.statements[statement] = trace.statements.get(statement, 0) + 1
+
+
+def watch_engine(engine):
+    """
+    Counts and times the queries an engine runs for requests.
+    """
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+"""
+Request hooks
+"""
+
+
+def start_request():
+    trace = _current.trace = Trace()
+    if (app.config['INSTRUMENT_PROFILE'] and
+        request.args.get('_profile') == '1'):
+        trace.profile = cProfile.Profile()
+        trace.profile.enable()
+
+
+def finish_request(response):
+    trace = current_trace()
+    if trace is None:
+        return response
+    elapsed_ms = (time.time() - trace.started) * 1000
+
+    if trace.profile is not None:
+        trace.profile.disable()
+        response.headers['X-Profile'] = dump_profile(trace.profile)
+        trace.profile = None
+
+    endpoint = request.endpoint or 'unmatched'
+    repeated = metrics.record(endpoint, response.status_code, elapsed_ms,
+                              trace)
+    for statement, count in repeated:
+        app.logger.warning('%s ran the same statement %d times: %s',
+                           request.path, count, statement)
+
+    budget = budgets.get(endpoint)
+    if budget is not None and trace.queries > budget:
+        message = '{0} ran {1} queries, over its budget of {2}'.format(
+                        request.path, trace.queries, budget)
+        if app.config['QUERY_BUDGET_STRICT']:
+            raise QueryBudgetExceeded(message)
+        app.logger.warning(message)
+    return response
+
+
+def end_request(exception=None):
+    trace = current_trace()
+    if trace is not None and trace.profile is not None:
+        trace.profile.disable()
+    _current.trace = None
+
+
+def dump_profile(profile):
+    """
+    Writes a request's profile to INSTRUMENT_PROFILE_DIR. Returns the
+    file name.
+    """
+    directory = app.config['INSTRUMENT_PROFILE_DIR']
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    name = '{0}-{1:.0f}.prof'.format(request.endpoint or 'unmatched',
+                                     time.time() * 1000)
+    profile.dump_stats(os.path.join(directory, name))
+    return name
+
+
+# The engine's query listeners are added by database.configure_engine.
+if app.config['INSTRUMENT_ENABLED']:
+    # Registered before the controllers' hooks, so the time and queries
+    # spent loading the user are counted too.
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(end_request)
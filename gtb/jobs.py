@@ -0,0 +1,279 @@
+from datetime import datetime, timedelta
+
+from contextlib import closing
+from sqlalchemy import exists
+
+from blobs import hash_stream
+from extract import ExtractTimeout, extract_text
+from gtb import app, db
+from models import File, Job
+from pages import bump_after_commit
+from search import content_words, index_file
+from storage import storage
+
+import threading
+import traceback
+
+
+"""
+A job queue kept in the jobs table, so it needs nothing but the database.
+Uploads queue their jobs in the same transaction as the File row, and
+worker threads claim them with a conditional UPDATE, so a job runs once
+even with workers in several processes. A job that raises is retried with
+exponential backoff until it runs out of attempts, or fails straight away
+if it raises JobFailed.
+"""
+
+
+HANDLERS = {}
+
+
+class JobError(Exception):
+    """
+    Raised by a handler when a job can't be done.
+    """
+    pass
+
+
+class JobFailed(JobError):
+    """
+    Raised by a handler when trying the job again won't help.
+    """
+    pass
+
+
+def handler(kind):
+    """
+    Decorator to register the function that runs jobs of a kind. It gets
+    the claimed Job and runs inside its transaction.
+    """
+    def decorator(f):
+        HANDLERS[kind] = f
+        return f
+    return decorator
+
+
+def enqueue_file_jobs(f):
+    """
+    Queues the UPLOAD_JOBS for a new file and marks it as processing.
+    The caller commits.
+    """
+    kinds = app.config['UPLOAD_JOBS']
+    if kinds:
+        f.status = 'processing'
+        f.jobs.extend(Job(kind) for kind in kinds)
+
+
+def enqueue_all(kind):
+    """
+    Queues a job of kind for every file. Returns how many were queued.
+    """
+    count = 0
+    for (file_id,) in db.session.query(File.id):
+        db.session.add(Job(kind, file_id))
+        count += 1
+    db.session.commit()
+    return count
+
+
+def claim_job():
+    """
+    Claims the next job that is due and commits the claim. Returns None
+    when there's nothing to do.
+    """
+    now = datetime.utcnow()
+    due = db.session.query(
+                        Job.id
+                    ).filter(
+                        Job.state == 'queued'
+                    ).filter(
+                        Job.run_at <= now
+                    ).order_by(
+                        Job.run_at
+                    ).limit(
+                        app.config['JOB_CLAIM_BATCH']
+                    ).all()
+
+    for (job_id,) in due:
+        # Another worker may have taken it since the select.
+        claimed = Job.query.filter(
+                                Job.id == job_id
+                            ).filter(
+                                Job.state == 'queued'
+                            ).update({'state': 'running',
+                                      'locked_at': now,
+                                      'attempts': Job.attempts + 1},
+                                     synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return Job.query.get(job_id)
+    return None
+
+
+def run_job(job):
+    """
+    Runs a claimed job. Finished jobs are deleted; failed ones go back in
+    the queue or, out of attempts or on JobFailed, are marked failed along
+    with their file.
+    """
+    job_id, file_id = job.id, job.file_id
+    try:
+        if job.kind not in HANDLERS:
+            raise JobError("No handler for {0} jobs.".format(job.kind))
+        HANDLERS[job.kind](job)
+        db.session.delete(job)
+        db.session.flush()
+        if file_id is not None:
+            finish_file(file_id)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        fail_job(job_id, traceback.format_exc(),
+                 retry=not isinstance(e, JobFailed))
+
+
+def finish_file(file_id):
+    """
+    Marks a file ready once no jobs are left for it. Done as one UPDATE
+    so two workers finishing a file's last jobs at once can't both miss it.
+    """
+    f = File.query.get(file_id)
+    updated = File.query.filter(
+                            File.id == file_id
+                        ).filter(
+                            File.status == 'processing'
+                        ).filter(
+                            ~exists([Job.id], Job.file_id == file_id)
+                        ).update({'status': 'ready'},
+                                 synchronize_session=False)
+    if updated:
+        bump_after_commit('org:{0}'.format(f.organization_id))
+
+
+def fail_job(job_id, error, retry=True):
+    """
+    Records a failed attempt, scheduling the next one after a delay that
+    doubles with each attempt unless retry is False.
+    """
+    job = Job.query.get(job_id)
+    if job is None:
+        return
+    job.error = error
+    job.locked_at = None
+    if not retry or job.attempts >= app.config['JOB_MAX_ATTEMPTS']:
+        job.state = 'failed'
+        if job.file is not None:
+            job.file.status = 'failed'
+    else:
+        job.state = 'queued'
+        job.run_at = datetime.utcnow() + timedelta(
+            seconds=app.config['JOB_RETRY_DELAY'] * 2 ** (job.attempts - 1))
+    db.session.commit()
+
+
+def requeue_stale():
+    """
+    Puts jobs back in the queue whose worker died while running them.
+    Returns how many there were.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config['JOB_TIMEOUT'])
+    count = Job.query.filter(
+                        Job.state == 'running'
+                    ).filter(
+                        Job.locked_at < cutoff
+                    ).update({'state': 'queued', 'locked_at': None},
+                             synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+"""
+Workers
+"""
+
+
+class Worker(threading.Thread):
+    """
+    Runs jobs until stop is set. In burst mode it also stops once no job
+    is due.
+    """
+    def __init__(self, stop, burst=False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stop = stop
+        self.burst = burst
+
+    def run(self):
+        poll = app.config['JOB_POLL_INTERVAL']
+        with app.app_context():
+            while not self.stop.is_set():
+                try:
+                    job = claim_job()
+                    if job is not None:
+                        run_job(job)
+                    elif self.burst:
+                        break
+                    else:
+                        requeue_stale()
+                        self.stop.wait(poll)
+                except Exception:
+                    app.logger.exception("Job worker error")
+                    db.session.rollback()
+                    self.stop.wait(poll)
+                finally:
+                    db.session.remove()
+
+
+def start_workers(count, burst=False):
+    """
+    Starts count worker threads. Returns (stop event, threads).
+    """
+    stop = threading.Event()
+    workers = [Worker(stop, burst) for _ in range(count)]
+    for worker in workers:
+        worker.start()
+    return stop, workers
+
+
+@app.before_first_request
+def start_in_process_workers():
+    if app.config['JOB_WORKERS_IN_PROCESS']:
+        start_workers(app.config['JOB_WORKERS'])
+
+
+"""
+Handlers
+"""
+
+
+@handler('checksum')
+def verify_checksum(job):
+    """
+    Re-hashes a file's stored bytes and fails if they no longer match the
+    digest they were stored under.
+    """
+    f = job.file
+    if f.blob_id is None:
+        return
+    with closing(storage.open(f.blob.key)) as src:
+        digest, size = hash_stream(src)
+    if digest != f.blob_id or size != f.blob.size:
+        raise JobError("Stored bytes of {0} don't match their digest.".format(
+                            f.blob_id))
+
+
+@handler('extract_text')
+def extract_file_text(job):
+    """
+    Adds the words of a file's text to the search index.
+    """
+    f = job.file
+    with storage.local_file(f.storage_key) as path:
+        try:
+            text = extract_text(path, f.file_name,
+                                app.config['EXTRACT_MAX_BYTES'],
+                                app.config['EXTRACT_TIMEOUT'])
+        except ExtractTimeout as e:
+            raise JobFailed(str(e))
+    if text:
+        index_file(f, content_words(text))
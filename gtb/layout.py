@@ -0,0 +1,125 @@
+from gtb import app
+
+import errno
+import os
+import threading
+
+
+"""
+Where things live under UPLOAD_FOLDER, or in the bucket when storage isn't
+local (see storage.py). Every key and path the app uses is worked out here,
+and directories are created on first use only: each process remembers the
+ones it has made, so the upload path doesn't stat the filesystem over and
+over.
+
+    blobs/ab/cd/abcd...        file contents, by SHA-256 (see blobs.py)
+    .staging/<uuid>            uploads that haven't been stored yet
+    <org>/<term>_<year>/<tag>_<course>/<name>
+                               files uploaded before the blob store; moved
+                               into blobs/ by 'manage.py migrate-layout'
+"""
+
+
+# Blobs are spread over 256 * 256 directories by the first two bytes of
+# their digest, so a million files is about 15 per directory.
+SHARD_DEPTH = 2
+SHARD_WIDTH = 2
+
+_made = set()
+_made_lock = threading.Lock()
+
+
+def ensure_dir(path):
+    """
+    Creates a directory and its parents unless this process already has.
+    """
+    if path in _made:
+        return
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    with _made_lock:
+        _made.add(path)
+
+
+def forget_dir(path):
+    """
+    Makes the next ensure_dir(path) check again, for when something else
+    removed the directory.
+    """
+    with _made_lock:
+        _made.discard(path)
+
+
+def blob_dir():
+    return os.path.join(app.config['UPLOAD_FOLDER'], 'blobs')
+
+
+def blob_key(digest):
+    """
+    Returns the storage key of the blob with the given hex digest.
+    """
+    shards = [digest[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH]
+              for i in range(SHARD_DEPTH)]
+    return '/'.join(['blobs'] + shards + [digest])
+
+
+def local_path(key):
+    """
+    Returns where a storage key lives under UPLOAD_FOLDER on local disk.
+    """
+    return os.path.join(app.config['UPLOAD_FOLDER'], key)
+
+
+def staging_path(name):
+    """
+    Returns the path of a staging file. Writers call ensure_staging_dir()
+    first.
+    """
+    return os.path.join(app.config['UPLOAD_STAGING_FOLDER'], name)
+
+
+def ensure_staging_dir():
+    ensure_dir(app.config['UPLOAD_STAGING_FOLDER'])
+
+
+def legacy_folder_key(organization_id, term=None, year=None):
+    """
+    Returns the key of an organization's term folder in the old layout, or
+    of its top folder without a term.
+    """
+    key = '{0}/'.format(organization_id)
+    if term and year:
+        key += '{0}_{1}/'.format(term, year)
+    return key
+
+
+def legacy_course_key(folder_key, course_tag, course_id):
+    """
+    Returns the key of a course within a legacy term folder.
+    """
+    return folder_key + '{0}_{1}/'.format(course_tag, course_id)
+
+
+def remove_empty_dirs(root, keep=()):
+    """
+    Removes the empty directories under root, deepest first, leaving root
+    and everything under the directories in keep. Returns how many were
+    removed.
+    """
+    root = root.rstrip('/')
+    keep = [k.rstrip('/') for k in keep]
+    removed = 0
+    for path, dirs, files in os.walk(root, topdown=False):
+        if path == root or files:
+            continue
+        if any(path == k or path.startswith(k + '/') for k in keep):
+            continue
+        try:
+            os.rmdir(path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
@@ -1,10 +1,13 @@
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask.ext.sqlalchemy import SQLAlchemy
-from constants import TERMS
+from constants import FILE_STATES, JOB_STATES, TERMS
 from datetime import datetime
 from gtb import app, db
+from layout import (blob_key, legacy_course_key, legacy_folder_key,
+                    local_path, staging_path)
+from passwords import hash_password, needs_rehash, verify_password
 
 import os
+import uuid
 
 
 """ Organizations will each have their own defined roles too... eventually.
@@ -14,6 +17,31 @@ import os
 """
 
 
+class Blob(db.Model):
+    """
+    Represents stored file contents, addressed by their SHA-256 digest.
+    Files with identical bytes share one blob.
+    """
+    __tablename__ = 'blobs'
+
+    id = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger)
+    refcount = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __init__(self, digest, size, refcount=0):
+        self.id = digest
+        self.size = size
+        self.refcount = refcount
+
+    @property
+    def key(self):
+        """
+        Returns the blob's storage key, sharded by the digest's first bytes.
+        """
+        return blob_key(self.id)
+
+
 class Category(db.Model):
     """
     Represents a course category
@@ -32,6 +60,12 @@ class Conversation(db.Model):
     Represents a conversation between users.
     """
     __tablename__  = 'conversations'
+    __table_args__ = (
+        db.Index('ix_conversations_sender_receiver',
+                 'sender_id', 'receiver_id'),
+        db.Index('ix_conversations_receiver_sender',
+                 'receiver_id', 'sender_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer)
@@ -50,6 +84,15 @@ class File(db.Model):
     Represents a file for an organization
     """
     __tablename__ = "files"
+    __table_args__ = (
+        db.Index('ix_files_organization_upload_date',
+                 'organization_id', 'upload_date'),
+        db.Index('ix_files_organization_course',
+                 'organization_id', 'course_tag', 'course_id', 'upload_date'),
+        db.Index('ix_files_folder_course',
+                 'folder_id', 'course_tag', 'course_id'),
+        db.Index('ix_files_blob_id', 'blob_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     file_name = db.Column(db.String(255))
@@ -60,14 +103,20 @@ class File(db.Model):
     course_id = db.Column(db.Integer)
     class_date = db.Column(db.DateTime)
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
+    blob_id = db.Column(db.String(64), db.ForeignKey('blobs.id'))
+    # 'processing' while post-upload jobs are pending, then 'ready', or
+    # 'failed' once a job has used up its attempts.
+    status = db.Column(db.Enum(*FILE_STATES), default='ready')
 
     organization = db.relationship('Organization', backref='files')
     author = db.relationship('User', backref='uploads')
     folder = db.relationship('Folder', backref='files')
+    blob = db.relationship('Blob')
 
     # File does not need to be a course document.
     def __init__(self, file_name, author_id, organization_id, folder_id,
-                    course_tag=None, course_id=None, class_date=None):
+                    course_tag=None, course_id=None, class_date=None,
+                    blob_id=None):
         self.file_name = file_name
         self.author_id = author_id
         self.organization_id = organization_id
@@ -75,25 +124,35 @@ class File(db.Model):
         self.course_tag = course_tag
         self.course_id = course_id
         self.class_date = class_date
+        self.blob_id = blob_id
 
-        if course_tag and course_id:
-            folder = db.session.query(Folder).filter_by(id=folder_id).first()
-            path = (folder.path + self.course_tag + '_' +
-                    self.course_id + '/')
+    @property
+    def storage_key(self):
+        """
+        Returns the storage key of the file's bytes. Files uploaded before
+        the blob store keep their original course folder.
+        """
+        if self.blob_id:
+            return blob_key(self.blob_id)
+        return self.folder_key + self.file_name
 
-            if not os.path.exists(path):
-                os.makedirs(path)
+    @property
+    def folder_key(self):
+        """
+        Returns the key of the file's course folder in the old layout.
+        """
+        if self.course_tag and self.course_id:
+            return legacy_course_key(self.folder.key, self.course_tag,
+                                     self.course_id)
+        else:
+            return self.folder.key
 
     @property
     def full_path(self):
         """
         Returns the path to the file
         """
-        if self.course_tag and self.course_id:
-            return (self.folder.path + self.course_tag + '_' +
-                    str(self.course_id) + '/')
-        else:
-            return self.folder.path
+        return local_path(self.folder_key)
 
     @property
     def course_folder(self):
@@ -108,12 +167,19 @@ class Folder(db.Model):
     Represents a Folder
     """
     __tablename__ = 'folders'
+    __table_args__ = (
+        db.Index('ix_folders_organization_term_year',
+                 'organization_id', 'term', 'year'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id'))
     top = db.Column(db.Boolean)
     term = db.Column(db.Enum(*TERMS))
     year = db.Column(db.Integer)
+    # Kept up to date on upload so listings don't have to count files.
+    file_count = db.Column(db.Integer, default=0)
+    last_upload = db.Column(db.DateTime)
 
     organization = db.relationship('Organization', backref='folders')
 
@@ -123,13 +189,7 @@ class Folder(db.Model):
         self.top = top
         self.term = term
         self.year = year
-
-        path = app.config['UPLOAD_FOLDER']
-        if not top:
-            path += term + '_' + year + '/'
-
-        if not os.path.exists(path):
-            os.makedirs(path)
+        self.file_count = 0
 
     @property
     def name(self):
@@ -138,15 +198,48 @@ class Folder(db.Model):
         else:
             return str(self.organization_id)
 
+    @property
+    def key(self):
+        """
+        Returns the folder's key in the pre-blob layout.
+        """
+        return legacy_folder_key(self.organization_id, self.term, self.year)
+
     @property
     def path(self):
-        if self.term and self.year:
-            return (app.config['UPLOAD_FOLDER'] +
-                   '{0}/{1}_{2}/'.format(str(self.organization_id),
-                                          self.term,
-                                          str(self.year)))
-        else:
-            return '{0}/'.format(str(self.organization_id))
+        return local_path(self.key)
+
+
+class Job(db.Model):
+    """
+    Represents a unit of background work on a file, e.g. extracting its
+    text. Finished jobs are deleted; failed ones are kept with their error.
+    """
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_state_run_at', 'state', 'run_at'),
+        db.Index('ix_jobs_file_id', 'file_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32))
+    file_id = db.Column(db.Integer, db.ForeignKey('files.id'))
+    state = db.Column(db.Enum(*JOB_STATES), default='queued')
+    attempts = db.Column(db.Integer, default=0)
+    run_at = db.Column(db.DateTime, default=datetime.utcnow)
+    locked_at = db.Column(db.DateTime)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    file = db.relationship('File', backref=db.backref('jobs',
+                                            cascade='all, delete-orphan'))
+
+    def __init__(self, kind, file_id=None, run_at=None):
+        self.kind = kind
+        self.file_id = file_id
+        self.state = 'queued'
+        self.attempts = 0
+        self.run_at = run_at or datetime.utcnow()
 
 
 class Message(db.Model):
@@ -154,6 +247,9 @@ class Message(db.Model):
     Represents a message as part of a conversation.
     """
     __tablename__ = 'messages'
+    __table_args__ = (
+        db.Index('ix_messages_conversation_id', 'conversation_id', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'))
@@ -184,6 +280,7 @@ class Organization(db.Model):
     admin_id = db.Column(db.Integer, db.ForeignKey('users.id'))
 
     admin = db.relationship('User')
+    stats = db.relationship('OrganizationStats', uselist=False)
 
     def __init__(self, name, admin_id):
         self.name = name
@@ -195,6 +292,12 @@ class OrganizationMember(db.Model):
     Represents a member of an organization
     """
     __tablename__ = "organization_members"
+    __table_args__ = (
+        db.Index('ix_organization_members_user',
+                 'user_id', 'accepted', 'organization_id'),
+        db.Index('ix_organization_members_organization',
+                 'organization_id', 'accepted', 'user_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id'))
@@ -212,14 +315,194 @@ class OrganizationMember(db.Model):
         self.rank = rank
 
     def accept(self):
-        self.accepted = True
+        was_accepted, self.accepted = self.accepted, True
+        if not was_accepted:
+            OrganizationStats.add(self.organization_id, member_count=1,
+                                  pending_invites=-1)
         db.session.commit()
 
     def deny(self):
-        self.accepted = False
+        was_accepted, self.accepted = self.accepted, False
+        if was_accepted:
+            OrganizationStats.add(self.organization_id, member_count=-1,
+                                  pending_invites=1)
         db.session.commit()
 
 
+class OrganizationStats(db.Model):
+    """
+    Running totals for an organization, kept up to date in the same
+    transactions that change them so pages don't have to count rows.
+    'manage.py reconcile-stats' rebuilds them from scratch.
+    """
+    __tablename__ = 'organization_stats'
+
+    organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id'),
+                                primary_key=True)
+    member_count = db.Column(db.Integer, default=0)
+    pending_invites = db.Column(db.Integer, default=0)
+    file_count = db.Column(db.Integer, default=0)
+    # Each file counts its full size, even when its blob is shared.
+    bytes_stored = db.Column(db.BigInteger, default=0)
+    last_upload = db.Column(db.DateTime)
+
+    FIELDS = ('member_count', 'pending_invites', 'file_count', 'bytes_stored',
+              'last_upload')
+
+    def __init__(self, organization_id, member_count=0, pending_invites=0,
+                 file_count=0, bytes_stored=0, last_upload=None):
+        self.organization_id = organization_id
+        self.member_count = member_count
+        self.pending_invites = pending_invites
+        self.file_count = file_count
+        self.bytes_stored = bytes_stored
+        self.last_upload = last_upload
+
+    @classmethod
+    def add(cls, organization_id, last_upload=None, **counts):
+        """
+        Adds to an organization's counts, e.g. add(1, file_count=2), in
+        one UPDATE so concurrent transactions don't lose each other's
+        changes. Call it after making the change it counts: an
+        organization without a row yet is counted from scratch instead.
+        """
+        values = dict((name, getattr(cls, name) + n)
+                      for name, n in counts.items() if n)
+        if last_upload is not None:
+            values['last_upload'] = last_upload
+        if not values:
+            return
+        updated = cls.query.filter_by(
+                                organization_id=organization_id
+                            ).update(values, synchronize_session=False)
+        if not updated:
+            counted = cls.count(organization_id)[organization_id]
+            db.session.add(cls(organization_id, **dict(zip(cls.FIELDS,
+                                                           counted))))
+
+    @classmethod
+    def count(cls, organization_id=None):
+        """
+        Returns a dict of organization id -> tuple of FIELDS, counted from
+        the members and files as they are in this transaction, for one
+        organization or, by default, every organization.
+        """
+        members = db.session.query(
+                                OrganizationMember.organization_id,
+                                OrganizationMember.accepted,
+                                db.func.count(OrganizationMember.id))
+        files = db.session.query(
+                                File.organization_id,
+                                db.func.count(File.id),
+                                db.func.sum(Blob.size),
+                                db.func.max(File.upload_date)
+                            ).outerjoin(
+                                (Blob, Blob.id == File.blob_id))
+        if organization_id is None:
+            org_ids = [org_id for org_id, in db.session.query(Organization.id)]
+        else:
+            org_ids = [organization_id]
+            members = members.filter(
+                OrganizationMember.organization_id == organization_id)
+            files = files.filter(File.organization_id == organization_id)
+
+        counts = dict((org_id, [0, 0, 0, 0, None]) for org_id in org_ids)
+        for org_id, accepted, n in members.group_by(
+                                OrganizationMember.organization_id,
+                                OrganizationMember.accepted):
+            if org_id in counts and accepted is not None:
+                counts[org_id][0 if accepted else 1] += n
+        for org_id, n, size, last_upload in files.group_by(
+                                File.organization_id):
+            if org_id in counts:
+                counts[org_id][2:] = [n, size or 0, last_upload]
+
+        return dict((org_id, tuple(c)) for org_id, c in counts.items())
+
+class SearchTerm(db.Model):
+    """
+    Represents one entry in the search index: a normalized word that
+    appears in a file's name, course, term or organization.
+    """
+    __tablename__ = 'search_terms'
+    __table_args__ = (
+        db.Index('ix_search_terms_term_organization',
+                 'term', 'organization_id', 'file_id', 'weight'),
+        db.Index('ix_search_terms_file_id', 'file_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    term = db.Column(db.String(64))
+    file_id = db.Column(db.Integer, db.ForeignKey('files.id'))
+    organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id'))
+    weight = db.Column(db.Integer)
+
+    file = db.relationship('File', backref=db.backref('search_terms',
+                                            cascade='all, delete-orphan'))
+
+    def __init__(self, term, organization_id, weight=1):
+        self.term = term
+        self.organization_id = organization_id
+        self.weight = weight
+
+
+class UploadSession(db.Model):
+    """
+    Represents a chunked upload that has not been finalized yet.
+    The bytes received so far live in a staging file named after the id.
+    """
+    __tablename__ = 'upload_sessions'
+
+    id = db.Column(db.String(32), primary_key=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    organization_id = db.Column(db.Integer, db.ForeignKey('organizations.id'))
+    file_name = db.Column(db.String(255))
+    size = db.Column(db.BigInteger)
+    term = db.Column(db.Enum(*TERMS))
+    year = db.Column(db.Integer)
+    course_tag = db.Column(db.String(6))
+    course_id = db.Column(db.Integer)
+    class_date = db.Column(db.DateTime)
+    sha256 = db.Column(db.String(64))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __init__(self, author_id, organization_id, file_name, size, term,
+                    year, course_tag=None, course_id=None, class_date=None,
+                    sha256=None):
+        self.id = uuid.uuid4().hex
+        self.author_id = author_id
+        self.organization_id = organization_id
+        self.file_name = file_name
+        self.size = size
+        self.sha256 = sha256
+        self.term = term
+        self.year = year
+        self.course_tag = course_tag
+        self.course_id = course_id
+        self.class_date = class_date
+
+    @property
+    def staging_path(self):
+        """
+        Returns the path of the staging file holding the received bytes.
+        """
+        return staging_path(self.id)
+
+    @property
+    def offset(self):
+        """
+        Returns the number of bytes received so far.
+        """
+        try:
+            return os.path.getsize(self.staging_path)
+        except OSError:
+            return 0
+
+    @property
+    def complete(self):
+        return self.offset == self.size
+
+
 class User(db.Model):
     """
     Represents a standard user. (Login, own objects, etc)
@@ -229,7 +512,7 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(20), unique=True)
     name = db.Column(db.String(20))
-    password = db.Column(db.String(20))
+    password = db.Column(db.String(255))
     admin = db.Column(db.Boolean)
 
     def organizations(self):
@@ -253,10 +536,18 @@ class User(db.Model):
         return unicode(self.id)
 
     def check_password(self, password):
-        return check_password_hash(self.password, password)
+        """
+        Returns if password is the user's. A hash made with older settings
+        is replaced, so the caller should commit after a match.
+        """
+        if not verify_password(self.password, password):
+            return False
+        if needs_rehash(self.password):
+            self.password = hash_password(password)
+        return True
 
     def __init__(self, username, name, password, admin=False):
         self.username = username
         self.name = name
-        self.password = generate_password_hash(password)
+        self.password = hash_password(password)
         self.admin = admin
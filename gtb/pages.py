@@ -0,0 +1,198 @@
+from flask import request
+from flask.ext.login import current_user
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from werkzeug.contrib.cache import FileSystemCache, MemcachedCache, NullCache
+
+from cache import TTLCache
+from gtb import app
+from models import File, Folder, Organization, OrganizationMember
+
+from functools import wraps
+import hashlib
+import os
+import threading
+import time
+
+
+"""
+Caches rendered pages. Every page is keyed on a version counter for each
+scope it depends on (e.g. 'org:1'), and committing a change to a file,
+folder or membership bumps the versions of the scopes it touches. Pages
+cached under an old version are never looked up again and just age out.
+"""
+
+
+# Version counters have to outlive the pages keyed on them.
+VERSION_TIMEOUT = 24 * 60 * 60
+
+
+class RenderCache(object):
+    """
+    Versioned page cache over a get/set/delete backend, with hit/miss stats.
+    The version counters are kept in versions, the backend by default.
+    """
+    def __init__(self, backend, timeout, versions=None):
+        self.backend = backend
+        self.versions = backend if versions is None else versions
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, scope):
+        key = 'version:' + scope
+        version = self.versions.get(key)
+        if version is None:
+            # Start from the clock, so a counter that was evicted never
+            # comes back at a value an old page is still cached under.
+            version = int(time.time() * 1000)
+            self.versions.set(key, version, VERSION_TIMEOUT)
+        return version
+
+    def bump(self, scope):
+        key = 'version:' + scope
+        version = max((self.versions.get(key) or 0) + 1,
+                      int(time.time() * 1000))
+        self.versions.set(key, version, VERSION_TIMEOUT)
+
+    def get(self, key):
+        page = self.backend.get(key)
+        if page is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return page
+
+    def set(self, key, page):
+        self.backend.set(key, page, self.timeout)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'backend': type(self.backend).__name__,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+def make_backend(config):
+    """
+    Returns the cache backend named by RENDER_CACHE_BACKEND. 'lru' keeps
+    pages local to each process; 'filesystem' is shared by the processes on
+    one machine and 'memcached' by every machine.
+    """
+    name = config['RENDER_CACHE_BACKEND']
+    timeout = config['RENDER_CACHE_TIMEOUT']
+    if name == 'lru':
+        return TTLCache(timeout, max_size=config['RENDER_CACHE_SIZE'])
+    elif name == 'filesystem':
+        return FileSystemCache(config['RENDER_CACHE_DIR'],
+                               threshold=config['RENDER_CACHE_SIZE'],
+                               default_timeout=timeout)
+    elif name == 'memcached':
+        return MemcachedCache(config['RENDER_CACHE_SERVERS'],
+                              default_timeout=timeout, key_prefix='gtb:')
+    return NullCache()
+
+
+def make_versions(config):
+    """
+    Returns where to keep the version counters, or None for the backend.
+    Every process that commits changes has to see the same counters, job
+    workers included, so with 'lru' they go in RENDER_CACHE_DIR instead,
+    unless that is None.
+    """
+    if config['RENDER_CACHE_BACKEND'] == 'lru' and config['RENDER_CACHE_DIR']:
+        return FileSystemCache(os.path.join(config['RENDER_CACHE_DIR'],
+                                            'versions'),
+                               threshold=config['RENDER_CACHE_VERSIONS_SIZE'],
+                               default_timeout=VERSION_TIMEOUT)
+    return None
+
+
+render_cache = RenderCache(make_backend(app.config),
+                           app.config['RENDER_CACHE_TIMEOUT'],
+                           versions=make_versions(app.config))
+
+
+def cached_page(*scopes):
+    """
+    Decorator to serve a view's rendered page from the render cache.
+    scopes are filled in from the view's arguments and user_id, e.g.
+    @cached_page('org:{org_id}'). Only GETs by logged in users are cached,
+    since anonymous pages carry a per-session login form.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if (request.method != 'GET' or
+                not current_user.is_authenticated()):
+                return f(*args, **kwargs)
+
+            names = [scope.format(user_id=current_user.id, **kwargs)
+                     for scope in scopes]
+            key = 'page:' + hashlib.sha1('|'.join(
+                        [request.endpoint, str(current_user.id),
+                         request.full_path.encode('utf-8')] +
+                        ['{0}={1}'.format(name, render_cache.version(name))
+                         for name in names])).hexdigest()
+
+            page = render_cache.get(key)
+            if page is None:
+                page = f(*args, **kwargs)
+                if isinstance(page, basestring):
+                    render_cache.set(key, page)
+            return page
+        return decorated_function
+    return decorator
+
+
+"""
+Invalidation
+"""
+
+
+_pending = threading.local()
+
+
+def bump_after_commit(*scopes):
+    """
+    Bumps scopes once the current transaction commits. Bumping earlier
+    would let a request re-cache the old data under the new version.
+    """
+    if not hasattr(_pending, 'scopes'):
+        _pending.scopes = set()
+    _pending.scopes.update(scopes)
+
+
+@event.listens_for(Session, 'after_commit')
+def bump_pending(session):
+    for scope in getattr(_pending, 'scopes', ()):
+        render_cache.bump(scope)
+    _pending.scopes = set()
+
+
+@event.listens_for(Session, 'after_rollback')
+def drop_pending(session):
+    _pending.scopes = set()
+
+
+@event.listens_for(File, 'after_insert')
+@event.listens_for(File, 'after_update')
+@event.listens_for(File, 'after_delete')
+@event.listens_for(Folder, 'after_insert')
+@event.listens_for(Folder, 'after_update')
+@event.listens_for(Folder, 'after_delete')
+def organization_content_changed(mapper, connection, target):
+    bump_after_commit('org:{0}'.format(target.organization_id))
+
+
+@event.listens_for(Organization, 'after_update')
+def organization_changed(mapper, connection, organization):
+    bump_after_commit('org:{0}'.format(organization.id))
+
+
+@event.listens_for(OrganizationMember, 'after_insert')
+@event.listens_for(OrganizationMember, 'after_update')
+@event.listens_for(OrganizationMember, 'after_delete')
+def organization_member_changed(mapper, connection, member):
+    bump_after_commit('org:{0}'.format(member.organization_id))
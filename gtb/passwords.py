@@ -0,0 +1,183 @@
+from werkzeug.security import (check_password_hash, gen_salt, pbkdf2_hex,
+                               safe_str_cmp)
+
+from gtb import app
+
+import hashlib
+import multiprocessing
+import os
+import threading
+
+
+"""
+Hashes and checks passwords off the web threads. Hashing is meant to be
+slow, so a burst of logins would otherwise hold every worker thread, and
+the GIL, until it passed. Instead a pool of PASSWORD_HASH_WORKERS
+processes does the hashing, and once PASSWORD_HASH_MAX_PENDING hashes are
+waiting in a process, further logins are turned away with PasswordsBusy
+rather than queueing behind them.
+
+Hashes are PBKDF2 in Werkzeug's format (pbkdf2:sha256:20000$salt$hash),
+so older hashes still check. The algorithm and iterations come from the
+config; a user whose hash was made with others is rehashed on login.
+"""
+
+
+class PasswordsBusy(Exception):
+    """
+    Raised when too many passwords are already being hashed.
+    """
+    pass
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_pending = threading.BoundedSemaphore(app.config['PASSWORD_HASH_MAX_PENDING'])
+
+
+def current_method():
+    return 'pbkdf2:{0}:{1}'.format(app.config['PASSWORD_HASH_ALGORITHM'],
+                                   app.config['PASSWORD_HASH_ITERATIONS'])
+
+
+def hash_password(password):
+    """
+    Returns a new salted hash of password.
+    """
+    return run(make_hash, password, app.config['PASSWORD_HASH_ALGORITHM'],
+               app.config['PASSWORD_HASH_ITERATIONS'],
+               app.config['PASSWORD_SALT_LENGTH'])
+
+
+def verify_password(pwhash, password):
+    """
+    Returns if password matches pwhash.
+    """
+    return run(matches, pwhash, password)
+
+
+def needs_rehash(pwhash):
+    """
+    Returns if pwhash was made with other settings than the current ones.
+    """
+    return not pwhash or pwhash.split('$', 1)[0] != current_method()
+
+
+def run(f, *args):
+    """
+    Calls f(*args) in the pool, or in this thread without workers.
+    Raises PasswordsBusy when too many calls are pending already, or this
+    one waited longer than PASSWORD_HASH_TIMEOUT. A call that timed out
+    keeps its place until the pool has run it, so PASSWORD_HASH_MAX_PENDING
+    bounds everything queued in the pool.
+    """
+    if not _pending.acquire(False):
+        raise PasswordsBusy()
+    pool = get_pool()
+    if pool is None:
+        try:
+            return f(*args)
+        finally:
+            _pending.release()
+
+    try:
+        result = pool.apply_async(call, (f,) + args, callback=finished)
+    except Exception:
+        _pending.release()
+        raise
+    try:
+        failed, value = result.get(app.config['PASSWORD_HASH_TIMEOUT'])
+    except multiprocessing.TimeoutError:
+        raise PasswordsBusy()
+    if failed:
+        raise value
+    return value
+
+
+def finished(outcome):
+    """
+    Frees a call's place once the pool has run it, whether or not the
+    caller is still waiting. Runs in the pool's result thread.
+    """
+    _pending.release()
+
+
+def start_pool():
+    """
+    Starts this process's pool, unless it has one. Call it before starting
+    any threads, since forking the workers copies whatever locks other
+    threads hold: run.py does before serving, and serve.py in each worker
+    right after forking.
+    """
+    global _pool, _pool_pid
+    if _pool_pid == os.getpid():
+        return _pool
+    workers = app.config['PASSWORD_HASH_WORKERS']
+    _pool = multiprocessing.Pool(workers) if workers else None
+    _pool_pid = os.getpid()
+    return _pool
+
+
+def get_pool():
+    """
+    Returns this process's pool. A process whose entry point didn't start
+    one, like a test run, gets it on first use. A pool isn't shared with
+    processes forked after it started.
+    """
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                start_pool()
+    return _pool
+
+
+"""
+Run in the workers
+"""
+
+
+def call(f, *args):
+    """
+    Returns (failed, what f(*args) returned or raised). Python 2's pool
+    only calls back for calls that succeed, so nothing is raised here.
+    """
+    try:
+        return False, f(*args)
+    except Exception as e:
+        return True, e
+
+
+def pbkdf2(password, salt, algorithm, iterations):
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+    if isinstance(salt, unicode):
+        salt = salt.encode('utf-8')
+    # hashlib's is in C; Werkzeug's is several times slower.
+    if hasattr(hashlib, 'pbkdf2_hmac'):
+        return hashlib.pbkdf2_hmac(algorithm, password, salt,
+                                   iterations).encode('hex')
+    return pbkdf2_hex(password, salt, iterations,
+                      hashfunc=getattr(hashlib, algorithm))
+
+
+def make_hash(password, algorithm, iterations, salt_length):
+    salt = gen_salt(salt_length)
+    return 'pbkdf2:{0}:{1}${2}${3}'.format(algorithm, iterations, salt,
+                                           pbkdf2(password, salt, algorithm,
+                                                  iterations))
+
+
+def matches(pwhash, password):
+    if not pwhash or pwhash.count('$') < 2:
+        return False
+    # Hashes come back from the database as unicode; hashlib and
+    # safe_str_cmp want str.
+    pwhash = pwhash.encode('utf-8')
+    method, salt, hashval = pwhash.split('$', 2)
+    parts = method.split(':')
+    if (len(parts) == 3 and parts[0] == 'pbkdf2' and parts[2].isdigit() and
+        parts[1] in hashlib.algorithms):
+        return safe_str_cmp(pbkdf2(password, salt, parts[1], int(parts[2])),
+                            hashval)
+    return check_password_hash(pwhash, password)
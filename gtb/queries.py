@@ -0,0 +1,294 @@
+from sqlalchemy import and_, case, desc, func, or_
+from sqlalchemy.orm import joinedload
+
+from collections import namedtuple
+from constants import TERM_ORDER
+from gtb import db
+from models import (Conversation, File, Folder, Message, OrganizationMember,
+                    User)
+
+
+"""
+Read queries for views that would otherwise walk relationships row by row.
+Each returns plain tuples with everything the template needs.
+"""
+
+
+InboxEntry = namedtuple('InboxEntry', ['conversation', 'other', 'last_sent',
+                                       'unread', 'preview'])
+
+
+class CourseFolder(namedtuple('CourseFolder', ['course_tag', 'course_id',
+                                               'file_count', 'last_upload'])):
+    """
+    A course within a term folder, e.g. "CS 101".
+    """
+    @property
+    def name(self):
+        return self.course_tag + ' ' + str(self.course_id)
+
+
+COURSE_FOLDER_SORTS = {
+    'name': lambda count, last: (File.course_tag, File.course_id),
+    'files': lambda count, last: (desc(count), File.course_tag,
+                                  File.course_id),
+    'recent': lambda count, last: (desc(last), File.course_tag,
+                                   File.course_id),
+}
+
+FILE_SORTS = {
+    'recent': (File.upload_date.desc(),),
+    'name': (File.file_name, File.upload_date.desc()),
+    'class_date': (File.class_date.desc(), File.upload_date.desc()),
+}
+
+# What each kind of page reads from the rows it lists, loaded with them so
+# rendering doesn't lazy load a relationship per row. Pass to options():
+#     File.query.options(*LOAD_PROFILES['file_listing'])
+LOAD_PROFILES = {
+    # Member tables show each member's name.
+    'members': (joinedload('user'),),
+    # File tables show the author and the term folder of each file.
+    'file_listing': (joinedload('author'), joinedload('folder')),
+    # Search results also say which organization a file is from.
+    'search_results': (joinedload('author'), joinedload('folder'),
+                       joinedload('organization')),
+    # Files from before the blob store are found through their folder.
+    'download': (joinedload('folder'),),
+}
+
+
+def inbox_conversations(user_id, page=1, per_page=25):
+    """
+    Returns (entries, has_next) for a user's conversations, most recently
+    active first, each with the other participant, the time and text of
+    the last message, and how many messages to the user are unread.
+    """
+    other_id = case([(Conversation.receiver_id == user_id,
+                      Conversation.sender_id)],
+                    else_=Conversation.receiver_id)
+    unread = func.sum(case([(and_(Message.read == False,
+                                  Message.sender_id != user_id), 1)],
+                           else_=0))
+    last_sent = func.max(Message.sent_at).label('last_sent')
+
+    rows = db.session.query(
+                        Conversation, User, last_sent,
+                        func.max(Message.id), unread
+                    ).join(
+                        (User, User.id == other_id)
+                    ).outerjoin(
+                        (Message, Message.conversation_id == Conversation.id)
+                    ).filter(
+                        or_(Conversation.sender_id == user_id,
+                            Conversation.receiver_id == user_id)
+                    ).group_by(
+                        Conversation.id, User.id
+                    ).order_by(
+                        desc('last_sent')
+                    ).limit(
+                        per_page + 1
+                    ).offset(
+                        (page - 1) * per_page
+                    ).all()
+
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+
+    last_ids = [row[3] for row in rows if row[3] is not None]
+    previews = {}
+    if last_ids:
+        previews = dict(db.session.query(
+                                    Message.id, Message.content
+                                ).filter(
+                                    Message.id.in_(last_ids)
+                                ).all())
+
+    entries = [InboxEntry(conv, other, sent, int(unread or 0),
+                          previews.get(last_id))
+               for conv, other, sent, last_id, unread in rows]
+    return entries, has_next
+
+
+def find_conversation(user_id, other_id):
+    """
+    Returns the conversation between two users, whichever of them started it.
+    """
+    return Conversation.query.filter(
+                        or_(and_(Conversation.sender_id == user_id,
+                                 Conversation.receiver_id == other_id),
+                            and_(Conversation.sender_id == other_id,
+                                 Conversation.receiver_id == user_id))
+                    ).first()
+
+
+def conversation_messages(conversation_id, before=None, limit=50):
+    """
+    Returns (messages, has_older) for the newest limit messages of a
+    conversation, or the ones just before message id before. Messages come
+    back oldest first, with their senders loaded.
+    """
+    query = Message.query.options(
+                        joinedload('sender')
+                    ).filter(
+                        Message.conversation_id == conversation_id
+                    )
+    if before is not None:
+        query = query.filter(Message.id < before)
+
+    messages = query.order_by(Message.id.desc()).limit(limit + 1).all()
+    has_older = len(messages) > limit
+    messages = messages[:limit]
+    messages.reverse()
+    return messages, has_older
+
+
+def mark_read(conversation_id, user_id):
+    """
+    Marks the messages sent to user_id in a conversation as read. Nothing
+    is marked unless user_id is one of the conversation's two users.
+    """
+    participant = db.session.query(
+                        Conversation.id
+                    ).filter(
+                        Conversation.id == conversation_id
+                    ).filter(
+                        or_(Conversation.sender_id == user_id,
+                            Conversation.receiver_id == user_id)
+                    )
+    Message.query.filter(
+                    Message.conversation_id.in_(participant.subquery())
+                ).filter(
+                    Message.sender_id != user_id
+                ).filter(
+                    Message.read == False
+                ).update({'read': True}, synchronize_session=False)
+
+
+def recent_files(organization_id, limit=5):
+    """
+    Returns the organization's most recently uploaded files.
+    """
+    return File.query.options(
+                        *LOAD_PROFILES['file_listing']
+                    ).filter_by(
+                        organization_id=organization_id
+                    ).order_by(
+                        File.upload_date.desc()
+                    ).limit(limit).all()
+
+
+def term_folders(organization_id):
+    """
+    Returns the organization's term folders, newest term first. Each folder
+    carries its own file count and last upload time. Folders without a
+    known term come last in their year.
+    """
+    term_order = case([(Folder.term == term, n)
+                       for n, term in enumerate(TERM_ORDER, 1)], else_=0)
+    return Folder.query.filter_by(
+                            organization_id=organization_id,
+                            top=False
+                        ).order_by(
+                            Folder.year.desc(), term_order.desc()
+                        ).all()
+
+
+def course_folders(folder_id, sort='name', page=1, per_page=100):
+    """
+    Returns (course folders, has_next) for a term folder, with the number
+    of files and last upload time of each, grouped in SQL.
+    """
+    count = func.count(File.id)
+    last = func.max(File.upload_date)
+    order = COURSE_FOLDER_SORTS.get(sort, COURSE_FOLDER_SORTS['name'])
+
+    rows = db.session.query(
+                        File.course_tag, File.course_id, count, last
+                    ).filter(
+                        File.folder_id == folder_id
+                    ).filter(
+                        File.course_tag != None
+                    ).group_by(
+                        File.course_tag, File.course_id
+                    ).order_by(
+                        *order(count, last)
+                    ).limit(
+                        per_page + 1
+                    ).offset(
+                        (page - 1) * per_page
+                    ).all()
+
+    return [CourseFolder(*row) for row in rows[:per_page]], \
+           len(rows) > per_page
+
+
+def archive_files(folder_id, course_tag=None, course_id=None):
+    """
+    Returns every file in a term folder, or in one of its courses, in
+    course and name order with their blobs loaded.
+    """
+    query = File.query.options(
+                        joinedload('blob')
+                    ).filter(
+                        File.folder_id == folder_id
+                    )
+    if course_tag and course_id:
+        query = query.filter(
+                        File.course_tag == course_tag
+                    ).filter(
+                        File.course_id == course_id
+                    )
+    return query.order_by(File.course_tag, File.course_id, File.file_name,
+                          File.id).all()
+
+
+def organization_members(organization_id, page=1, per_page=50):
+    """
+    Returns (members, has_next) for a page of an organization's accepted
+    members, with their users loaded.
+    """
+    members = OrganizationMember.query.options(
+                        *LOAD_PROFILES['members']
+                    ).filter_by(
+                        organization_id=organization_id,
+                        accepted=True
+                    ).order_by(
+                        OrganizationMember.id
+                    ).limit(
+                        per_page + 1
+                    ).offset(
+                        (page - 1) * per_page
+                    ).all()
+
+    return members[:per_page], len(members) > per_page
+
+
+def course_files(organization_id, term, year, course_tag, course_id,
+                 sort='recent', page=1, per_page=50):
+    """
+    Returns (files, has_next) for one course in one term of an organization.
+    """
+    files = File.query.options(
+                        *LOAD_PROFILES['file_listing']
+                    ).join(
+                        (Folder, File.folder_id == Folder.id)
+                    ).filter(
+                        File.organization_id == organization_id
+                    ).filter(
+                        File.course_tag == course_tag
+                    ).filter(
+                        File.course_id == course_id
+                    ).filter(
+                        Folder.term == term
+                    ).filter(
+                        Folder.year == year
+                    ).order_by(
+                        *FILE_SORTS.get(sort, FILE_SORTS['recent'])
+                    ).limit(
+                        per_page + 1
+                    ).offset(
+                        (page - 1) * per_page
+                    ).all()
+
+    return files[:per_page], len(files) > per_page
@@ -0,0 +1,153 @@
+from sqlalchemy import and_, desc, func, or_
+
+from gtb import db
+from models import File, SearchTerm
+from queries import LOAD_PROFILES
+
+import re
+
+
+"""
+An inverted index over everything search() matches on. Each file gets one
+SearchTerm row per normalized word in its name, course, term folder and
+organization name, plus the words of its text once a job has extracted it,
+so a search is a single grouped lookup on the term column instead of a
+scan of every file the user can see.
+"""
+
+
+# Compact forms ("cs101", "fall2013") are what people type most, so they
+# rank above a stray word in a file name.
+WEIGHTS = {
+    'name': 1,
+    'organization': 1,
+    'term': 1,
+    'course_tag': 3,
+    'course_id': 2,
+    'course': 5,
+    'folder': 4,
+    'content': 1,
+}
+
+# Only the most frequent words of a file's text are indexed.
+CONTENT_TERMS = 500
+
+
+def tokenize(text):
+    """
+    Returns the lowercase alphanumeric words in text.
+    """
+    return re.findall(r'[a-z0-9]+', (text or '').lower())
+
+
+def compact(text):
+    """
+    Returns text lowercased with everything but letters and digits removed,
+    so "CS 101" and "cs101" index the same.
+    """
+    return ''.join(tokenize(text))
+
+
+def content_words(text):
+    """
+    Returns the CONTENT_TERMS most frequent words of at least three
+    characters in text.
+    """
+    counts = {}
+    for word in tokenize(text):
+        if 3 <= len(word) <= 64:
+            counts[word] = counts.get(word, 0) + 1
+    ranked = sorted(counts, key=lambda word: (-counts[word], word))
+    return ranked[:CONTENT_TERMS]
+
+
+def file_terms(f, words=()):
+    """
+    Returns a dict of term -> weight for a file and the words of its text.
+    """
+    terms = {}
+
+    def add(words, weight):
+        for word in words:
+            if word:
+                terms[word[:64]] = terms.get(word[:64], 0) + weight
+
+    add(tokenize(f.file_name), WEIGHTS['name'])
+    add(tokenize(f.organization.name), WEIGHTS['organization'])
+    if f.course_tag and f.course_id:
+        add([f.course_tag.lower()], WEIGHTS['course_tag'])
+        add([str(f.course_id)], WEIGHTS['course_id'])
+        add([compact(f.course_folder)], WEIGHTS['course'])
+    if f.folder and f.folder.term and f.folder.year:
+        add(tokenize(f.folder.name), WEIGHTS['term'])
+        add([compact(f.folder.name)], WEIGHTS['folder'])
+    add(words, WEIGHTS['content'])
+    return terms
+
+
+def index_file(f, words=()):
+    """
+    Replaces a file's index entries, including words from its text if
+    given. The file must have been flushed; the caller commits.
+    """
+    f.search_terms = [SearchTerm(term, f.organization_id, weight)
+                      for term, weight in file_terms(f, words).items()]
+
+
+def rebuild_index():
+    """
+    Rebuilds the whole index from the files table. Returns the number of
+    files indexed. File text isn't read here; queue extract_text jobs to
+    index it again.
+    """
+    SearchTerm.query.delete()
+    count = 0
+    for f in File.query.yield_per(500):
+        index_file(f)
+        count += 1
+    db.session.commit()
+    return count
+
+
+def search_files(query, organization_ids, page=1, per_page=25):
+    """
+    Returns (files, has_next) for the files in organization_ids matching
+    query, best matches first. The last word also matches as a prefix, so
+    results show up while it is still being typed.
+    """
+    words = tokenize(query)
+    if not words or not organization_ids:
+        return [], False
+
+    terms = set(words)
+    terms.add(compact(query))
+
+    # Terms are [a-z0-9] only and '{' sorts right after 'z', so this range
+    # is a prefix match that can still use the index on term.
+    last = words[-1]
+    matches = or_(SearchTerm.term.in_(list(terms)),
+                  and_(SearchTerm.term >= last, SearchTerm.term < last + '{'))
+
+    score = func.sum(SearchTerm.weight).label('score')
+    rows = db.session.query(
+                        File, score
+                    ).options(
+                        *LOAD_PROFILES['search_results']
+                    ).join(
+                        (SearchTerm, SearchTerm.file_id == File.id)
+                    ).filter(
+                        SearchTerm.organization_id.in_(organization_ids)
+                    ).filter(
+                        matches
+                    ).group_by(
+                        File.id
+                    ).order_by(
+                        desc('score'), File.upload_date.desc()
+                    ).limit(
+                        per_page + 1
+                    ).offset(
+                        (page - 1) * per_page
+                    ).all()
+
+    files = [f for f, _ in rows]
+    return files[:per_page], len(files) > per_page
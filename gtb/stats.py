@@ -0,0 +1,42 @@
+from gtb import db
+from models import OrganizationStats
+
+
+"""
+Rebuilds the per-organization totals in OrganizationStats from the rows
+they count. They are kept up to date as things change, so this is only
+needed after editing the database by hand or to check nothing drifted.
+"""
+
+
+FIELDS = OrganizationStats.FIELDS
+
+
+def reconcile_stats(dry_run=False):
+    """
+    Makes every organization's stats match a fresh count, adding missing
+    rows and removing ones for organizations that are gone. Returns how
+    many rows were wrong.
+    """
+    counts = OrganizationStats.count()
+    fixed = 0
+    for stats in OrganizationStats.query.all():
+        expected = counts.pop(stats.organization_id, None)
+        if expected is None:
+            fixed += 1
+            db.session.delete(stats)
+        elif tuple(getattr(stats, f) for f in FIELDS) != expected:
+            fixed += 1
+            for field, value in zip(FIELDS, expected):
+                setattr(stats, field, value)
+
+    for org_id, expected in counts.items():
+        fixed += 1
+        db.session.add(OrganizationStats(org_id, **dict(zip(FIELDS,
+                                                             expected))))
+
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
+    return fixed
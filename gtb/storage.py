@@ -0,0 +1,267 @@
+from collections import namedtuple
+from contextlib import contextmanager
+
+from gtb import app
+from layout import ensure_dir, forget_dir
+
+import calendar
+import errno
+import os
+import shutil
+import tempfile
+import uuid
+
+
+"""
+Where stored file contents live. Everything outside the staging folder is
+read and written through the storage object here by key (a relative path
+like 'blobs/ab/cd/abcd...'), so app nodes can share an object store
+instead of each keeping files on its own disk.
+
+    STORAGE_BACKEND = 'local'   files under UPLOAD_FOLDER
+    STORAGE_BACKEND = 's3'      any S3 API compatible store; needs boto3
+"""
+
+
+# How much is read or written at a time when copying files around.
+BLOCK_SIZE = 64 * 1024
+
+Stat = namedtuple('Stat', ['size', 'mtime'])
+
+
+class NotStored(LookupError):
+    """
+    Raised when reading a key that isn't stored.
+    """
+    pass
+
+
+class Storage(object):
+    """
+    The interface every backend implements.
+    """
+    def put(self, key, path):
+        """
+        Stores the contents of the local file at path under key. The file
+        itself is left in place.
+        """
+        raise NotImplementedError()
+
+    def open(self, key):
+        """
+        Returns a readable file object for key.
+        """
+        raise NotImplementedError()
+
+    def stream(self, key, start=0, stop=None):
+        """
+        Yields the bytes of key in [start, stop) in blocks.
+        """
+        raise NotImplementedError()
+
+    def stat(self, key):
+        """
+        Returns a Stat for key, or None if it isn't stored.
+        """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """
+        Removes key. Removing a key that isn't stored is not an error.
+        """
+        raise NotImplementedError()
+
+    def local_path(self, key):
+        """
+        Returns the path of key on this machine's disk if it has one, which
+        lets the front end server send it.
+        """
+        return None
+
+    @contextmanager
+    def local_file(self, key):
+        """
+        Context manager giving a local path holding the contents of key,
+        downloading it to a temporary file when it isn't on disk.
+        """
+        path = self.local_path(key)
+        if path is not None:
+            yield path
+            return
+
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as dst:
+                for block in self.stream(key):
+                    dst.write(block)
+            yield path
+        finally:
+            os.remove(path)
+
+
+class LocalStorage(Storage):
+    """
+    Stores keys as files under root.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def local_path(self, key):
+        return os.path.join(self.root, key)
+
+    def put(self, key, path):
+        target = self.local_path(key)
+        directory = os.path.dirname(target)
+        ensure_dir(directory)
+        try:
+            # A hard link is as cheap as a rename when the staging folder is
+            # on the same filesystem, and leaves the staged file in place.
+            os.link(path, target)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return
+            if e.errno == errno.ENOENT and os.path.exists(path):
+                # The directory was removed since we made it.
+                forget_dir(directory)
+                ensure_dir(directory)
+                return self.put(key, path)
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            partial = '{0}.{1}.part'.format(target, uuid.uuid4().hex)
+            shutil.copyfile(path, partial)
+            os.rename(partial, target)
+
+    def open(self, key):
+        try:
+            return open(self.local_path(key), 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise NotStored(key)
+            raise
+
+    def stream(self, key, start=0, stop=None):
+        with self.open(key) as src:
+            src.seek(start)
+            remaining = None if stop is None else stop - start
+            while remaining is None or remaining > 0:
+                size = (BLOCK_SIZE if remaining is None
+                        else min(BLOCK_SIZE, remaining))
+                block = src.read(size)
+                if not block:
+                    break
+                if remaining is not None:
+                    remaining -= len(block)
+                yield block
+
+    def stat(self, key):
+        try:
+            stat = os.stat(self.local_path(key))
+        except OSError:
+            return None
+        return Stat(stat.st_size, stat.st_mtime)
+
+    def delete(self, key):
+        try:
+            os.remove(self.local_path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class S3Storage(Storage):
+    """
+    Stores keys as objects in an S3 bucket, under prefix. endpoint_url
+    points it at another S3 API compatible server, e.g. MinIO. client is
+    made with boto3 unless one is given, like a stand-in for tests.
+    """
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None,
+                 access_key=None, secret_key=None, client=None):
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise RuntimeError("STORAGE_BACKEND 's3' needs boto3 "
+                                   "installed.")
+            client = boto3.client('s3', endpoint_url=endpoint_url,
+                                  region_name=region,
+                                  aws_access_key_id=access_key,
+                                  aws_secret_access_key=secret_key)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = client
+        self.client_error = client.exceptions.ClientError
+
+    def object_key(self, key):
+        return self.prefix + key
+
+    def is_missing(self, error):
+        return error.response.get('Error', {}).get('Code') in \
+            ('404', 'NoSuchKey', 'NotFound')
+
+    def put(self, key, path):
+        # Uploads big files in parts, several at once.
+        self.client.upload_file(path, self.bucket, self.object_key(key))
+
+    def object_body(self, key, **kwargs):
+        """
+        Returns the streaming body of key's object. kwargs go to
+        get_object, e.g. a Range.
+        """
+        try:
+            return self.client.get_object(Bucket=self.bucket,
+                                          Key=self.object_key(key),
+                                          **kwargs)['Body']
+        except self.client_error as e:
+            if self.is_missing(e):
+                raise NotStored(key)
+            raise
+
+    def open(self, key):
+        return self.object_body(key)
+
+    def stream(self, key, start=0, stop=None):
+        if start or stop is not None:
+            body = self.object_body(key, Range='bytes={0}-{1}'.format(
+                                start, '' if stop is None else stop - 1))
+        else:
+            body = self.object_body(key)
+        try:
+            while True:
+                block = body.read(BLOCK_SIZE)
+                if not block:
+                    break
+                yield block
+        finally:
+            body.close()
+
+    def stat(self, key):
+        try:
+            head = self.client.head_object(Bucket=self.bucket,
+                                           Key=self.object_key(key))
+        except self.client_error as e:
+            if self.is_missing(e):
+                return None
+            raise
+        return Stat(head['ContentLength'],
+                    calendar.timegm(head['LastModified'].utctimetuple()))
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket,
+                                  Key=self.object_key(key))
+
+
+def make_storage(config):
+    """
+    Returns the backend named by STORAGE_BACKEND.
+    """
+    if config['STORAGE_BACKEND'] == 's3':
+        return S3Storage(config['STORAGE_S3_BUCKET'],
+                         prefix=config['STORAGE_S3_PREFIX'],
+                         endpoint_url=config['STORAGE_S3_ENDPOINT_URL'],
+                         region=config['STORAGE_S3_REGION'],
+                         access_key=config['STORAGE_S3_ACCESS_KEY'],
+                         secret_key=config['STORAGE_S3_SECRET_KEY'])
+    return LocalStorage(config['UPLOAD_FOLDER'])
+
+
+storage = make_storage(app.config)
@@ -1 +1,820 @@
+from gtb import app, db
+from blobs import discard_stored
+from downloads import requested_range
+from jobs import (HANDLERS, JobError, claim_job, requeue_stale, run_job,
+                  start_workers)
+from instrument import QueryBudgetExceeded, budgets, metrics
+from models import (Blob, Category, File, Folder, Job, Message,
+                    OrganizationMember, OrganizationStats, SearchTerm,
+                    UploadSession, User)
+from passwords import PasswordsBusy
+from pages import RenderCache, make_backend, make_versions, render_cache
+from queries import inbox_conversations, term_folders
+from search import index_file, rebuild_index, search_files
+from stats import reconcile_stats
+from storage import NotStored, S3Storage, storage
+from uploads import UploadError, bulk_upload
+from util import page_number, user_cache
+from zipstream import SizeMismatch, ZipStream
 
+from datetime import datetime, timedelta
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+
+import config
+import passwords
+
+
+class AppTestCase(unittest.TestCase):
+    """
+    Runs each test against a fresh database and upload folder, logged in
+    as a member of organization 1.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        app.config['TESTING'] = True
+        app.config['CSRF_ENABLED'] = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + \
+            os.path.join(self.directory, 'test.db')
+        app.config['UPLOAD_FOLDER'] = os.path.join(self.directory, 'up/')
+        app.config['UPLOAD_STAGING_FOLDER'] = \
+            os.path.join(self.directory, 'up/.staging/')
+        storage.root = app.config['UPLOAD_FOLDER']
+        for cache in (render_cache.backend, render_cache.versions, user_cache):
+            cache.clear()
+
+        db.create_all()
+        db.session.add(Category('CS'))
+        db.session.commit()
+
+        self.client = app.test_client()
+        self.client.post('/register', data=dict(name='Alice',
+                                                username='alice',
+                                                password='pass',
+                                                confirm_pass='pass'))
+        self.client.post('/create/organization', data=dict(name='Org One'))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(self.directory)
+
+    def upload(self, data, name='notes.txt', course_id='101'):
+        return self.client.post('/organization/1/upload', data=dict(
+                                    course_tag='CS', course_id=course_id,
+                                    term='Fall', year='2013',
+                                    date='01/02/2013',
+                                    file=(io.BytesIO(data), name)))
+
+
+class InstrumentTestCase(AppTestCase):
+
+    def test_queries_are_counted_on_the_test_database(self):
+        # The engine for this test's database was made after the app was
+        # imported, and has to count queries all the same.
+        self.client.get('/organization/1/display')
+        queries = metrics.endpoints['display_org'].queries
+        self.assertGreater(queries.max, 0)
+
+
+class UploadTestCase(AppTestCase):
+
+    def start_session(self, size):
+        response = self.client.post('/organization/1/upload/sessions',
+                                    data=dict(file_name='big.pdf', size=size,
+                                              term='Fall', year='2013',
+                                              course_tag='CS',
+                                              course_id='101',
+                                              date='01/02/2013'))
+        self.assertEqual(response.status_code, 201)
+        return json.loads(response.data)['id']
+
+    def put_chunk(self, session_id, offset, data):
+        return self.client.put('/upload/sessions/{0}?offset={1}'.format(
+                                    session_id, offset),
+                               data=data,
+                               content_type='application/octet-stream')
+
+    def test_chunk_after_gap_is_rejected(self):
+        session_id = self.start_session(10)
+        self.assertEqual(self.put_chunk(session_id, 0, '01234').status_code,
+                         200)
+
+        response = self.put_chunk(session_id, 7, '789')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(json.loads(response.data)['offset'], 5)
+        self.assertEqual(UploadSession.query.get(session_id).offset, 5)
+
+    def test_duplicate_upload_shares_blob(self):
+        self.upload('same bytes', 'a.txt')
+        self.upload('same bytes', 'b.txt')
+
+        self.assertEqual(File.query.count(), 2)
+        blob = Blob.query.one()
+        self.assertEqual(blob.refcount, 2)
+        self.assertEqual(set(f.blob_id for f in File.query), set([blob.id]))
+
+    def test_discard_keeps_committed_blobs(self):
+        self.upload('kept bytes')
+        kept = Blob.query.one().key
+        orphan = kept[:-1] + ('0' if kept[-1] != '0' else '1')
+        with open(os.path.join(storage.root, kept), 'rb') as src:
+            path = os.path.join(self.directory, 'orphan')
+            with open(path, 'wb') as dst:
+                dst.write(src.read())
+        storage.put(orphan, path)
+
+        discard_stored([kept, orphan])
+        self.assertNotEqual(storage.stat(kept), None)
+        self.assertEqual(storage.stat(orphan), None)
+
+
+class BulkUploadTestCase(AppTestCase):
+
+    def setUp(self):
+        AppTestCase.setUp(self)
+        self.max_bytes = app.config['BULK_UPLOAD_MAX_BYTES']
+        app.config['BULK_UPLOAD_MAX_BYTES'] = 10
+
+    def tearDown(self):
+        app.config['BULK_UPLOAD_MAX_BYTES'] = self.max_bytes
+        AppTestCase.tearDown(self)
+
+    def bulk_upload(self, entries):
+        with app.test_request_context():
+            return bulk_upload(entries, organization_id=1, author_id=1,
+                               term='Fall', year=2013, course_tag='CS',
+                               course_id=101)
+
+    def test_declared_size_over_budget_is_not_opened(self):
+        def open_stream():
+            self.fail('opened a file over the budget')
+
+        with self.assertRaises(UploadError) as raised:
+            self.bulk_upload([('a.txt', 6, lambda: io.BytesIO('abcdef')),
+                              ('b.txt', 5, open_stream)])
+        self.assertEqual(raised.exception.status, 413)
+        self.assertEqual(File.query.count(), 0)
+
+    def test_copy_stops_past_budget(self):
+        stream = io.BytesIO('x' * 1000)
+        with self.assertRaises(UploadError):
+            self.bulk_upload([('a.txt', None, lambda: io.BytesIO('abcdef')),
+                              ('b.txt', None, lambda: stream)])
+        self.assertEqual(stream.tell(), 5)
+        self.assertEqual(File.query.count(), 0)
+        self.assertEqual(os.listdir(app.config['UPLOAD_STAGING_FOLDER']), [])
+
+
+class OrganizationTestCase(AppTestCase):
+
+    def test_members_are_paged(self):
+        per_page = app.config['MEMBERS_PER_PAGE']
+        app.config['MEMBERS_PER_PAGE'] = 1
+        try:
+            for username in ('bob', 'carol'):
+                client = app.test_client()
+                client.post('/register', data=dict(name=username,
+                                                   username=username,
+                                                   password='pass',
+                                                   confirm_pass='pass'))
+                self.client.post('/organization/1/add_member',
+                                 data=dict(username=username, rank='1'))
+                client.post('/me/invites', data=dict(accept='1'))
+
+            first = self.client.get('/organization/1/display').data
+            last = self.client.get('/organization/1/display?page=3').data
+        finally:
+            app.config['MEMBERS_PER_PAGE'] = per_page
+        self.assertIn('Alice', first)
+        self.assertNotIn('carol', first)
+        self.assertIn('page=2', first)
+        self.assertIn('carol', last)
+        self.assertNotIn('page=4', last)
+
+    def test_term_folders_are_in_chronological_order(self):
+        for term, year in (('Spring', 2013), ('Fall', 2012), ('Fall', 2013),
+                           ('Winter', 2013), (None, 2013), ('Summer', 2013)):
+            db.session.add(Folder(1, term=term, year=year))
+        db.session.commit()
+        self.assertEqual([(f.term, f.year) for f in term_folders(1)],
+                         [('Fall', 2013), ('Summer', 2013), ('Spring', 2013),
+                          ('Winter', 2013), (None, 2013), ('Fall', 2012)])
+
+    def test_malformed_course_paths_are_not_found(self):
+        for path in ('/organization/1/term/Fall/folder/CS 101',
+                     '/organization/1/term/Fall 2013/folder/CS x',
+                     '/organization/1/download/term/Fall 2013/folder/CS'):
+            self.assertEqual(self.client.get(path).status_code, 404, path)
+
+
+class ConversationTestCase(AppTestCase):
+
+    def register(self, username):
+        client = app.test_client()
+        client.post('/register', data=dict(name=username, username=username,
+                                           password='pass',
+                                           confirm_pass='pass'))
+        return client
+
+    def test_only_participants_see_a_conversation(self):
+        bob = self.register('bob')
+        self.client.post('/1/2/conversation', data=dict(subject='hi',
+                                                        content='hello'))
+        eve = self.register('eve')
+
+        self.assertEqual(eve.get('/1/2/conversation').status_code, 404)
+        self.assertEqual(eve.get('/2/1/conversation').status_code, 404)
+        self.assertEqual(Message.query.one().read, False)
+
+        self.assertEqual(bob.get('/1/2/conversation').status_code, 200)
+        self.assertEqual(Message.query.one().read, True)
+
+    def test_inbox_counts_unread_and_shows_the_last_message(self):
+        bob = self.register('bob')
+        carol = self.register('carol')
+        for content in ('one', 'two'):
+            self.client.post('/1/2/conversation',
+                             data=dict(subject='notes', content=content))
+        for content in ('three', 'four'):
+            carol.post('/3/1/conversation',
+                       data=dict(subject='exam', content=content))
+
+        entries, has_next = inbox_conversations(1)
+        self.assertFalse(has_next)
+        self.assertEqual([(e.other.username, e.unread, e.preview)
+                          for e in entries],
+                         [('carol', 2, 'four'), ('bob', 0, 'two')])
+        entries, _ = inbox_conversations(2)
+        self.assertEqual([(e.other.username, e.unread, e.preview)
+                          for e in entries], [('alice', 2, 'two')])
+
+        self.client.get('/3/1/conversation')
+        bob.post('/2/1/conversation', data=dict(content='five'))
+        entries, _ = inbox_conversations(1)
+        self.assertEqual([(e.other.username, e.unread, e.preview)
+                          for e in entries],
+                         [('bob', 1, 'five'), ('carol', 0, 'four')])
+        entries, has_next = inbox_conversations(1, page=2, per_page=1)
+        self.assertEqual([e.other.username for e in entries], ['carol'])
+        self.assertFalse(has_next)
+
+
+class QueryBudgetTestCase(AppTestCase):
+    """
+    Renders the budgeted pages of an organization with several members,
+    files and messages, so a query per row goes over the budget.
+    """
+    def setUp(self):
+        AppTestCase.setUp(self)
+        self.strict = app.config['QUERY_BUDGET_STRICT']
+        app.config['QUERY_BUDGET_STRICT'] = True
+
+        for n in range(4):
+            username = 'member{0}'.format(n)
+            client = app.test_client()
+            client.post('/register', data=dict(name=username,
+                                               username=username,
+                                               password='pass',
+                                               confirm_pass='pass'))
+            self.client.post('/organization/1/add_member',
+                             data=dict(username=username, rank='1'))
+            client.post('/me/invites', data=dict(accept='1'))
+            client.post('/{0}/1/conversation'.format(n + 2),
+                        data=dict(subject='notes', content='first'))
+            self.client.post('/1/{0}/conversation'.format(n + 2),
+                             data=dict(content='reply'))
+
+        for n in range(6):
+            self.client.post('/organization/1/upload', data=dict(
+                                 course_tag='CS', course_id=str(101 + n % 3),
+                                 term=('Fall', 'Spring')[n % 2],
+                                 year='2013', date='01/02/2013',
+                                 file=(io.BytesIO('notes %d' % n),
+                                       'notes%d.txt' % n)))
+
+    def tearDown(self):
+        app.config['QUERY_BUDGET_STRICT'] = self.strict
+        AppTestCase.tearDown(self)
+
+    def test_pages_stay_within_their_budgets(self):
+        folder = Folder.query.filter_by(organization_id=1, term='Fall').one()
+        for path in ('/organization/1/display',
+                     '/organization/1/folder/{0}'.format(folder.id),
+                     '/organization/1/term/Fall 2013/folder/CS 101',
+                     '/inbox',
+                     '/1/2/conversation',
+                     '/search?search=notes'):
+            self.assertEqual(self.client.get(path).status_code, 200, path)
+        self.assertEqual(File.query.count(), 6)
+        self.assertEqual(Message.query.count(), 8)
+
+    def test_going_over_the_budget_fails(self):
+        budget = budgets['display_org']
+        budgets['display_org'] = 1
+        try:
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get('/organization/1/display')
+        finally:
+            budgets['display_org'] = budget
+
+
+class SearchTestCase(AppTestCase):
+
+    def search(self, query, organization_ids=(1,)):
+        files, _ = search_files(query, list(organization_ids))
+        return [f.file_name for f in files]
+
+    def test_course_matches_rank_above_file_names(self):
+        self.upload('review', 'review.txt', course_id='101')
+        self.upload('other', '101.txt', course_id='102')
+        self.assertEqual(self.search('101'), ['review.txt', '101.txt'])
+        self.assertEqual(self.search('cs101'), ['review.txt'])
+
+    def test_last_word_matches_as_a_prefix(self):
+        self.upload('review', 'review.txt')
+        self.upload('syllabus', 'syllabus.txt')
+        self.assertEqual(self.search('revi'), ['review.txt'])
+        self.assertEqual(self.search('revi syll'), ['syllabus.txt'])
+
+    def test_any_word_matches(self):
+        self.upload('review', 'review.txt')
+        self.upload('syllabus', 'syllabus.txt')
+        self.assertEqual(sorted(self.search('review syllabus')),
+                         ['review.txt', 'syllabus.txt'])
+
+    def test_only_searched_organizations_match(self):
+        self.upload('review', 'review.txt')
+        bob = app.test_client()
+        bob.post('/register', data=dict(name='Bob', username='bob',
+                                        password='pass', confirm_pass='pass'))
+        bob.post('/create/organization', data=dict(name='Org Two'))
+        bob.post('/organization/2/upload', data=dict(
+                     course_tag='CS', course_id='101', term='Fall',
+                     year='2013', date='01/02/2013',
+                     file=(io.BytesIO('secret'), 'review2.txt')))
+
+        self.assertEqual(self.search('review'), ['review.txt'])
+        self.assertEqual(self.search('review', (2,)), ['review2.txt'])
+        results = self.client.get('/search?search=review').data
+        self.assertIn('review.txt', results)
+        self.assertNotIn('review2.txt', results)
+
+    def test_index_follows_file_changes(self):
+        self.upload('review', 'review.txt')
+        f = File.query.one()
+        f.file_name = 'summary.txt'
+        index_file(f)
+        db.session.commit()
+        self.assertEqual(self.search('review'), [])
+        self.assertEqual(self.search('summary'), ['summary.txt'])
+
+        db.session.delete(f)
+        db.session.commit()
+        self.assertEqual(SearchTerm.query.count(), 0)
+        self.assertEqual(self.search('summary'), [])
+
+    def test_rebuild_index(self):
+        self.upload('review', 'review.txt')
+        self.upload('syllabus', 'syllabus.txt')
+        SearchTerm.query.delete()
+        db.session.commit()
+        self.assertEqual(self.search('review'), [])
+
+        self.assertEqual(rebuild_index(), 2)
+        self.assertEqual(self.search('review'), ['review.txt'])
+        self.assertEqual(len(self.search('cs101')), 2)
+
+
+class JobTestCase(AppTestCase):
+
+    def setUp(self):
+        AppTestCase.setUp(self)
+        self.saved = dict((name, app.config[name]) for name in
+                          ('JOB_MAX_ATTEMPTS', 'EXTRACT_TIMEOUT',
+                           'UPLOAD_JOBS'))
+        app.config['JOB_MAX_ATTEMPTS'] = 2
+        HANDLERS['broken'] = self.broken
+
+    def tearDown(self):
+        del HANDLERS['broken']
+        app.config.update(self.saved)
+        AppTestCase.tearDown(self)
+
+    def broken(self, job):
+        raise JobError('broken')
+
+    def due_now(self):
+        Job.query.update({'run_at': datetime.utcnow()},
+                         synchronize_session=False)
+        db.session.commit()
+
+    def test_uploads_are_processed(self):
+        self.upload('lecture about eigenvalues')
+        self.assertEqual(File.query.one().status, 'processing')
+        self.assertEqual(Job.query.count(), 2)
+
+        stop, workers = start_workers(1, burst=True)
+        for worker in workers:
+            worker.join(10)
+        self.assertEqual(Job.query.count(), 0)
+        self.assertEqual(File.query.one().status, 'ready')
+        self.assertEqual(len(search_files('eigenvalues', [1])[0]), 1)
+
+    def test_a_job_is_claimed_once(self):
+        app.config['UPLOAD_JOBS'] = ['checksum']
+        self.upload('notes')
+        later = Job('checksum', File.query.one().id,
+                    run_at=datetime.utcnow() + timedelta(hours=1))
+        db.session.add(later)
+        db.session.commit()
+
+        job = claim_job()
+        self.assertEqual((job.state, job.attempts), ('running', 1))
+        self.assertNotEqual(job.id, later.id)
+        self.assertEqual(claim_job(), None)
+
+    def test_failures_back_off_then_fail_the_file(self):
+        app.config['UPLOAD_JOBS'] = ['broken']
+        self.upload('notes')
+
+        before = datetime.utcnow()
+        run_job(claim_job())
+        job = Job.query.one()
+        delay = app.config['JOB_RETRY_DELAY']
+        self.assertEqual((job.state, job.attempts), ('queued', 1))
+        self.assertIn('broken', job.error)
+        self.assertGreaterEqual(job.run_at, before + timedelta(seconds=delay))
+        self.assertEqual(claim_job(), None)
+
+        self.due_now()
+        run_job(claim_job())
+        job = Job.query.one()
+        self.assertEqual((job.state, job.attempts), ('failed', 2))
+        self.assertEqual(File.query.one().status, 'failed')
+        self.assertEqual(claim_job(), None)
+
+    def test_stale_jobs_are_requeued(self):
+        app.config['UPLOAD_JOBS'] = ['checksum', 'extract_text']
+        self.upload('notes')
+        stale, running = claim_job(), claim_job()
+        stale.locked_at = datetime.utcnow() - timedelta(
+                              seconds=app.config['JOB_TIMEOUT'] + 1)
+        stale_id, running_id = stale.id, running.id
+        db.session.commit()
+
+        self.assertEqual(requeue_stale(), 1)
+        self.assertEqual(Job.query.get(stale_id).state, 'queued')
+        self.assertEqual(Job.query.get(running_id).state, 'running')
+
+    def test_slow_pdf_extraction_is_killed(self):
+        app.config['UPLOAD_JOBS'] = ['extract_text']
+        app.config['EXTRACT_TIMEOUT'] = 0.2
+        bin_dir = os.path.join(self.directory, 'bin')
+        os.mkdir(bin_dir)
+        script = os.path.join(bin_dir, 'pdftotext')
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\nexec sleep 30\n')
+        os.chmod(script, 0755)
+        path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + path
+        try:
+            self.upload('%PDF-1.4', 'slides.pdf')
+            started = time.time()
+            run_job(claim_job())
+        finally:
+            os.environ['PATH'] = path
+        self.assertLess(time.time() - started, 10)
+        job = Job.query.one()
+        self.assertEqual((job.state, job.attempts), ('failed', 1))
+        self.assertIn('pdftotext ran longer', job.error)
+        self.assertEqual(File.query.one().status, 'failed')
+
+
+class StatsTestCase(AppTestCase):
+
+    def assertStatsCounted(self):
+        db.session.remove()
+        stats = OrganizationStats.query.get(1)
+        kept = tuple(getattr(stats, f) for f in OrganizationStats.FIELDS)
+        self.assertEqual(kept, OrganizationStats.count()[1])
+        self.assertEqual(reconcile_stats(dry_run=True), 0)
+
+    def invite(self, username):
+        client = app.test_client()
+        client.post('/register', data=dict(name=username, username=username,
+                                           password='pass',
+                                           confirm_pass='pass'))
+        self.client.post('/organization/1/add_member',
+                         data=dict(username=username, rank='1'))
+        self.assertStatsCounted()
+        return client
+
+    def remove(self, username):
+        user_id = OrganizationMember.query.filter(
+                                OrganizationMember.user.has(username=username)
+                            ).one().user_id
+        self.client.post('/organization/1/users/remove',
+                         data=dict(user_id=user_id))
+        self.assertStatsCounted()
+
+    def test_counters_match_a_fresh_count(self):
+        self.assertStatsCounted()
+
+        bob = self.invite('bob')
+        bob.post('/me/invites', data=dict(accept='1'))
+        self.assertStatsCounted()
+
+        carol = self.invite('carol')
+        carol.post('/me/invites', data=dict(deny='1'))
+        self.assertStatsCounted()
+
+        self.invite('dave')
+        self.remove('dave')
+        self.remove('bob')
+
+        self.upload('first', 'a.txt')
+        self.assertStatsCounted()
+        self.upload('first', 'b.txt')
+        self.assertStatsCounted()
+        self.assertEqual(OrganizationStats.query.get(1).file_count, 2)
+
+    def test_missing_row_is_counted_from_scratch(self):
+        self.upload('first', 'a.txt')
+        OrganizationStats.query.delete()
+        db.session.commit()
+
+        self.upload('second', 'b.txt')
+        self.assertStatsCounted()
+        self.assertEqual(OrganizationStats.query.get(1).file_count, 2)
+
+
+class UserCacheTestCase(AppTestCase):
+
+    def set_admin(self, admin):
+        User.query.get(1).admin = admin
+        db.session.commit()
+        db.session.remove()
+
+    def is_admin(self):
+        return 'not an admin' not in self.client.get('/admin/cache').data
+
+    def test_changed_users_are_reloaded(self):
+        self.assertFalse(self.is_admin())
+        self.assertFalse(user_cache.get(1).admin)
+
+        self.set_admin(True)
+        self.assertEqual(user_cache.get(1), None)
+        self.assertTrue(self.is_admin())
+
+        self.set_admin(False)
+        self.assertFalse(self.is_admin())
+
+    def test_deleted_users_are_logged_out(self):
+        self.client.get('/inbox')
+        self.assertNotEqual(user_cache.get(1), None)
+        db.session.delete(User.query.get(1))
+        db.session.commit()
+        self.assertEqual(user_cache.get(1), None)
+        self.assertEqual(self.client.get('/inbox').status_code, 401)
+
+
+class PasswordPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pending = passwords._pending
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        passwords._pending = threading.BoundedSemaphore(1)
+        app.config['PASSWORD_HASH_TIMEOUT'] = 0.1
+        passwords.start_pool()
+
+    def tearDown(self):
+        passwords._pending = self.pending
+        app.config['PASSWORD_HASH_TIMEOUT'] = self.timeout
+
+    def test_timed_out_call_keeps_its_place(self):
+        self.assertRaises(PasswordsBusy, passwords.run, time.sleep, 0.5)
+        # Still running in the pool, so the next call is turned away.
+        began = time.time()
+        self.assertRaises(PasswordsBusy, passwords.run, abs, -1)
+        self.assertLess(time.time() - began, 0.05)
+
+        time.sleep(0.6)
+        self.assertEqual(passwords.run(abs, -1), 1)
+
+    def test_errors_are_raised_and_free_their_place(self):
+        self.assertRaises(ValueError, passwords.run, int, 'x')
+        self.assertEqual(passwords.run(abs, -2), 2)
+
+
+class RenderCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_lru_versions_are_shared_between_processes(self):
+        config = dict(app.config, RENDER_CACHE_BACKEND='lru',
+                      RENDER_CACHE_DIR=self.directory)
+        web, worker = [RenderCache(make_backend(config),
+                                   config['RENDER_CACHE_TIMEOUT'],
+                                   versions=make_versions(config))
+                       for _ in range(2)]
+
+        before = web.version('org:1')
+        self.assertEqual(worker.version('org:1'), before)
+        worker.bump('org:1')
+        self.assertNotEqual(web.version('org:1'), before)
+
+    def test_versions_outnumber_cached_pages(self):
+        config = dict(app.config, RENDER_CACHE_BACKEND='lru',
+                      RENDER_CACHE_DIR=self.directory, RENDER_CACHE_SIZE=2)
+        cache = RenderCache(make_backend(config),
+                            config['RENDER_CACHE_TIMEOUT'],
+                            versions=make_versions(config))
+        for n in range(10):
+            cache.bump('org:{0}'.format(n))
+        self.assertEqual(len(os.listdir(os.path.join(self.directory,
+                                                     'versions'))), 10)
+
+    def test_serve_refuses_per_process_versions(self):
+        import serve
+
+        directory = config.RENDER_CACHE_DIR
+        config.RENDER_CACHE_DIR = None
+        try:
+            self.assertEqual(serve.check_caches(1), None)
+            self.assertNotEqual(serve.check_caches(4), None)
+        finally:
+            config.RENDER_CACHE_DIR = directory
+        self.assertEqual(serve.check_caches(4), None)
+
+
+class FakeS3Error(Exception):
+
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.response = {'Error': {'Code': code}}
+
+
+class FakeS3(object):
+    """
+    The part of a boto3 S3 client S3Storage uses, keeping objects in a dict.
+    """
+    class exceptions(object):
+        ClientError = FakeS3Error
+
+    def __init__(self):
+        self.objects = {}
+
+    def upload_file(self, path, bucket, key):
+        with open(path, 'rb') as f:
+            self.objects[bucket, key] = (f.read(), datetime.utcnow())
+
+    def get_object(self, Bucket, Key, Range=None):
+        if (Bucket, Key) not in self.objects:
+            raise FakeS3Error('NoSuchKey')
+        data = self.objects[Bucket, Key][0]
+        if Range:
+            start, stop = Range[len('bytes='):].split('-')
+            data = data[int(start):int(stop) + 1 if stop else None]
+        return {'Body': io.BytesIO(data)}
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise FakeS3Error('404')
+        data, modified = self.objects[Bucket, Key]
+        return {'ContentLength': len(data), 'LastModified': modified}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+
+class S3StorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeS3()
+        self.storage = S3Storage('bucket', prefix='gtb/', client=self.client)
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write('0123456789')
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_put_read_and_delete(self):
+        self.storage.put('blobs/ab', self.path)
+        self.assertIn(('bucket', 'gtb/blobs/ab'), self.client.objects)
+        self.assertEqual(self.storage.open('blobs/ab').read(), '0123456789')
+        self.assertEqual(''.join(self.storage.stream('blobs/ab', 2, 5)),
+                         '234')
+        self.assertEqual(''.join(self.storage.stream('blobs/ab', 7)), '789')
+        self.assertEqual(self.storage.stat('blobs/ab').size, 10)
+        with self.storage.local_file('blobs/ab') as path:
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), '0123456789')
+
+        self.storage.delete('blobs/ab')
+        self.assertEqual(self.storage.stat('blobs/ab'), None)
+        self.assertRaises(NotStored, self.storage.open, 'blobs/ab')
+
+
+class PageNumberTestCase(unittest.TestCase):
+
+    def page(self, query):
+        with app.test_request_context('/?' + query):
+            return page_number()
+
+    def test_pages_count_from_one(self):
+        self.assertEqual(self.page('page=3'), 3)
+        self.assertEqual(self.page('page=0'), 1)
+        self.assertEqual(self.page('page=-2'), 1)
+        self.assertEqual(self.page('page=last'), 1)
+        self.assertEqual(self.page(''), 1)
+
+
+class RangeTestCase(unittest.TestCase):
+
+    def requested(self, header, size=10):
+        with app.test_request_context(headers={'Range': header}):
+            return requested_range('etag', None, size)
+
+    def test_valid_range(self):
+        self.assertEqual(self.requested('bytes=2-4'), (2, 5))
+
+    def test_suffix_range(self):
+        self.assertEqual(self.requested('bytes=-3'), (7, 10))
+
+    def test_unsatisfiable_range(self):
+        self.assertEqual(self.requested('bytes=20-30'), False)
+
+    def test_no_range(self):
+        with app.test_request_context():
+            self.assertEqual(requested_range('etag', None, 10), None)
+
+
+class ZipStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_archive_reads_back(self):
+        members = {'notes.txt': 'hello world\n' * 1000,
+                   u'CS_101/r\xe9sum\xe9.pdf': os.urandom(70000),
+                   'empty.txt': ''}
+        archive = ZipStream()
+        for i, (name, data) in enumerate(sorted(members.items())):
+            path = self.write(str(i), data)
+            if i % 2:
+                source = lambda path=path: open(path, 'rb')
+            else:
+                source = path
+            archive.add(source, name, len(data), time.time())
+
+        written = ''.join(archive)
+        with zipfile.ZipFile(io.BytesIO(written)) as z:
+            self.assertEqual(z.testzip(), None)
+            self.assertEqual(sorted(z.namelist()), sorted(members))
+            for name, data in members.items():
+                self.assertEqual(z.read(name), data)
+
+    def test_content_length_of_stored_archive(self):
+        path = self.write('a.pdf', 'x' * 100)
+        archive = ZipStream()
+        archive.add(path, 'a.pdf', 100, time.time())
+        self.assertEqual(archive.content_length(), len(''.join(archive)))
+
+    def test_member_of_the_wrong_size_fails(self):
+        path = self.write('a.pdf', 'x' * 100)
+        for size in (99, 101):
+            archive = ZipStream()
+            archive.add(path, 'a.pdf', size, time.time())
+            written = []
+            with self.assertRaises(SizeMismatch):
+                for block in archive:
+                    written.append(block)
+            self.assertLessEqual(len(''.join(written)),
+                                 archive.content_length())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,348 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+from werkzeug.utils import secure_filename
+
+from blobs import (copy_hashed, discard_stored, hash_file, reference_blob,
+                   store_blobs)
+from gtb import app, db
+from jobs import enqueue_file_jobs
+from layout import ensure_staging_dir, staging_path
+from models import File, Folder, OrganizationStats, UploadSession
+from search import index_file
+from storage import BLOCK_SIZE
+from util import allowed_file, get_or_create_folder, get_tag_choices
+
+import os
+import posixpath
+import re
+import uuid
+
+
+"""
+Uploads are written to a staging file first, then put in the blob store
+in the same transaction that commits the File row. Chunked upload sessions
+append to their staging file across requests, so a client on a flaky
+connection can resume from the last offset it got back.
+"""
+
+
+COURSE_FOLDER = re.compile(r'^([A-Za-z]{1,6})[ _-]?([0-9]{1,5})$')
+
+
+class UploadError(Exception):
+    """
+    Raised when an upload request can't be applied to its session.
+    """
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.message = message
+        self.status = status
+
+
+def copy_stream(src, dst, length=None):
+    """
+    Copies at most length bytes (or everything) from src to dst in blocks.
+    Returns the number of bytes copied.
+    """
+    copied = 0
+    while length is None or copied < length:
+        size = BLOCK_SIZE if length is None else min(BLOCK_SIZE,
+                                                     length - copied)
+        block = src.read(size)
+        if not block:
+            break
+        dst.write(block)
+        copied += len(block)
+    return copied
+
+
+def new_staging_path():
+    """
+    Returns a fresh path in the staging folder, creating the folder if needed.
+    """
+    ensure_staging_dir()
+    return staging_path(uuid.uuid4().hex)
+
+
+def receive_file(stream, limit=None):
+    """
+    Streams an uploaded file into a new staging file, hashing it on the way.
+    With limit, stops once more than limit bytes are received, and the size
+    returned is over limit. Returns (staging path, hex digest, size).
+    """
+    staging_path = new_staging_path()
+    with open(staging_path, 'wb') as dst:
+        digest, size = copy_hashed(stream, dst, limit)
+    return staging_path, digest, size
+
+
+def add_file(blob, organization_id, author_id, file_name, term, year,
+                course_tag=None, course_id=None, class_date=None):
+    """
+    Adds a File pointing at blob to the session, in its term folder, counts
+    it towards the folder and queues its post-upload jobs.
+    """
+    folder = get_or_create_folder(organization_id, term, year)
+    return add_files(folder, author_id,
+                     [(blob, dict(file_name=file_name,
+                                  course_tag=course_tag,
+                                  course_id=course_id,
+                                  class_date=class_date))])[0]
+
+
+def add_files(folder, author_id, uploads):
+    """
+    Adds a File to the session for each (blob, fields) in uploads, where
+    fields holds file_name, course_tag, course_id and class_date. All go in
+    one term folder, which is counted up once along with the organization,
+    and are flushed together.
+    """
+    now = datetime.utcnow()
+    files = []
+    for blob, fields in uploads:
+        f = File(author_id=author_id, organization_id=folder.organization_id,
+                 folder_id=folder.id, blob_id=blob.id, **fields)
+        f.upload_date = now
+        db.session.add(f)
+        enqueue_file_jobs(f)
+        files.append(f)
+
+    folder.file_count = Folder.file_count + len(files)
+    folder.last_upload = now
+    db.session.flush()
+    OrganizationStats.add(folder.organization_id, file_count=len(files),
+                          bytes_stored=sum(blob.size for blob, _ in uploads),
+                          last_upload=now)
+    for f in files:
+        index_file(f)
+    return files
+
+
+def commit_file(staging_path, digest, size, organization_id, author_id,
+                term, year, claim=None, **fields):
+    """
+    Stores a fully received staging file and commits the File row for it.
+    Either both happen or neither does. Takes the same arguments as
+    add_file, and claim as for commit_files.
+    """
+    return commit_files([(staging_path, digest, size, fields)],
+                        organization_id, author_id, term, year, claim)[0]
+
+
+def commit_files(staged, organization_id, author_id, term, year,
+                 claim=None):
+    """
+    Stores staged files and commits a File for each in one transaction, so
+    either all of them are added or none are. staged holds (staging path,
+    digest, size, fields) with fields as for add_files. claim, if given, is
+    called first in the same transaction and can raise to commit nothing.
+    The staging files are removed once committed. Returns the Files.
+    """
+    for attempt in (1, 2):
+        stored = []
+        try:
+            if claim is not None:
+                claim()
+            blobs = store_blobs([s[:3] for s in staged], stored)
+            folder = get_or_create_folder(organization_id, term, year)
+            files = add_files(folder, author_id,
+                              [(blob, s[3]) for blob, s in zip(blobs, staged)])
+            db.session.commit()
+            break
+        except Exception as e:
+            db.session.rollback()
+            discard_stored(stored)
+            # Someone else stored some of the same bytes first. Trying again
+            # references their blobs instead.
+            if attempt > 1 or not isinstance(e, IntegrityError):
+                raise
+
+    for staging_path, _, _, _ in staged:
+        if os.path.exists(staging_path):
+            os.remove(staging_path)
+    return files
+
+
+def bulk_upload(entries, organization_id, author_id, term, year,
+                course_tag=None, course_id=None, class_date=None):
+    """
+    Uploads every (path, size, open) in entries to one term folder in a
+    single transaction. size is what the file claims to be, or None, and
+    open returns a stream of it. A file whose folder is named after a
+    course ("CS_101") goes to that course, the rest to course_tag and
+    course_id. Returns a result dict per entry, in order.
+    """
+    tags = set(tag for tag, _ in get_tag_choices())
+    max_files = app.config['BULK_UPLOAD_MAX_FILES']
+    max_bytes = app.config['BULK_UPLOAD_MAX_BYTES']
+    too_big = "At most {0} bytes can be uploaded at once.".format(max_bytes)
+
+    results, staged = [], []
+    total = 0
+    try:
+        for path, declared_size, open_stream in entries:
+            file_name = secure_filename(posixpath.basename(path))
+            course = course_for_path(path, tags) or (course_tag, course_id)
+            if not allowed_file(file_name):
+                results.append({'name': path, 'status': 'skipped',
+                                'message': 'Not an allowed file name.'})
+                continue
+            if not all(course):
+                results.append({'name': path, 'status': 'skipped',
+                                'message': 'No course given.'})
+                continue
+            if len(staged) == max_files:
+                raise UploadError("At most {0} files can be uploaded at "
+                                  "once.".format(max_files), status=413)
+
+            remaining = max_bytes - total
+            if declared_size is not None and declared_size > remaining:
+                raise UploadError(too_big, status=413)
+
+            # Reads no more than one byte past what is left of the budget.
+            staging_path, digest, size = receive_file(open_stream(),
+                                                      remaining)
+            staged.append((staging_path, digest, size,
+                           dict(file_name=file_name,
+                                course_tag=course[0],
+                                course_id=course[1],
+                                class_date=class_date)))
+            total += size
+            if total > max_bytes:
+                raise UploadError(too_big, status=413)
+            results.append({'name': path, 'status': 'created'})
+
+        files = []
+        if staged:
+            files = commit_files(staged, organization_id, author_id, term,
+                                 year)
+    except Exception:
+        for staging_path, _, _, _ in staged:
+            if os.path.exists(staging_path):
+                os.remove(staging_path)
+        raise
+
+    created = iter(files)
+    for result in results:
+        if result['status'] == 'created':
+            f = next(created)
+            result.update(file_id=f.id, course=f.course_folder)
+    return results
+
+
+def course_for_path(path, tags):
+    """
+    Returns (course_tag, course_id) if the folder path is in is named after
+    a course with one of tags, as in the upload folder layout ("CS_101").
+    """
+    match = COURSE_FOLDER.match(posixpath.basename(posixpath.dirname(path)))
+    if match and match.group(1).upper() in tags:
+        return match.group(1).upper(), match.group(2)
+    return None
+
+
+def link_file(blob, **kwargs):
+    """
+    Commits a File for bytes that are already in the blob store.
+    """
+    f = add_file(reference_blob(blob), **kwargs)
+    db.session.commit()
+    return f
+
+
+def write_chunk(upload, offset, stream, length):
+    """
+    Writes length bytes from stream into the session's staging file at
+    offset. Re-sending bytes we already have is allowed, leaving a gap is not.
+    Returns the new offset.
+    """
+    current = upload.offset
+    if offset > current:
+        raise UploadError("Expected a chunk at offset {0}.".format(current),
+                          status=409)
+    if length is None:
+        raise UploadError("Chunks need a Content-Length.", status=411)
+    if length > app.config['UPLOAD_CHUNK_SIZE']:
+        raise UploadError("Chunks can be at most {0} bytes.".format(
+                                app.config['UPLOAD_CHUNK_SIZE']), status=413)
+    if offset + length > upload.size:
+        raise UploadError("Chunk runs past the end of the file.", status=416)
+
+    path = upload.staging_path
+    ensure_staging_dir()
+
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as dst:
+        dst.seek(offset)
+        written = copy_stream(stream, dst, length)
+
+    if written != length:
+        raise UploadError("Chunk was cut short after {0} bytes.".format(
+                                written), status=400)
+    return max(current, offset + written)
+
+
+def finalize_session(upload):
+    """
+    Commits the File for a fully received session and removes the session,
+    in one transaction. When two requests finalize the same session, only
+    the one that deletes the session row adds a File.
+    """
+    if not upload.complete:
+        raise UploadError("Only {0} of {1} bytes have been received.".format(
+                                upload.offset, upload.size), status=409)
+
+    try:
+        digest, size = hash_file(upload.staging_path)
+    except (IOError, OSError):
+        # Another request finalized it and removed the staging file.
+        raise UploadError("This upload has already been finalized.",
+                          status=409)
+    if upload.sha256 and upload.sha256 != digest:
+        raise UploadError("The received bytes don't match the given hash.",
+                          status=422)
+
+    def claim():
+        deleted = UploadSession.query.filter_by(
+                                    id=upload.id
+                                ).delete(synchronize_session=False)
+        if deleted != 1:
+            raise UploadError("This upload has already been finalized.",
+                              status=409)
+
+    return commit_file(upload.staging_path, digest, size,
+                       claim=claim,
+                       organization_id=upload.organization_id,
+                       author_id=upload.author_id,
+                       file_name=upload.file_name,
+                       term=upload.term,
+                       year=upload.year,
+                       course_tag=upload.course_tag,
+                       course_id=upload.course_id,
+                       class_date=upload.class_date)
+
+
+def discard_session(upload):
+    """
+    Removes a session and whatever bytes it has received.
+    """
+    if os.path.exists(upload.staging_path):
+        os.remove(upload.staging_path)
+    db.session.delete(upload)
+    db.session.commit()
+
+
+def expire_sessions(max_age=None):
+    """
+    Discards sessions older than max_age seconds (UPLOAD_SESSION_TTL by
+    default). Returns how many were removed.
+    """
+    if max_age is None:
+        max_age = app.config['UPLOAD_SESSION_TTL']
+    cutoff = datetime.utcnow() - timedelta(seconds=max_age)
+    stale = UploadSession.query.filter(
+                                UploadSession.created_at < cutoff
+                            ).all()
+    for upload in stale:
+        discard_session(upload)
+    return len(stale)
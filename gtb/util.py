@@ -1,12 +1,24 @@
+from flask import abort, g, has_request_context, render_template, request
 from flask.ext.login import current_user
+from sqlalchemy import event
 
+from cache import TTLCache
 from constants import CURRENT_YEAR
 from gtb import app, db, login_manager
-from models import Category, OrganizationMember, User
+from models import Category, Folder, OrganizationMember, User
 
+from datetime import datetime
 from functools import wraps
 
 
+# user id -> detached User, merged into each request's session by load_user.
+user_cache = TTLCache(app.config['USER_CACHE_TTL'],
+                      max_size=app.config['USER_CACHE_SIZE'])
+
+# Select field choices that come from the database.
+choices_cache = TTLCache(app.config['CHOICES_CACHE_TTL'])
+
+
 """
 Decorators
 """
@@ -62,20 +74,116 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.')
 
 
-def create_dirs(folder, f=None):
+def page_number(values=None):
     """
-    Creates directiories for either JUST an organization, or
-    within an organization for a single file being uploaded.
+    Returns the ?page= of the request, or of values, counting from 1.
+    Anything below 1 or not a number is page 1.
     """
-    path = app.config['UPLOAD_PATH'] + folder.organization_id + '/'
-    if not folder.top:
-        path += folder.name.replace(' ', '_') + '/'
-        if f:
-            path += f.course_tag + '_' + f.course_id + '/'
-    if not os.exists(path):
-        os.makedirs(path)
+    values = request.args if values is None else values
+    return max(values.get('page', 1, type=int), 1)
+
+
+def parse_course(term, folder):
+    """
+    Returns (term, year, course tag, course id) for a term like "Fall 2013"
+    and a course folder like "CS 101" taken from a URL, or aborts with a
+    404 if they don't look like that.
+    """
+    try:
+        term_name, year = term.split(" ")
+        course_tag, course_id = folder.split(" ")
+        return term_name, int(year), course_tag, int(course_id)
+    except ValueError:
+        abort(404)
+
+
+def get_or_create_folder(organization_id, term, year):
+    """
+    Returns the term folder for an organization, adding it to the session
+    if it doesn't exist yet. The caller is responsible for committing.
+    """
+    folder = Folder.query.filter_by(
+                            organization_id=organization_id,
+                            term=term,
+                            year=year
+                        ).first()
+    if not folder:
+        folder = Folder(organization_id=organization_id,
+                        top=False,
+                        term=term,
+                        year=year)
+        db.session.add(folder)
+        db.session.flush()
+    return folder
+
+
+@app.template_filter('date')
+def format_date(value, fmt="%b %d, %Y"):
+    """
+    Formats a datetime for display, e.g. {{ msg.sent_at|date }}.
+    """
+    return value.strftime(fmt) if value else ""
+
+
+@app.template_filter('size')
+def format_size(value):
+    """
+    Formats a byte count for display, e.g. {{ stats.bytes_stored|size }}.
+    """
+    value = value or 0
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if value < 1024:
+            break
+        value /= 1024.0
     else:
-        print "Path exists at: {0}".format(path)
+        unit = 'TB'
+    if unit == 'bytes':
+        return '{0} bytes'.format(int(value))
+    return '{0:.1f} {1}'.format(value, unit)
+
+
+def get_memberships(user_id):
+    """
+    Returns a dict of organization id -> accepted for every organization
+    the user is a member of or invited to. Loaded at most once per request,
+    and never cached across requests since it decides access.
+    """
+    per_request = getattr(g, 'memberships', None)
+    if per_request is None:
+        per_request = g.memberships = {}
+    if user_id in per_request:
+        return per_request[user_id]
+
+    memberships = dict(db.session.query(
+                                    OrganizationMember.organization_id,
+                                    OrganizationMember.accepted
+                                ).filter_by(
+                                    user_id=user_id
+                                ).all())
+    per_request[user_id] = memberships
+    return memberships
+
+
+def get_organization_ids(user_id):
+    """
+    Returns the ids of the organizations the user has accepted membership in.
+    """
+    return sorted(org_id for org_id, accepted in
+                    get_memberships(user_id).items() if accepted)
+
+
+def get_tag_choices():
+    """
+    Returns the (value, label) choices for course tags. Loaded on first use
+    and shared by all requests until CHOICES_CACHE_TTL runs out or a
+    Category changes.
+    """
+    choices = choices_cache.get('tags')
+    if choices is None:
+        tags = get_tags()
+        choices = zip(tags, tags)
+        choices_cache.set('tags', choices)
+    return choices
 
 
 def get_tags():
@@ -101,6 +209,13 @@ def get_user():
     return None
 
 
+def get_year_choices():
+    """
+    Returns the (value, label) choices for years, newest first.
+    """
+    return YEAR_CHOICES
+
+
 def get_year_range():
     """
     Returns the year range for 1950 to CURRENT_YEAR.
@@ -108,9 +223,64 @@ def get_year_range():
     return range(1850, CURRENT_YEAR + 1)
 
 
+YEAR_CHOICES = [(str(year), str(year)) for year in get_year_range()[::-1]]
+
+
+def no_perms(msg):
+    """
+    Renders the error message page, for the decorators above.
+    """
+    return render_template("message.html", msg=msg)
+
+
+def parse_date(date):
+    """
+    Parses a MM/DD/YYYY date as sent by the datepicker.
+    Returns None if it isn't one.
+    """
+    try:
+        month, day, year = map(int, date.split('/'))
+        return datetime(year, month, day, 0, 0, 0)
+    except (AttributeError, ValueError):
+        return None
+
+
 @login_manager.user_loader
 def load_user(userid):
-    return User.query.filter_by(id=userid).first()
+    """
+    Returns the logged in user. Users are cached for USER_CACHE_TTL seconds
+    and merged into the session without a query, so most requests don't
+    hit the database to find out who is asking.
+    """
+    try:
+        userid = int(userid)
+    except (TypeError, ValueError):
+        return None
+
+    user = user_cache.get(userid)
+    if user is None:
+        user = User.query.filter_by(id=userid).first()
+        if user is None:
+            return None
+        # Keep a detached copy: this session's will be expired by commits.
+        db.session.expunge(user)
+        user_cache.set(userid, user)
+    return db.session.merge(user, load=False)
+
+
+def invalidate_user(user_id):
+    """
+    Drops the cached copy of a user.
+    """
+    user_cache.delete(user_id)
+
+
+def invalidate_memberships(user_id):
+    """
+    Drops the memberships of a user loaded in this request.
+    """
+    if has_request_context():
+        getattr(g, 'memberships', {}).pop(user_id, None)
 
 
 def member_of(org_id):
@@ -118,8 +288,27 @@ def member_of(org_id):
     Returns if the current user is a member of the organization with
     an id of org_id.
     """
-    return db.session.query(OrganizationMember).filter_by(
-                                        user_id=current_user.id,
-                                        organization_id=org_id,
-                                        accepted=True
-                                ).first()
+    return get_memberships(current_user.id).get(org_id) is True
+
+
+@event.listens_for(Category, 'after_insert')
+@event.listens_for(Category, 'after_update')
+@event.listens_for(Category, 'after_delete')
+def category_changed(mapper, connection, category):
+    choices_cache.delete('tags')
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def user_changed(mapper, connection, user):
+    invalidate_user(user.id)
+
+
+@event.listens_for(OrganizationMember, 'after_insert')
+@event.listens_for(OrganizationMember, 'after_update')
+@event.listens_for(OrganizationMember, 'after_delete')
+def membership_changed(mapper, connection, member):
+    """
+    Invites, accept(), deny() and removals all go through here.
+    """
+    invalidate_memberships(member.user_id)
@@ -0,0 +1,278 @@
+from contextlib import closing
+
+from storage import BLOCK_SIZE
+
+import struct
+import time
+import zlib
+
+
+"""
+Writes a zip archive as a stream of byte strings, reading each member from
+disk or storage in blocks as it goes, so no temp file is needed and memory
+stays flat however big the archive gets. Each member's CRC and sizes follow
+its data in a data descriptor, and zip64 records are written for members
+over 4 GiB and archives with too many members for the classic format.
+"""
+
+
+# Values that don't fit the classic fields are written as these, with the
+# real value in a zip64 field.
+MAX_32 = 0xFFFFFFFF
+MAX_16 = 0xFFFF
+ZIP64_LIMIT = MAX_32
+ZIP64_COUNT_LIMIT = MAX_16
+
+STORED = 0
+DEFLATED = 8
+
+# Data descriptor follows the data; names are UTF-8.
+FLAGS = 0x08
+FLAG_UTF8 = 0x800
+
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+DATA_DESCRIPTOR = struct.Struct('<4s3L')
+DATA_DESCRIPTOR64 = struct.Struct('<4sL2Q')
+CENTRAL_HEADER = struct.Struct('<4s6H3L5H2L')
+END_RECORD = struct.Struct('<4s4H2LH')
+END_RECORD64 = struct.Struct('<4sQ2H2L4Q')
+END_LOCATOR64 = struct.Struct('<4sLQL')
+
+# Formats that are compressed already; deflating them again only costs CPU.
+STORED_EXTENSIONS = set(['zip', 'gz', 'tgz', 'bz2', 'xz', '7z', 'rar',
+                         'jpg', 'jpeg', 'png', 'gif', 'mp3', 'mp4', 'm4a',
+                         'mov', 'avi', 'pdf', 'docx', 'xlsx', 'pptx', 'odt',
+                         'ods', 'odp', 'epub'])
+
+
+class SizeMismatch(Exception):
+    """
+    Raised when a member's data isn't the size it was added with. Its
+    headers, and the archive's length if that was sent, are wrong by then.
+    """
+    pass
+
+
+def compression_for(name):
+    """
+    Returns STORED for names of already compressed formats, else DEFLATED.
+    """
+    ext = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+    return STORED if ext in STORED_EXTENSIONS else DEFLATED
+
+
+def dos_time(timestamp):
+    """
+    Returns the (date, time) pair zip headers use for a unix timestamp.
+    """
+    t = time.localtime(timestamp)
+    year = max(t.tm_year, 1980)
+    return (((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+            (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2))
+
+
+def max_compressed_size(size):
+    """
+    An upper bound on what deflate can grow size bytes of incompressible
+    data to, the same bound zlib's compressBound gives.
+    """
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 13
+
+
+class ZipMember(object):
+    """
+    A file to be written into the archive as name. source is a path on
+    disk, or a callable returning a readable file object.
+    """
+    def __init__(self, source, name, size, mtime, compression=None):
+        self.source = source
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.compression = (compression_for(name) if compression is None
+                            else compression)
+        self.encoded_name = name.encode('utf-8')
+        self.flags = FLAGS
+        if self.encoded_name != name.encode('ascii', 'replace'):
+            self.flags |= FLAG_UTF8
+
+        # Whether sizes need 8 bytes has to be known before the data is.
+        bound = (self.size if self.compression == STORED
+                 else max_compressed_size(self.size))
+        self.zip64 = bound >= ZIP64_LIMIT
+
+        self.offset = None
+        self.crc = 0
+        self.compressed_size = 0
+        self.uncompressed_size = 0
+
+    def local_header(self):
+        date, clock = dos_time(self.mtime)
+        extra = ''
+        sizes = 0
+        if self.zip64:
+            # Real sizes are in the data descriptor; these are placeholders.
+            extra = struct.pack('<2H2Q', 1, 16, 0, 0)
+            sizes = MAX_32
+        return LOCAL_HEADER.pack('PK\x03\x04', 45 if self.zip64 else 20,
+                                 self.flags, self.compression, clock, date,
+                                 0, sizes, sizes, len(self.encoded_name),
+                                 len(extra)) + self.encoded_name + extra
+
+    def data(self):
+        """
+        Yields the member's data, compressed if it is to be, and records
+        its CRC and sizes. Raises SizeMismatch once the data turns out not
+        to be size bytes, before yielding any past it.
+        """
+        compressor = None
+        if self.compression == DEFLATED:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                          zlib.DEFLATED, -15)
+        crc = 0
+        read = 0
+        size = 0
+        if callable(self.source):
+            opened = closing(self.source())
+        else:
+            opened = open(self.source, 'rb')
+        with opened as src:
+            while True:
+                block = src.read(BLOCK_SIZE)
+                if not block:
+                    break
+                read += len(block)
+                if read > self.size:
+                    raise SizeMismatch(self.mismatch(read))
+                crc = zlib.crc32(block, crc)
+                if compressor:
+                    block = compressor.compress(block)
+                size += len(block)
+                if block:
+                    yield block
+        if read != self.size:
+            raise SizeMismatch(self.mismatch(read))
+        if compressor:
+            block = compressor.flush()
+            size += len(block)
+            yield block
+        self.crc = crc & 0xFFFFFFFF
+        self.compressed_size = size
+        self.uncompressed_size = read
+
+    def mismatch(self, read):
+        return "{0} was added as {1} bytes, but {2} were read.".format(
+                    self.name.encode('utf-8'), self.size, read)
+
+    def data_descriptor(self):
+        if self.zip64:
+            return DATA_DESCRIPTOR64.pack('PK\x07\x08', self.crc,
+                                          self.compressed_size,
+                                          self.uncompressed_size)
+        return DATA_DESCRIPTOR.pack('PK\x07\x08', self.crc,
+                                    self.compressed_size,
+                                    self.uncompressed_size)
+
+    def central_header(self):
+        date, clock = dos_time(self.mtime)
+        fields = []
+        size, compressed_size, offset = (self.size, self.compressed_size,
+                                          self.offset)
+        if self.zip64 or size >= ZIP64_LIMIT:
+            fields += [size, compressed_size]
+            size = compressed_size = MAX_32
+        if offset >= ZIP64_LIMIT:
+            fields.append(offset)
+            offset = MAX_32
+        extra = ''
+        if fields:
+            extra = struct.pack('<2H', 1, 8 * len(fields)) + \
+                    struct.pack('<{0}Q'.format(len(fields)), *fields)
+        version = 45 if fields else 20
+        # Made on Unix, so the external attributes hold a file mode.
+        return CENTRAL_HEADER.pack('PK\x01\x02', (3 << 8) | version, version,
+                                   self.flags, self.compression, clock, date,
+                                   self.crc, compressed_size, size,
+                                   len(self.encoded_name), len(extra), 0, 0,
+                                   0, 0o100644 << 16,
+                                   offset) + self.encoded_name + extra
+
+
+class ZipStream(object):
+    """
+    A zip archive of files that can be iterated over as it is written,
+    e.g. as the body of a response.
+    """
+    def __init__(self):
+        self.members = []
+
+    def add(self, source, name, size, mtime, compression=None):
+        """
+        Adds the file at source (a path, or a callable opening the file) as
+        name. size has to be the file's size, and mtime its modification
+        time as a unix timestamp.
+        """
+        self.members.append(ZipMember(source, name, size, mtime,
+                                      compression))
+
+    def content_length(self):
+        """
+        Returns the length of the archive if it is known up front, which is
+        when every member is stored uncompressed. Otherwise None.
+        """
+        if any(m.compression != STORED for m in self.members):
+            return None
+        length = 0
+        offsets = []
+        for m in self.members:
+            offsets.append(length)
+            length += (len(m.local_header()) + m.size +
+                       (DATA_DESCRIPTOR64 if m.zip64
+                        else DATA_DESCRIPTOR).size)
+        directory_offset = length
+        for m, offset in zip(self.members, offsets):
+            m.offset, m.compressed_size = offset, m.size
+            length += len(m.central_header())
+        return length + len(self.end_records(directory_offset,
+                                             length - directory_offset))
+
+    def end_records(self, directory_offset, directory_size):
+        """
+        Returns the end of central directory record, preceded by the zip64
+        record and locator when the classic one can't hold the values.
+        """
+        count = len(self.members)
+        records = ''
+        if (count >= ZIP64_COUNT_LIMIT or directory_offset >= ZIP64_LIMIT or
+            directory_size >= ZIP64_LIMIT):
+            end64_offset = directory_offset + directory_size
+            records += END_RECORD64.pack('PK\x06\x06', 44, 45, 45, 0, 0,
+                                         count, count, directory_size,
+                                         directory_offset)
+            records += END_LOCATOR64.pack('PK\x06\x07', 0, end64_offset, 1)
+            count = min(count, MAX_16)
+            directory_offset = min(directory_offset, MAX_32)
+            directory_size = min(directory_size, MAX_32)
+        return records + END_RECORD.pack('PK\x05\x06', 0, 0, count, count,
+                                         directory_size, directory_offset, 0)
+
+    def __iter__(self):
+        offset = 0
+        for m in self.members:
+            m.offset = offset
+            header = m.local_header()
+            yield header
+            offset += len(header)
+            for block in m.data():
+                offset += len(block)
+                yield block
+            descriptor = m.data_descriptor()
+            offset += len(descriptor)
+            yield descriptor
+
+        directory_offset = offset
+        for m in self.members:
+            header = m.central_header()
+            offset += len(header)
+            yield header
+        yield self.end_records(directory_offset, offset - directory_offset)
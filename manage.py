@@ -0,0 +1,98 @@
+import sys
+import argparse
+
+sys.dont_write_bytecode = True
+from gtb import app
+
+
+def purge_uploads(args):
+    from gtb.uploads import expire_sessions
+    removed = expire_sessions(args.max_age)
+    print "Removed {0} stale upload session(s).".format(removed)
+
+
+def reindex(args):
+    from gtb.search import rebuild_index
+    count = rebuild_index()
+    print "Indexed {0} file(s).".format(count)
+    if args.content:
+        from gtb.jobs import enqueue_all
+        queued = enqueue_all('extract_text')
+        print "Queued text extraction for {0} file(s).".format(queued)
+
+
+def migrate_layout(args):
+    from gtb.blobs import adopt_legacy_files
+    from gtb.layout import blob_dir, remove_empty_dirs
+    adopted, missing = adopt_legacy_files(args.batch_size, args.dry_run)
+    print "{0} {1} file(s) into the blob store.".format(
+            "Would move" if args.dry_run else "Moved", adopted)
+    if missing:
+        print "{0} file(s) were not found on disk.".format(missing)
+    if not args.dry_run:
+        removed = remove_empty_dirs(app.config['UPLOAD_FOLDER'],
+                                    keep=[blob_dir(),
+                                          app.config['UPLOAD_STAGING_FOLDER']])
+        print "Removed {0} empty folder(s).".format(removed)
+
+
+def reconcile_stats(args):
+    from gtb.stats import reconcile_stats
+    fixed = reconcile_stats(args.dry_run)
+    print "{0} {1} organization stats row(s).".format(
+            "Would fix" if args.dry_run else "Fixed", fixed)
+
+
+def worker(args):
+    from gtb.jobs import start_workers
+    threads = args.threads or app.config['JOB_WORKERS']
+    stop, workers = start_workers(threads, burst=args.burst)
+    try:
+        while any(w.is_alive() for w in workers):
+            for w in workers:
+                w.join(1)
+    except KeyboardInterrupt:
+        stop.set()
+        for w in workers:
+            w.join()
+
+
+parser = argparse.ArgumentParser()
+subparsers = parser.add_subparsers()
+
+purge = subparsers.add_parser("purge-uploads",
+                              help="discard abandoned chunked uploads")
+purge.add_argument("--max-age", help="age in seconds (UPLOAD_SESSION_TTL)",
+                   default=None, type=int)
+purge.set_defaults(func=purge_uploads)
+
+index = subparsers.add_parser("reindex",
+                              help="rebuild the search index from scratch")
+index.add_argument("--content", help="also queue text extraction jobs",
+                   action="store_true")
+index.set_defaults(func=reindex)
+
+layout = subparsers.add_parser("migrate-layout",
+                               help="move files from the old per-course "
+                                    "folders into the blob store")
+layout.add_argument("--batch-size", help="files per transaction",
+                    default=100, type=int)
+layout.add_argument("--dry-run", help="only count what would be moved",
+                    action="store_true")
+layout.set_defaults(func=migrate_layout)
+
+stats = subparsers.add_parser("reconcile-stats",
+                              help="recount the per-organization stats")
+stats.add_argument("--dry-run", help="only count the rows that are wrong",
+                   action="store_true")
+stats.set_defaults(func=reconcile_stats)
+
+work = subparsers.add_parser("worker", help="run background jobs")
+work.add_argument("--threads", help="worker threads (JOB_WORKERS)",
+                  default=None, type=int)
+work.add_argument("--burst", help="exit once no job is due",
+                  action="store_true")
+work.set_defaults(func=worker)
+
+args = parser.parse_args()
+args.func(args)
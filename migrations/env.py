@@ -3,6 +3,12 @@ from alembic import context
 from sqlalchemy import engine_from_config, pool
 from logging.config import fileConfig
 
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gtb import app, db
+
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 config = context.config
@@ -11,11 +17,11 @@ config = context.config
 # This line sets up loggers basically.
 fileConfig(config.config_file_name)
 
-# add your model's MetaData object here
-# for 'autogenerate' support
-# from myapp import mymodel
-# target_metadata = mymodel.Base.metadata
-target_metadata = None
+# Migrate the database the app is configured for, using the app's models
+# for 'autogenerate' support.
+config.set_main_option('sqlalchemy.url',
+                       app.config['SQLALCHEMY_DATABASE_URI'])
+target_metadata = db.metadata
 
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
@@ -0,0 +1,105 @@
+"""baseline schema
+
+Revision ID: 2b7c9e41d5a3
+Revises: None
+Create Date: 2014-03-02 14:10:27.118904
+
+Databases created with create_db.py before migrations existed already have
+these tables; mark them with 'alembic stamp 2b7c9e41d5a3' and upgrade.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2b7c9e41d5a3'
+down_revision = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('categories',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('tag', sa.String(length=6), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('conversations',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('sender_id', sa.Integer(), nullable=True),
+        sa.Column('receiver_id', sa.Integer(), nullable=True),
+        sa.Column('subject', sa.String(length=100), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('users',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('username', sa.String(length=20), nullable=True),
+        sa.Column('name', sa.String(length=20), nullable=True),
+        sa.Column('password', sa.String(length=20), nullable=True),
+        sa.Column('admin', sa.Boolean(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('username')
+    )
+    op.create_table('organizations',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=255), nullable=True),
+        sa.Column('admin_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['admin_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('folders',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('organization_id', sa.Integer(), nullable=True),
+        sa.Column('top', sa.Boolean(), nullable=True),
+        sa.Column('term', sa.Enum('Fall', 'Winter', 'Spring', 'Summer'),
+                  nullable=True),
+        sa.Column('year', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['organization_id'], ['organizations.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('files',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('file_name', sa.String(length=255), nullable=True),
+        sa.Column('author_id', sa.Integer(), nullable=True),
+        sa.Column('organization_id', sa.Integer(), nullable=True),
+        sa.Column('folder_id', sa.String(), nullable=True),
+        sa.Column('course_tag', sa.String(length=6), nullable=True),
+        sa.Column('course_id', sa.Integer(), nullable=True),
+        sa.Column('class_date', sa.DateTime(), nullable=True),
+        sa.Column('upload_date', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['author_id'], ['users.id']),
+        sa.ForeignKeyConstraint(['folder_id'], ['folders.id']),
+        sa.ForeignKeyConstraint(['organization_id'], ['organizations.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('messages',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('conversation_id', sa.Integer(), nullable=True),
+        sa.Column('sender_id', sa.Integer(), nullable=True),
+        sa.Column('content', sa.String(length=511), nullable=True),
+        sa.Column('sent_at', sa.DateTime(), nullable=True),
+        sa.Column('read', sa.Boolean(), nullable=True),
+        sa.ForeignKeyConstraint(['conversation_id'], ['conversations.id']),
+        sa.ForeignKeyConstraint(['sender_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('organization_members',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('organization_id', sa.Integer(), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('accepted', sa.Boolean(), nullable=True),
+        sa.Column('rank', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['organization_id'], ['organizations.id']),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('organization_members')
+    op.drop_table('messages')
+    op.drop_table('files')
+    op.drop_table('folders')
+    op.drop_table('organizations')
+    op.drop_table('users')
+    op.drop_table('conversations')
+    op.drop_table('categories')
@@ -0,0 +1,73 @@
+"""upload sessions, blob store and search index
+
+Revision ID: 4e18a6f0c2d9
+Revises: 2b7c9e41d5a3
+Create Date: 2014-03-09 11:42:03.550271
+
+After upgrading an existing database, run 'python manage.py reindex' to
+index the files that were uploaded before the search index existed.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4e18a6f0c2d9'
+down_revision = '2b7c9e41d5a3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('blobs',
+        sa.Column('id', sa.String(length=64), nullable=False),
+        sa.Column('size', sa.BigInteger(), nullable=True),
+        sa.Column('refcount', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.add_column('files',
+        sa.Column('blob_id', sa.String(length=64), nullable=True)
+    )
+    # SQLite can't add constraints to an existing table.
+    if op.get_bind().dialect.name != 'sqlite':
+        op.create_foreign_key('fk_files_blob_id', 'files', 'blobs',
+                              ['blob_id'], ['id'])
+    op.create_table('upload_sessions',
+        sa.Column('id', sa.String(length=32), nullable=False),
+        sa.Column('author_id', sa.Integer(), nullable=True),
+        sa.Column('organization_id', sa.Integer(), nullable=True),
+        sa.Column('file_name', sa.String(length=255), nullable=True),
+        sa.Column('size', sa.BigInteger(), nullable=True),
+        sa.Column('term', sa.Enum('Fall', 'Winter', 'Spring', 'Summer'),
+                  nullable=True),
+        sa.Column('year', sa.Integer(), nullable=True),
+        sa.Column('course_tag', sa.String(length=6), nullable=True),
+        sa.Column('course_id', sa.Integer(), nullable=True),
+        sa.Column('class_date', sa.DateTime(), nullable=True),
+        sa.Column('sha256', sa.String(length=64), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['author_id'], ['users.id']),
+        sa.ForeignKeyConstraint(['organization_id'], ['organizations.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('search_terms',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('term', sa.String(length=64), nullable=True),
+        sa.Column('file_id', sa.Integer(), nullable=True),
+        sa.Column('organization_id', sa.Integer(), nullable=True),
+        sa.Column('weight', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['file_id'], ['files.id']),
+        sa.ForeignKeyConstraint(['organization_id'], ['organizations.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_search_terms_term', 'search_terms', ['term'])
+
+
+def downgrade():
+    op.drop_index('ix_search_terms_term', 'search_terms')
+    op.drop_table('search_terms')
+    op.drop_table('upload_sessions')
+    if op.get_bind().dialect.name != 'sqlite':
+        op.drop_constraint('fk_files_blob_id', 'files', type='foreignkey')
+    op.drop_column('files', 'blob_id')
+    op.drop_table('blobs')
@@ -0,0 +1,55 @@
+"""indexes for hot lookup columns
+
+Revision ID: 5f3d2a7b8c61
+Revises: 4e18a6f0c2d9
+Create Date: 2014-03-16 19:05:48.302117
+
+Each index matches the filter and sort columns of a query on a hot path;
+see bench/indexes.py for the query plans before and after.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5f3d2a7b8c61'
+down_revision = '4e18a6f0c2d9'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+INDEXES = [
+    ('ix_conversations_sender_receiver', 'conversations',
+        ['sender_id', 'receiver_id']),
+    ('ix_conversations_receiver_sender', 'conversations',
+        ['receiver_id', 'sender_id']),
+    ('ix_files_organization_upload_date', 'files',
+        ['organization_id', 'upload_date']),
+    ('ix_files_organization_course', 'files',
+        ['organization_id', 'course_tag', 'course_id', 'upload_date']),
+    ('ix_files_folder_course', 'files',
+        ['folder_id', 'course_tag', 'course_id']),
+    ('ix_files_blob_id', 'files', ['blob_id']),
+    ('ix_folders_organization_term_year', 'folders',
+        ['organization_id', 'term', 'year']),
+    ('ix_messages_conversation_id', 'messages', ['conversation_id', 'id']),
+    ('ix_organization_members_user', 'organization_members',
+        ['user_id', 'accepted', 'organization_id']),
+    ('ix_organization_members_organization', 'organization_members',
+        ['organization_id', 'accepted', 'user_id']),
+    ('ix_search_terms_term_organization', 'search_terms',
+        ['term', 'organization_id', 'file_id', 'weight']),
+    ('ix_search_terms_file_id', 'search_terms', ['file_id']),
+]
+
+
+def upgrade():
+    # Superseded by ix_search_terms_term_organization, which leads with term.
+    op.drop_index('ix_search_terms_term', 'search_terms')
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table)
+    op.create_index('ix_search_terms_term', 'search_terms', ['term'])
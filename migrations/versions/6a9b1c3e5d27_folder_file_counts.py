@@ -0,0 +1,35 @@
+"""per-folder file counts and last upload time
+
+Revision ID: 6a9b1c3e5d27
+Revises: 5f3d2a7b8c61
+Create Date: 2014-03-23 16:27:51.904113
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a9b1c3e5d27'
+down_revision = '5f3d2a7b8c61'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('folders',
+        sa.Column('file_count', sa.Integer(), nullable=True)
+    )
+    op.add_column('folders',
+        sa.Column('last_upload', sa.DateTime(), nullable=True)
+    )
+    op.execute(
+        "UPDATE folders SET "
+        "file_count = (SELECT count(*) FROM files "
+        "              WHERE files.folder_id = folders.id), "
+        "last_upload = (SELECT max(upload_date) FROM files "
+        "               WHERE files.folder_id = folders.id)"
+    )
+
+
+def downgrade():
+    op.drop_column('folders', 'last_upload')
+    op.drop_column('folders', 'file_count')
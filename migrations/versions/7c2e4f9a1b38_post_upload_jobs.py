@@ -0,0 +1,52 @@
+"""post-upload job queue and file status
+
+Revision ID: 7c2e4f9a1b38
+Revises: 6a9b1c3e5d27
+Create Date: 2014-03-30 14:05:12.417930
+
+Files uploaded before this revision are marked ready. Run
+'python manage.py reindex --content' to queue text extraction for them.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c2e4f9a1b38'
+down_revision = '6a9b1c3e5d27'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # SQLite can't add the CHECK constraint an Enum brings with it.
+    if op.get_bind().dialect.name != 'sqlite':
+        status = sa.Enum('processing', 'ready', 'failed')
+    else:
+        status = sa.String(length=10)
+    op.add_column('files',
+        sa.Column('status', status, nullable=True)
+    )
+    op.execute("UPDATE files SET status = 'ready'")
+    op.create_table('jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(length=32), nullable=True),
+        sa.Column('file_id', sa.Integer(), nullable=True),
+        sa.Column('state', sa.Enum('queued', 'running', 'failed'),
+                  nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=True),
+        sa.Column('run_at', sa.DateTime(), nullable=True),
+        sa.Column('locked_at', sa.DateTime(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['file_id'], ['files.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_jobs_state_run_at', 'jobs', ['state', 'run_at'])
+    op.create_index('ix_jobs_file_id', 'jobs', ['file_id'])
+
+
+def downgrade():
+    op.drop_index('ix_jobs_file_id', 'jobs')
+    op.drop_index('ix_jobs_state_run_at', 'jobs')
+    op.drop_table('jobs')
+    op.drop_column('files', 'status')
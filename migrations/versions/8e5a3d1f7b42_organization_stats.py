@@ -0,0 +1,48 @@
+"""per-organization stats
+
+Revision ID: 8e5a3d1f7b42
+Revises: 7c2e4f9a1b38
+Create Date: 2014-04-06 11:42:37.208415
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8e5a3d1f7b42'
+down_revision = '7c2e4f9a1b38'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('organization_stats',
+        sa.Column('organization_id', sa.Integer(), nullable=False),
+        sa.Column('member_count', sa.Integer(), nullable=True),
+        sa.Column('pending_invites', sa.Integer(), nullable=True),
+        sa.Column('file_count', sa.Integer(), nullable=True),
+        sa.Column('bytes_stored', sa.BigInteger(), nullable=True),
+        sa.Column('last_upload', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['organization_id'], ['organizations.id']),
+        sa.PrimaryKeyConstraint('organization_id')
+    )
+    op.execute(
+        "INSERT INTO organization_stats (organization_id, member_count, "
+        "pending_invites, file_count, bytes_stored, last_upload) "
+        "SELECT organizations.id, "
+        "(SELECT count(*) FROM organization_members m "
+        " WHERE m.organization_id = organizations.id AND m.accepted = 1), "
+        "(SELECT count(*) FROM organization_members m "
+        " WHERE m.organization_id = organizations.id AND m.accepted = 0), "
+        "(SELECT count(*) FROM files f "
+        " WHERE f.organization_id = organizations.id), "
+        "(SELECT coalesce(sum(b.size), 0) FROM files f "
+        " JOIN blobs b ON b.id = f.blob_id "
+        " WHERE f.organization_id = organizations.id), "
+        "(SELECT max(f.upload_date) FROM files f "
+        " WHERE f.organization_id = organizations.id) "
+        "FROM organizations"
+    )
+
+
+def downgrade():
+    op.drop_table('organization_stats')
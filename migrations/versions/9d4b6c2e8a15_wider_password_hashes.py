@@ -0,0 +1,29 @@
+"""room for longer password hashes
+
+Revision ID: 9d4b6c2e8a15
+Revises: 8e5a3d1f7b42
+Create Date: 2014-04-12 14:08:19.530627
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9d4b6c2e8a15'
+down_revision = '8e5a3d1f7b42'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # SQLite doesn't enforce string lengths, and can't alter columns.
+    if op.get_bind().dialect.name != 'sqlite':
+        op.alter_column('users', 'password',
+                        type_=sa.String(length=255),
+                        existing_type=sa.String(length=20))
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        op.alter_column('users', 'password',
+                        type_=sa.String(length=20),
+                        existing_type=sa.String(length=255))
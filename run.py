@@ -3,15 +3,19 @@ import argparse
 
 sys.dont_write_bytecode = True
 from gtb import app
+from gtb.passwords import start_pool
 
-parser = argparse.ArgumentParser()
+parser = argparse.ArgumentParser(description="Runs the development "
+                                 "server. Use serve.py in production.")
 parser.add_argument("-i", "--ip", help="listen to this IP address",
                     default="0.0.0.0")
 parser.add_argument("-p", "--port", help="listen to this port",
                     default="3000", type=int)
 parser.add_argument("-d", "--debug", help="turn debugging on",
-                    default=True)
+                    action="store_true")
 
 args = parser.parse_args()
 
+# Before the server starts its threads.
+start_pool()
 app.run(args.ip, args.port, args.debug)
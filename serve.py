@@ -0,0 +1,113 @@
+"""
+Serves the app in production with gunicorn: a master process forks
+SERVE_WORKERS workers, each handling up to SERVE_THREADS requests at a
+time, and replaces any that die or hang. run.py is Flask's development
+server, which handles one request at a time.
+
+    python serve.py [-b 0.0.0.0:3000] [-w 4] [-t 4] [--timeout 600]
+                    [--preload | --no-preload]
+
+Settings default to the SERVE_* values in config.py.
+
+Workers don't share memory. Each keeps its own copies of logged in users
+(for USER_CACHE_TTL seconds) and of select field choices (for
+CHOICES_CACHE_TTL seconds), so a change made through one worker reaches
+the others once their copies expire. Memberships, which decide access,
+are never cached between requests. Rendered pages are shared, or with
+RENDER_CACHE_BACKEND = 'lru' kept per worker under version counters in
+RENDER_CACHE_DIR that all workers share; more than one worker is refused
+when those counters would be kept per worker too.
+
+    kill -HUP <master pid>    starts new workers and lets the old ones
+                              finish their requests (up to
+                              SERVE_GRACEFUL_TIMEOUT seconds). With
+                              --preload the code isn't reimported, so
+                              deploy new code with USR2 and then QUIT the
+                              old master instead.
+    kill -TERM <master pid>   same, then exits.
+"""
+import argparse
+import sys
+
+from gunicorn.app.base import BaseApplication
+
+import config
+
+
+class Server(BaseApplication):
+    """
+    Runs the app under gunicorn with the given settings.
+    """
+    def __init__(self, options):
+        self.options = options
+        BaseApplication.__init__(self)
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from gtb import app
+        return app
+
+
+def post_fork(server, worker):
+    """
+    Gives each worker its own database connections rather than the ones
+    a preloaded app opened in the master, and starts its password hashing
+    pool before the worker starts its threads.
+    """
+    from gtb import db
+    from gtb.passwords import start_pool
+    db.engine.dispose()
+    start_pool()
+
+
+def check_caches(workers):
+    """
+    Returns why the config can't run with this many workers, or None.
+    Only the config is read, so the app isn't imported before forking.
+    """
+    if (workers > 1 and config.RENDER_CACHE_BACKEND == 'lru' and
+        not config.RENDER_CACHE_DIR):
+        return ("RENDER_CACHE_BACKEND 'lru' without a RENDER_CACHE_DIR "
+                "keeps page versions per process, so workers would serve "
+                "each other's stale pages. Set RENDER_CACHE_DIR, use "
+                "another backend or run one worker.")
+    return None
+
+
+def options(args):
+    return {'bind': args.bind,
+            'workers': args.workers,
+            # More than one thread switches gunicorn to its threaded worker.
+            'threads': args.threads,
+            'timeout': args.timeout,
+            'graceful_timeout': config.SERVE_GRACEFUL_TIMEOUT,
+            'keepalive': config.SERVE_KEEPALIVE,
+            'preload_app': args.preload,
+            'post_fork': post_fork,
+            'proc_name': 'gtb'}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--bind', default=config.SERVE_BIND)
+    parser.add_argument('-w', '--workers', type=int,
+                        default=config.SERVE_WORKERS)
+    parser.add_argument('-t', '--threads', type=int,
+                        default=config.SERVE_THREADS)
+    parser.add_argument('--timeout', type=int, default=config.SERVE_TIMEOUT)
+    parser.add_argument('--preload', dest='preload', action='store_true',
+                        default=config.SERVE_PRELOAD)
+    parser.add_argument('--no-preload', dest='preload', action='store_false')
+    args = parser.parse_args(argv)
+
+    problem = check_caches(args.workers)
+    if problem:
+        parser.error(problem)
+    Server(options(args)).run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())